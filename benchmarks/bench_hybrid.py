@@ -0,0 +1,134 @@
+# bench_hybrid.py
+#
+# Latency and recall of vector-only, BM25 and hybrid retrieval on a synthetic corpus
+# where every document carries an exact identifier (ticket id, error code, function
+# name) and queries mix that identifier with a few topical words.
+#
+#   python benchmarks/bench_hybrid.py --docs 20000 --queries 300
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from bm25 import BM25Index, HybridProvider  # noqa: E402
+from vector_store import HashingEmbedder, VectorStore  # noqa: E402
+
+TOPIC_WORDS = (
+    "proxy certificate stream token latency index cache browser prompt context retrieval "
+    "conversation upstream handshake timeout memory payload session header request response "
+    "deploy rollback config queue worker shard tenant quota billing invoice refund login"
+).split()
+# Zipf-distributed vocabulary so posting lengths look like natural text
+VOCAB = TOPIC_WORDS + [f"w{i}" for i in range(20000)]
+WEIGHTS = [1.0 / (rank + 1) for rank in range(len(VOCAB))]
+
+
+def make_corpus(n_docs, rng):
+    docs = []
+    for i in range(n_docs):
+        ident = rng.choice([f"TICKET-{i:06d}", f"E{i:05d}X", f"handle_{i}_event"])
+        words = rng.choices(VOCAB, weights=WEIGHTS, k=rng.randint(40, 120))
+        words.insert(rng.randrange(len(words)), ident)
+        docs.append({"id": f"doc-{i}", "text": " ".join(words), "ident": ident})
+    return docs
+
+
+def make_queries(docs, n_queries, rng):
+    queries = []
+    for doc in rng.sample(docs, n_queries):
+        words = [w for w in doc["text"].split() if w != doc["ident"]]
+        text = " ".join(rng.sample(words, min(4, len(words))) + [doc["ident"]])
+        queries.append((text, doc["id"]))
+    return queries
+
+
+def exhaustive_bm25(index, text, k):
+    scores = {}
+    for term_id in index._terms(text):
+        docs, tfs = index._postings(term_id)
+        idf = float(index.idf[term_id])
+        for doc, tf in zip(docs, tfs):
+            scores[doc] = scores.get(doc, 0.0) + idf * tf * (index.k1 + 1) / (tf + float(index.norms[doc]))
+    return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+
+def timed(fn, queries, k):
+    latencies = []
+    results = []
+    for text, _ in queries:
+        start = time.perf_counter()
+        results.append(fn(text, k))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.asarray(latencies)
+
+
+def summarize(name, results, latencies, queries, store):
+    hits = 0
+    for rows, (_, expected) in zip(results, queries):
+        ids = {store.chunk(row)["id"] for row in rows}
+        hits += expected in ids
+    return {
+        "method": name,
+        "recall_at_k": hits / len(queries),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "mean_ms": float(latencies.mean()),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--dtype", choices=["float16", "int8"], default="int8")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    docs = make_corpus(args.docs, rng)
+    queries = make_queries(docs, args.queries, rng)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        store = VectorStore.build(tmp, docs, HashingEmbedder(), dtype=args.dtype)
+        lexical = BM25Index.build(tmp)
+        build_s = time.perf_counter() - start
+        hybrid = HybridProvider(store, lexical, k=args.k)
+
+        def vector_only(text, k):
+            return store.search(store.embedder.embed([text]), k)[0][0].tolist()
+
+        def bm25_maxscore(text, k):
+            return [row for row, _ in lexical.search(text, k)]
+
+        def bm25_exhaustive(text, k):
+            return [row for row, _ in exhaustive_bm25(lexical, text, k)]
+
+        def hybrid_fused(text, k):
+            return [row for row, _ in hybrid.rank(text)]
+
+        report = {"docs": args.docs, "queries": args.queries, "k": args.k, "build_s": build_s, "results": []}
+        for name, fn in [("vector", vector_only), ("bm25_maxscore", bm25_maxscore),
+                         ("bm25_exhaustive", bm25_exhaustive), ("hybrid", hybrid_fused)]:
+            results, latencies = timed(fn, queries, args.k)
+            report["results"].append(summarize(name, results, latencies, queries, store))
+
+        # MaxScore must return the same top-k scores as the exhaustive scan
+        mismatches = 0
+        for text, _ in queries:
+            fast = [round(score, 4) for _, score in lexical.search(text, args.k)]
+            slow = [round(score, 4) for _, score in exhaustive_bm25(lexical, text, args.k)]
+            mismatches += fast != slow
+        report["maxscore_mismatches"] = mismatches
+        store.close()
+
+    print(json.dumps(report, indent=2))
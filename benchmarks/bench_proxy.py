@@ -0,0 +1,347 @@
+# bench_proxy.py
+#
+# End-to-end cost of the injector. A local HTTPS server stands in for
+# chatgpt.com and streams `event: delta` SSE replies at a fixed token rate;
+# concurrent clients call it directly, through the proxy with the
+# conversation route decrypted but not rewritten, and through the proxy with
+# injection on. The proxy runs in its own process so its RSS is its own.
+# With --context-chunks the proxy retrieves that many overlapping document
+# windows per prompt instead of the static context, so --context-budget
+# (0 = unlimited) shows what packing saves in request bytes and tokens.
+#
+#   python benchmarks/bench_proxy.py --clients 16 --requests 20 --tokens 200 --token-rate 400
+#   python benchmarks/bench_proxy.py --scenarios direct,inject --context-chunks 12 --context-budget 0
+
+import argparse
+import datetime
+import http.client
+import json
+import multiprocessing
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC))
+
+from context_packer import TokenCounter  # noqa: E402
+
+COUNTER = TokenCounter()
+
+PATHS = ("/backend-api/conversation", "/backend-anon/conversation")
+HOST = "localhost"
+CLIENT_PROMPT = "How do I rotate the signing key without downtime?"
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def self_signed_cert(directory):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, HOST)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=7))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(HOST)]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = Path(directory) / "server.pem"
+    key_path = Path(directory) / "server.key"
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ))
+    return cert_path, key_path
+
+
+def sse_events(tokens, token_chars):
+    # Same shape as chatgpt.com's v1 delta encoding: one `add`, then bare appends
+    message = {
+        "message": {
+            "id": "bench-message",
+            "author": {"role": "assistant"},
+            "content": {"content_type": "text", "parts": [""]},
+            "status": "in_progress",
+        },
+        "conversation_id": "bench-conversation",
+    }
+    yield b'event: delta_encoding\ndata: "v1"\n\n'
+    yield b"event: delta\ndata: " + json.dumps({"p": "", "o": "add", "v": message, "c": 0}).encode() + b"\n\n"
+    word = ("lorem ipsum dolor sit amet " * (token_chars // 27 + 1))[:token_chars]
+    first = json.dumps({"p": "/message/content/parts/0", "o": "append", "v": word}).encode()
+    rest = json.dumps({"v": word}).encode()
+    for i in range(tokens):
+        yield b"event: delta\ndata: " + (first if i == 0 else rest) + b"\n\n"
+    yield b"data: [DONE]\n\n"
+
+
+class FakeChatGPT(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, cert, key, tokens, token_rate, token_chars):
+        super().__init__(("127.0.0.1", port), FakeChatGPTHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.token_chars = token_chars
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.injected = 0
+        self.request_bytes = []
+        self.injected_tokens = []
+
+
+class FakeChatGPTHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Streaming servers send each event immediately; Nagle would hold small writes for an ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.split("?")[0] not in PATHS:
+            self.send_error(404)
+            return
+        prompt = json.loads(body)["messages"][0]["content"]["parts"][0]
+        injected_tokens = COUNTER.count(prompt) - COUNTER.count(CLIENT_PROMPT)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.injected += prompt != CLIENT_PROMPT
+            self.server.request_bytes.append(len(body))
+            self.server.injected_tokens.append(injected_tokens)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        delay = 1.0 / self.server.token_rate if self.server.token_rate else 0.0
+        for event in sse_events(self.server.tokens, self.server.token_chars):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            self.wfile.flush()
+            if delay:
+                time.sleep(delay)
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def request_body(index):
+    return json.dumps({
+        "action": "next",
+        "messages": [{
+            "id": f"bench-{index}",
+            "author": {"role": "user"},
+            "content": {"content_type": "text", "parts": [CLIENT_PROMPT]},
+            "metadata": {},
+        }],
+        "conversation_id": None,
+        "parent_message_id": f"parent-{index}",
+        "model": "auto",
+    }).encode()
+
+
+def document_windows(count):
+    # Overlapping windows of one long paragraph, like vector_store.chunk_text makes, plus
+    # the top two again as a second provider would return them
+    from vector_store import chunk_text
+    rng = np.random.default_rng(0)
+    words = ["signing", "key", "rotation", "deploy", "service", "token", "replica", "cluster", "secret",
+             "restart", "namespace", "config", "the", "a", "of", "to", "and", "with", "without", "downtime"]
+    text = " ".join(rng.choice(words, size=160 * count))
+    windows = chunk_text(text)[:count]
+    return windows + windows[:2]
+
+
+def run_proxy(port, inject, log_level, ready, context_chunks=0, context_budget=None):
+    # Child process: the proxy under test and nothing else
+    sys.path.insert(0, str(SRC))
+    import logging
+    from context_providers import FunctionProvider
+    from mitmproxy_integration import MitmProxyThread
+    from routes import DEFAULT_ROUTES, Route
+
+    logging.getLogger().setLevel(log_level)
+    routes = None if inject else [
+        Route(r.name, r.paths, methods=r.methods, hosts=r.hosts, inject=False) for r in DEFAULT_ROUTES
+    ]
+    providers = None
+    if context_chunks:
+        windows = document_windows(context_chunks)
+        providers = [FunctionProvider(lambda prompt: windows, name="windows")]
+    proxy = MitmProxyThread(port, allowed_hosts=HOST, routes=routes, providers=providers,
+                            context_budget=context_budget)
+    proxy.daemon = True
+    proxy.start()
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    ready.set()
+    proxy.join()
+
+
+def proc_memory(pid):
+    memory = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                key, value = line.split(":")
+                memory[key] = int(value.split()[0]) * 1024
+    return {"rss_bytes": memory.get("VmRSS"), "peak_rss_bytes": memory.get("VmHWM")}
+
+
+def client(server_port, proxy_port, requests, warmup, results, errors):
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    if proxy_port is None:
+        conn = http.client.HTTPSConnection(HOST, server_port, context=context, timeout=60)
+    else:
+        conn = http.client.HTTPSConnection("127.0.0.1", proxy_port, context=context, timeout=60)
+        conn.set_tunnel(HOST, server_port)
+    for i in range(warmup + requests):
+        body = request_body(i)
+        start = time.perf_counter()
+        try:
+            conn.request("POST", PATHS[i % len(PATHS)], body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            first = response.read1(65536)
+            ttfb = time.perf_counter() - start
+            received = len(first)
+            while True:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                received += len(chunk)
+            total = time.perf_counter() - start
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(repr(e))
+            conn.close()
+            continue
+        if i >= warmup:
+            results.append((ttfb, total, received))
+    conn.close()
+
+
+def run_scenario(name, server, proxy_port, args):
+    results = []
+    errors = []
+    threads = [
+        threading.Thread(target=client, args=(server.server_port, proxy_port, args.requests, args.warmup, results, errors))
+        for _ in range(args.clients)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    ttfb = np.array([r[0] for r in results]) * 1000
+    total = np.array([r[1] for r in results]) * 1000
+    received = sum(r[2] for r in results)
+    summary = {
+        "scenario": name,
+        "requests": len(results),
+        "errors": len(errors),
+        "throughput_rps": len(results) / wall,
+        "throughput_mb_s": received / wall / 1e6,
+    }
+    if server.request_bytes:
+        summary["request_bytes"] = {f"p{q}": float(np.percentile(server.request_bytes, q)) for q in (50, 95)}
+        summary["injected_tokens"] = {f"p{q}": float(np.percentile(server.injected_tokens, q)) for q in (50, 95)}
+        summary["injected_tokens"]["mean"] = float(np.mean(server.injected_tokens))
+    for label, values in (("ttfb_ms", ttfb), ("total_ms", total)):
+        if len(values):
+            summary[label] = {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+    return summary
+
+
+def added_latency(direct, proxied):
+    added = {}
+    for label in ("ttfb_ms", "total_ms"):
+        if label in direct and label in proxied:
+            added[label] = {q: proxied[label][q] - direct[label][q] for q in direct[label]}
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=20, help="Measured requests per client")
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured requests per client")
+    parser.add_argument("--tokens", type=int, default=200, help="Delta events per reply")
+    parser.add_argument("--token-rate", type=float, default=0, help="Delta events per second (0 = unthrottled)")
+    parser.add_argument("--token-chars", type=int, default=4)
+    parser.add_argument("--scenarios", default="direct,passthrough,inject")
+    parser.add_argument("--context-chunks", type=int, default=0, help="Retrieve this many overlapping windows (0 = static context)")
+    parser.add_argument("--context-budget", type=int, default=1024, help="Injected context token budget (0 = unlimited)")
+    parser.add_argument("--proxy-log-level", default="WARNING")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    args = parser.parse_args()
+
+    report = {"config": vars(args), "results": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = self_signed_cert(tmp)
+        server = FakeChatGPT(free_port(), cert, key, args.tokens, args.token_rate, args.token_chars)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        mp = multiprocessing.get_context("spawn")
+        direct = None
+        for name in args.scenarios.split(","):
+            server.requests = server.injected = 0
+            server.request_bytes, server.injected_tokens = [], []
+            if name == "direct":
+                summary = run_scenario(name, server, None, args)
+                direct = summary
+            else:
+                port = free_port()
+                ready = mp.Event()
+                proc = mp.Process(target=run_proxy, daemon=True, args=(
+                    port, name == "inject", args.proxy_log_level, ready, args.context_chunks, args.context_budget or None,
+                ))
+                proc.start()
+                if not ready.wait(60):
+                    proc.terminate()
+                    raise SystemExit(f"Proxy for {name} did not start")
+                before = proc_memory(proc.pid)
+                summary = run_scenario(name, server, port, args)
+                summary["proxy_memory"] = dict(proc_memory(proc.pid), idle_rss_bytes=before["rss_bytes"])
+                proc.terminate()
+                proc.join(10)
+                if direct is not None:
+                    summary["added_latency_ms"] = added_latency(direct, summary)
+            summary["upstream_requests"] = server.requests
+            summary["upstream_injected"] = server.injected
+            report["results"].append(summary)
+        server.shutdown()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    print(output)
@@ -0,0 +1,100 @@
+# bench_rewrite.py
+#
+# Per-request CPU of the /conversation request rewrite: the old full parse +
+# pretty-print + reserialize path against the byte-splicing PromptRewrite path.
+#
+#   python benchmarks/bench_rewrite.py
+
+import argparse
+import json
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from rewrite import PromptRewrite  # noqa: E402
+
+CONTEXT = "You have to answer with my name AHMED WALI. Must include my name."
+
+
+def make_payload(attachments, history_chars):
+    message = {
+        "id": str(uuid.uuid4()),
+        "author": {"role": "user"},
+        "create_time": time.time(),
+        "content": {"content_type": "text", "parts": ["How do I rotate the signing key without downtime?"]},
+        "metadata": {
+            "attachments": [
+                {
+                    "id": f"file-{i}",
+                    "name": f"report-{i}.pdf",
+                    "size": 1 << 20,
+                    "mime_type": "application/pdf",
+                    "extracted_text": ("Quarterly numbers and notes. " * 40),
+                }
+                for i in range(attachments)
+            ],
+            "serialization_metadata": {"custom_symbol_offsets": []},
+        },
+    }
+    return {
+        "action": "next",
+        "messages": [message],
+        "conversation_id": str(uuid.uuid4()),
+        "parent_message_id": str(uuid.uuid4()),
+        "model": "auto",
+        "timezone_offset_min": -300,
+        "history_and_training_disabled": False,
+        "conversation_mode": {"kind": "primary_assistant"},
+        "client_contextual_info": {"notes": "x" * history_chars},
+        "supports_buffering": True,
+    }
+
+
+def old_path(body):
+    # What the request hook did before: parse, pretty-print, reserialize, encode twice
+    payload_json = json.loads(body)
+    json.dumps(payload_json, indent=2)
+    original_prompt = payload_json["messages"][0]["content"]["parts"][0]
+    payload_json["messages"][0]["content"]["parts"][0] = f"{CONTEXT} Prompt: {original_prompt}"
+    modified_payload = json.dumps(payload_json)
+    str(len(modified_payload.encode("utf-8")))
+    return modified_payload.encode("utf-8")
+
+
+def new_path(body):
+    rewrite = PromptRewrite(body)
+    rewrite.conversation_id
+    return rewrite.apply(f"{CONTEXT} Prompt: {rewrite.prompt}")
+
+
+def measure(fn, body, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        fn(body)
+    return (time.process_time() - start) / iterations * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=0, help="Fixed iteration count (default: scale by size)")
+    args = parser.parse_args()
+
+    cases = [("small", 0, 0), ("attachments_20", 20, 0), ("attachments_200", 200, 0), ("history_2mb", 5, 2_000_000)]
+    report = []
+    for name, attachments, history in cases:
+        body = json.dumps(make_payload(attachments, history)).encode("utf-8")
+        iterations = args.iterations or max(20, 2_000_000 // len(body))
+        assert json.loads(old_path(body)) == json.loads(new_path(body))
+        old_us = measure(old_path, body, iterations)
+        new_us = measure(new_path, body, iterations)
+        report.append({
+            "case": name,
+            "body_bytes": len(body),
+            "old_us_per_request": round(old_us, 1),
+            "new_us_per_request": round(new_us, 1),
+            "speedup": round(old_us / new_us, 1),
+        })
+    print(json.dumps(report, indent=2))
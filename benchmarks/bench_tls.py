@@ -0,0 +1,230 @@
+# bench_tls.py
+#
+# First-connection TLS cost of the secure proxy. Each scenario starts the
+# proxy in a fresh process (a restart), then opens one CONNECT tunnel per
+# distinct SNI host to a local TLS server and times the client handshake and
+# the first request. The client verifies against the project CA, so a stale
+# or mismatched cached leaf shows up as an error rather than a fast number.
+#
+#   no-cache    leaves generated by mitmproxy on the first handshake (the old behaviour)
+#   warm-start  empty leaf cache, every host issued while the proxy starts
+#   restart     same confdir again: leaves loaded from proxy_data/leaf-certs
+#
+# Also times CA generation in-process against the `openssl req` CLI it replaces.
+#
+#   python benchmarks/bench_tls.py --hosts 50
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+SRC = Path(__file__).resolve().parent.parent / "src_secure"
+sys.path.insert(0, str(SRC))
+
+DOMAIN = "bench.test"
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def upstream_cert(directory):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, f"*.{DOMAIN}")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=7))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(f"*.{DOMAIN}")]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = Path(directory) / "upstream.pem"
+    key_path = Path(directory) / "upstream.key"
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ))
+    return cert_path, key_path
+
+
+def serve_upstream(listener, context):
+    # Answers one tiny HTTP/1.1 response per connection
+    def handle(conn):
+        try:
+            with context.wrap_socket(conn, server_side=True) as tls:
+                tls.recv(65536)
+                tls.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok")
+        except OSError:
+            pass
+
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+def run_proxy(ca_cert, ca_key, confdir, port, hosts, scenario, log_level, results):
+    # Child process: one proxy start plus one first connection per host
+    import logging
+    logging.getLogger().setLevel(log_level)
+    from mitmproxy_integration import MitmProxyThread
+
+    start = time.perf_counter()
+    proxy = MitmProxyThread(
+        ca_cert, ca_key, port,
+        confdir=confdir,
+        warm_hosts=hosts if scenario != "no-cache" else None,
+        leaf_cache=scenario != "no-cache",
+        # The stand-in upstream is self-signed
+        options_overrides={"allowed_hosts": ",".join(hosts), "ssl_insecure": True},
+    )
+    proxy.daemon = True
+    proxy.start()
+    proxy.wait_ready(timeout=60)
+    startup = time.perf_counter() - start
+    results.put({"startup_ms": startup * 1000})
+    proxy.join()
+
+
+def first_request(proxy_port, upstream_port, host, context):
+    start = time.perf_counter()
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=30)
+    try:
+        sock.sendall(f"CONNECT 127.0.0.1:{upstream_port} HTTP/1.1\r\nHost: 127.0.0.1:{upstream_port}\r\n\r\n".encode())
+        reply = b""
+        while b"\r\n\r\n" not in reply:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("proxy closed the tunnel")
+            reply += chunk
+        if b" 200 " not in reply.split(b"\r\n", 1)[0]:
+            raise ConnectionError(reply.split(b"\r\n", 1)[0].decode())
+        handshake_start = time.perf_counter()
+        tls = context.wrap_socket(sock, server_hostname=host)
+        handshake = time.perf_counter() - handshake_start
+        tls.sendall(f"GET / HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+        response = b""
+        while b"ok" not in response:
+            chunk = tls.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        tls.close()
+    finally:
+        sock.close()
+    return handshake, time.perf_counter() - start
+
+
+def run_scenario(name, ca_cert, ca_key, confdir, upstream_port, hosts, args):
+    mp = multiprocessing.get_context("spawn")
+    port = free_port()
+    results = mp.Queue()
+    proc = mp.Process(target=run_proxy, args=(ca_cert, ca_key, confdir, port, hosts, name, args.proxy_log_level, results), daemon=True)
+    proc.start()
+    summary = {"scenario": name, **results.get(timeout=120)}
+
+    context = ssl.create_default_context(cafile=str(ca_cert))
+    handshakes, totals, errors = [], [], []
+    for host in hosts:
+        try:
+            handshake, total = first_request(port, upstream_port, host, context)
+        except (OSError, ssl.SSLError) as e:
+            errors.append(f"{host}: {e!r}")
+            continue
+        handshakes.append(handshake * 1000)
+        totals.append(total * 1000)
+    proc.terminate()
+    proc.join(10)
+
+    summary["connections"] = len(handshakes)
+    summary["errors"] = errors[:5]
+    for label, values in (("handshake_ms", handshakes), ("first_request_ms", totals)):
+        if values:
+            summary[label] = {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+            summary[label]["mean"] = float(np.mean(values))
+    summary["cached_leaves"] = len(list((Path(confdir) / "leaf-certs").glob("*.pem")))
+    return summary
+
+
+def time_ca_generation(tmp, repeat):
+    from certs import ensure_ca
+    timings = {"in_process_ms": []}
+    for i in range(repeat):
+        start = time.perf_counter()
+        ensure_ca(Path(tmp) / f"ca-{i}")
+        timings["in_process_ms"].append((time.perf_counter() - start) * 1000)
+    if shutil.which("openssl"):
+        timings["openssl_cli_ms"] = []
+        config = Path(tmp) / "openssl.cnf"
+        config.write_text(
+            "[req]\ndefault_bits = 2048\nprompt = no\ndefault_md = sha256\n"
+            "distinguished_name = dn\nx509_extensions = v3_ca\n"
+            "[dn]\nCN = Custom Proxy CA\nO = Your Company\nC = US\n"
+            "[v3_ca]\nbasicConstraints = critical,CA:TRUE\nkeyUsage = critical,keyCertSign,cRLSign\n"
+        )
+        for i in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([
+                "openssl", "req", "-new", "-x509", "-days", "3650", "-config", str(config),
+                "-keyout", str(Path(tmp) / f"cli-{i}.key"), "-out", str(Path(tmp) / f"cli-{i}.pem"), "-nodes",
+            ], check=True, capture_output=True, timeout=60)
+            timings["openssl_cli_ms"].append((time.perf_counter() - start) * 1000)
+    # RSA key generation time varies a lot, so report the median
+    return {label: float(np.median(values)) for label, values in timings.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", type=int, default=30, help="Distinct SNI hosts, one first connection each")
+    parser.add_argument("--ca-repeat", type=int, default=5)
+    parser.add_argument("--proxy-log-level", default="WARNING")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    args = parser.parse_args()
+
+    from certs import ensure_ca
+
+    hosts = [f"h{i}.{DOMAIN}" for i in range(args.hosts)]
+    report = {"config": vars(args), "results": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        report["ca_generation"] = time_ca_generation(tmp, args.ca_repeat)
+        ca_cert, ca_key = ensure_ca(Path(tmp) / "certificates")
+
+        cert, key = upstream_cert(tmp)
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(cert, key)
+        listener = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=serve_upstream, args=(listener, server_context), daemon=True).start()
+        upstream_port = listener.getsockname()[1]
+
+        no_cache = Path(tmp) / "proxy_data-no-cache"
+        cached = Path(tmp) / "proxy_data"
+        for name, confdir in (("no-cache", no_cache), ("warm-start", cached), ("restart", cached)):
+            report["results"].append(run_scenario(name, ca_cert, ca_key, confdir, upstream_port, hosts, args))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    print(output)
@@ -0,0 +1,292 @@
+# bm25.py
+
+import array
+import bisect
+import collections
+import heapq
+import json
+import logging
+import math
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from context_providers import ContextChunk
+from vector_store import StoreProvider, read_header, tokenize
+
+LEXICAL_FILES = ("offsets", "docs", "tfs", "idf", "norms", "upper")
+
+
+class BM25Index:
+    """Inverted index stored next to a VectorStore, with the same row numbers.
+
+    Postings are CSR arrays: `docs[offsets[t]:offsets[t + 1]]` are the sorted rows
+    containing term t and `tfs` their term frequencies. IDF, per-row length
+    norms and each term's maximum possible contribution are precomputed so
+    queries can use MaxScore: once the k-th best score beats the combined upper
+    bound of the rarest-impact terms, those terms' postings are only probed for
+    candidates that can still make it into the top-k, never scanned.
+
+    As with the IVF index, the arrays of one build share a generation in their
+    file names and `bm25.json` naming it is replaced last, so a rebuild never
+    touches the files an open index has mapped.
+    """
+
+    def __init__(self, path, meta, arrays):
+        self.path = Path(path)
+        self.meta = meta
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+        self.vocab = meta["vocab"]
+        self.store_count = meta["store_count"]
+        self.deleted = frozenset(meta["deleted"])
+        for name in LEXICAL_FILES:
+            setattr(self, name, arrays[name])
+        # The query loop reads one norm per candidate; a flat array avoids numpy scalar overhead
+        self._norms = array.array("f", np.ascontiguousarray(self.norms).tobytes())
+
+    @classmethod
+    def open(cls, path):
+        path = Path(path)
+        for attempt in range(3):
+            with open(path / "bm25.json") as f:
+                meta = json.load(f)
+            # Indexes built before generations existed use the bare names
+            prefix = f"bm25-{meta['generation']}_" if "generation" in meta else "bm25_"
+            try:
+                arrays = {name: np.load(path / f"{prefix}{name}.npy", mmap_mode="r") for name in LEXICAL_FILES}
+            except FileNotFoundError:
+                # A rebuild committed and unlinked this generation between the two reads
+                if attempt == 2:
+                    raise
+                continue
+            return cls(path, meta, arrays)
+
+    @classmethod
+    def is_fresh(cls, path, store):
+        try:
+            with open(Path(path) / "bm25.json") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return meta["store_count"] == store.count and meta["deleted"] == store.deleted.tolist()
+
+    @classmethod
+    def build(cls, path, k1=1.2, b=0.75):
+        path = Path(path)
+        header = read_header(path)
+        count = header["count"]
+        deleted = sorted(header.get("deleted", ()))
+        deleted_set = set(deleted)
+
+        postings = collections.defaultdict(list)
+        lengths = np.zeros(count, dtype=np.float32)
+        with open(path / "chunks.jsonl", "rb") as f:
+            for row in range(count):
+                record = json.loads(f.readline())
+                if row in deleted_set:
+                    continue
+                tokens = tokenize(record["text"])
+                lengths[row] = len(tokens)
+                for term, tf in collections.Counter(tokens).items():
+                    postings[term].append((row, tf))
+
+        live = count - len(deleted_set)
+        avgdl = float(lengths.sum() / live) if live else 1.0
+        norms = (k1 * (1.0 - b + b * lengths / avgdl)).astype(np.float32)
+
+        vocab = {}
+        offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        docs = np.empty(sum(len(p) for p in postings.values()), dtype=np.uint32)
+        tfs = np.empty(len(docs), dtype=np.uint16)
+        idf = np.empty(len(postings), dtype=np.float32)
+        upper = np.empty(len(postings), dtype=np.float32)
+        pos = 0
+        for term_id, (term, plist) in enumerate(postings.items()):
+            vocab[term] = term_id
+            n = len(plist)
+            term_docs = np.fromiter((d for d, _ in plist), dtype=np.uint32, count=n)
+            term_tfs = np.fromiter((min(tf, 65535) for _, tf in plist), dtype=np.uint16, count=n)
+            docs[pos:pos + n] = term_docs
+            tfs[pos:pos + n] = term_tfs
+            pos += n
+            offsets[term_id + 1] = pos
+            idf[term_id] = math.log(1.0 + (live - n + 0.5) / (n + 0.5))
+            contrib = term_tfs * (k1 + 1.0) / (term_tfs + norms[term_docs])
+            upper[term_id] = idf[term_id] * contrib.max()
+
+        generation = f"{time.time_ns():x}"
+        arrays = {"offsets": offsets, "docs": docs, "tfs": tfs, "idf": idf, "norms": norms, "upper": upper}
+        for name, array in arrays.items():
+            np.save(path / f"bm25-{generation}_{name}.npy", array)
+        meta = {"generation": generation, "k1": k1, "b": b, "avgdl": avgdl, "store_count": count,
+                "deleted": deleted, "vocab": vocab}
+        tmp = path / "bm25.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path / "bm25.json")
+        # A live provider keeps its own generation mapped; unlinking never changes what it reads
+        for old in list(path.glob("bm25-*_*.npy")) + list(path.glob("bm25_*.npy")):
+            if not old.name.startswith(f"bm25-{generation}_"):
+                old.unlink()
+        logging.info(f"Built BM25 index: {len(vocab)} terms, {len(docs)} postings over {live} chunks")
+        return cls.open(path)
+
+    def _terms(self, text):
+        seen = []
+        for token in tokenize(text):
+            term_id = self.vocab.get(token)
+            if term_id is not None and term_id not in seen:
+                seen.append(term_id)
+        return seen
+
+    def _postings(self, term_id):
+        start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+        return self.docs[start:end].tolist(), self.tfs[start:end].tolist()
+
+    def search(self, text, k=10):
+        """MaxScore top-k. Returns a list of (row, score), best first."""
+        terms = self._terms(text)
+        if not terms:
+            return []
+        # Ascending upper bound: a prefix of this list is the non-essential set
+        terms.sort(key=lambda t: self.upper[t])
+        lists = [self._postings(t) for t in terms]
+        lengths = [len(docs) for docs, _ in lists]
+        idf = [float(self.idf[t]) for t in terms]
+        prefix_ub = np.cumsum([float(self.upper[t]) for t in terms]).tolist()
+        norms = self._norms
+        k1p1 = self.k1 + 1.0
+        n_terms = len(terms)
+
+        cursors = [0] * n_terms
+        heap = []
+        threshold = 0.0
+        first_essential = 0
+        while True:
+            # Next candidate: smallest current row across the essential lists
+            candidate = None
+            for i in range(first_essential, n_terms):
+                c = cursors[i]
+                if c < lengths[i]:
+                    doc = lists[i][0][c]
+                    if candidate is None or doc < candidate:
+                        candidate = doc
+            if candidate is None:
+                break
+
+            norm = norms[candidate]
+            score = 0.0
+            for i in range(first_essential, n_terms):
+                c = cursors[i]
+                if c < lengths[i]:
+                    docs, tfs = lists[i]
+                    if docs[c] == candidate:
+                        tf = tfs[c]
+                        score += idf[i] * tf * k1p1 / (tf + norm)
+                        cursors[i] = c + 1
+
+            # Probe the non-essential lists only while the candidate can still qualify
+            for i in range(first_essential - 1, -1, -1):
+                if score + prefix_ub[i] <= threshold:
+                    break
+                docs, tfs = lists[i]
+                j = bisect.bisect_left(docs, candidate, cursors[i])
+                cursors[i] = j
+                if j < lengths[i] and docs[j] == candidate:
+                    tf = tfs[j]
+                    score += idf[i] * tf * k1p1 / (tf + norm)
+
+            if candidate in self.deleted:
+                continue
+            if len(heap) < k:
+                heapq.heappush(heap, (score, candidate))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, candidate))
+            else:
+                continue
+            if len(heap) == k:
+                threshold = heap[0][0]
+                while first_essential < n_terms and prefix_ub[first_essential] <= threshold:
+                    first_essential += 1
+
+        return [(row, score) for score, row in sorted(heap, reverse=True)]
+
+    def score_rows(self, text, rows):
+        """Exact BM25 scores for specific rows, e.g. vector-only candidates."""
+        rows = np.asarray(rows, dtype=np.uint32)
+        scores = np.zeros(len(rows), dtype=np.float32)
+        norms = self.norms[rows]
+        for term_id in self._terms(text):
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            docs = self.docs[start:end]
+            pos = np.minimum(np.searchsorted(docs, rows), len(docs) - 1)
+            found = docs[pos] == rows
+            tf = self.tfs[start:end][pos[found]].astype(np.float32)
+            scores[found] += self.idf[term_id] * tf * (self.k1 + 1.0) / (tf + norms[found])
+        return scores
+
+
+class HybridProvider(StoreProvider):
+    """Fuses BM25 and vector scores over the union of both candidate lists.
+
+    Each side is rescored exactly on the other's candidates, both are min-max
+    normalised over the union, and `alpha` weights the vector side. Rows that
+    clear neither raw-score floor are dropped before fusion, so an unrelated
+    prompt gets no context rather than the least bad chunk.
+    """
+
+    name = "hybrid"
+
+    def __init__(self, store, lexical, k=4, alpha=0.5, candidates=20,
+                 min_vector_score=0.1, min_lexical_score=1.0):
+        super().__init__(store)
+        self.lexical = lexical
+        self.k = k
+        self.alpha = alpha
+        self.candidates = candidates
+        self.min_vector_score = min_vector_score
+        self.min_lexical_score = min_lexical_score
+
+    def rank(self, text, nprobe=None):
+        store = self.store
+        query = store.embedder.embed([text])[0]
+        vec_rows, _ = store.search(query, self.candidates, nprobe)[0]
+        lex_hits = self.lexical.search(text, self.candidates)
+        rows = sorted(set(vec_rows.tolist()) | {row for row, _ in lex_hits})
+        if not rows:
+            return []
+
+        index = np.asarray(rows)
+        vec = store.vectors[index].astype(np.float32) @ query
+        if store.scales is not None:
+            vec *= store.scales[index]
+        lex = self.lexical.score_rows(text, index)
+
+        relevant = (vec >= self.min_vector_score) | (lex >= self.min_lexical_score)
+        if not relevant.any():
+            return []
+        index, vec, lex = index[relevant], vec[relevant], lex[relevant]
+        fused = self.alpha * _minmax(vec) + (1.0 - self.alpha) * _minmax(lex)
+        order = np.argsort(-fused)[:self.k]
+        return [(int(index[i]), float(fused[i])) for i in order]
+
+    def search(self, prompt, nprobe=None):
+        chunks = []
+        for row, score in self.rank(prompt, nprobe):
+            meta = self.store.chunk(row)
+            chunks.append(ContextChunk(meta["id"], meta["text"], score, meta.get("source", self.name)))
+        return chunks
+
+
+def _minmax(scores):
+    if not len(scores):
+        return scores
+    lo, hi = scores.min(), scores.max()
+    if hi - lo < 1e-9:
+        return np.ones_like(scores) if hi > 0 else np.zeros_like(scores)
+    return (scores - lo) / (hi - lo)
@@ -0,0 +1,138 @@
+# capture.py
+
+import gzip
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from pathlib import Path
+
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+class FlowCapture:
+    """Records intercepted flows as JSONL without touching the proxy loop's latency.
+
+    `capture()` only samples and enqueues; a daemon thread drains the bounded
+    queue in batches, truncates long fields, and appends to size-rotated files
+    (`<prefix>-<timestamp>-<n>.jsonl[.gz|.zst]`). When the writer can't keep up the
+    record is dropped and counted instead of blocking the caller.
+    """
+
+    def __init__(self, directory, max_bytes=64 << 20, compression=None, sample_rate=1.0,
+                 max_field_chars=4096, queue_size=10000, batch_size=256, flush_interval=1.0, prefix="flows"):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unsupported capture compression: {compression}")
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.sample_rate = sample_rate
+        self.max_field_chars = max_field_chars
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.captured = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.written = 0
+        self.files = 0
+        self._file = None
+        self._file_bytes = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="flow-capture", daemon=True)
+        self._thread.start()
+
+    def capture(self, kind, **fields):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return False
+        fields["kind"] = kind
+        fields["ts"] = time.time()
+        try:
+            self.queue.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.captured += 1
+        return True
+
+    def stats(self):
+        return {
+            "captured": self.captured,
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "queued": self.queue.qsize(),
+            "files": self.files,
+        }
+
+    def close(self, timeout=5.0):
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    logging.error(f"Flow capture write failed, {len(batch)} records lost: {e}")
+            elif self._stopping.is_set() and self.queue.empty():
+                break
+        if self._file is not None:
+            self._file.close()
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        data = "".join(
+            json.dumps(self._truncate(record), ensure_ascii=False, default=str) + "\n" for record in batch
+        ).encode("utf-8")
+        if self._file is None or self._file_bytes >= self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        # Rotation is on uncompressed bytes so it doesn't depend on the codec's ratio
+        self._file_bytes += len(data)
+        self.written += len(batch)
+
+    def _truncate(self, record):
+        limit = self.max_field_chars
+        for key, value in record.items():
+            if isinstance(value, bytes):
+                value = value.decode("utf-8", errors="replace")
+            if isinstance(value, str) and len(value) > limit:
+                value = f"{value[:limit]}...[{len(value) - limit} more chars]"
+            record[key] = value
+        return record
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.files += 1
+        name = f"{self.prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{self.files}.jsonl{COMPRESSION_SUFFIXES[self.compression]}"
+        path = self.directory / name
+        if self.compression == "gzip":
+            self._file = gzip.open(path, "ab")
+        elif self.compression == "zstd":
+            import zstandard
+            self._file = zstandard.ZstdCompressor().stream_writer(open(path, "ab"))
+        else:
+            self._file = open(path, "ab")
+        self._file_bytes = 0
+        logging.info(f"Capturing flows to {path}")
@@ -0,0 +1,129 @@
+# context_packer.py
+
+import functools
+import logging
+import re
+
+DEFAULT_BUDGET = 1024
+
+# Roughly how BPE tokenizers pre-split text: a word with its leading space, up to
+# three digits, a run of punctuation, or whitespace
+_PIECE_RE = re.compile(r" ?[A-Za-z]+| ?\d{1,3}| ?[^\sA-Za-z\d]+|\s+")
+
+
+def _estimate(text):
+    tokens = 0
+    for piece in _PIECE_RE.findall(text):
+        if piece[-1:].isascii():
+            # Common words are one token; long or rare ones split about every 7 characters
+            tokens += 1 + len(piece) // 7
+        else:
+            tokens += len(piece)
+    return tokens
+
+
+def load_encoding(name="o200k_base"):
+    # tiktoken is optional and fetches its vocabulary on first use, so any failure means "estimate"
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logging.info(f"Using estimated token counts ({type(e).__name__}: {e})")
+        return None
+
+
+class TokenCounter:
+    """Token counts for context text, memoized by string.
+
+    Uses tiktoken when it is installed, otherwise an estimate from BPE-style
+    pre-tokenization. Chunks from the index recur across requests, so most
+    lookups are cache hits.
+    """
+
+    def __init__(self, encoding="auto", cache_size=8192):
+        self.encoding = load_encoding() if encoding == "auto" else encoding
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return _estimate(text)
+
+
+def _shingles(text, size=5):
+    words = text.casefold().split()
+    if len(words) <= size:
+        return {hash(tuple(words))}
+    return {hash(tuple(words[i:i + size])) for i in range(len(words) - size + 1)}
+
+
+class PackedContext:
+    __slots__ = ("text", "chunks", "tokens", "duplicates", "over_budget")
+
+    def __init__(self, text, chunks, tokens, duplicates, over_budget):
+        self.text = text
+        self.chunks = chunks
+        self.tokens = tokens
+        self.duplicates = duplicates
+        self.over_budget = over_budget
+
+
+class ContextPacker:
+    """Picks the retrieved chunks worth injecting under a token budget.
+
+    Chunks whose word 5-grams are mostly (`overlap`) already covered by
+    higher-scored chunks are dropped first: the same passage from two
+    providers, or near-copies across documents. The rest are packed greedily by
+    score per token; if the single best chunk that fits is worth more than the
+    greedy set, it is used alone (the usual 1/2-approximation for knapsack).
+    The selection is returned most relevant first. `budget=None` only dedupes.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, counter=None, overlap=0.8, separator="\n"):
+        self.budget = budget
+        self.counter = counter or TokenCounter()
+        self.overlap = overlap
+        self.separator = separator
+
+    def pack(self, chunks):
+        ranked = sorted(chunks, key=lambda c: c.score, reverse=True)
+        unique = []
+        seen = set()
+        for chunk in ranked:
+            shingles = _shingles(chunk.text)
+            if len(shingles & seen) >= self.overlap * len(shingles):
+                continue
+            seen |= shingles
+            unique.append(chunk)
+        duplicates = len(ranked) - len(unique)
+
+        separator_tokens = self.counter.count(self.separator) if len(unique) > 1 else 0
+        costs = {id(chunk): self.counter.count(chunk.text) + separator_tokens for chunk in unique}
+        if self.budget is None:
+            selected = unique
+        else:
+            selected = self._knapsack(unique, costs)
+        selected.sort(key=lambda c: c.score, reverse=True)
+        tokens = sum(costs[id(chunk)] for chunk in selected) - (separator_tokens if selected else 0)
+        text = self.separator.join(chunk.text for chunk in selected)
+        return PackedContext(text, selected, tokens, duplicates, len(unique) - len(selected))
+
+    def _knapsack(self, chunks, costs):
+        # Scores can be zero or negative (cosine); shift them positive so density still ranks
+        floor = min((c.score for c in chunks), default=1.0)
+        shift = 1e-6 - floor if floor <= 0 else 0.0
+        value = {id(c): c.score + shift for c in chunks}
+        by_density = sorted(chunks, key=lambda c: value[id(c)] / max(costs[id(c)], 1), reverse=True)
+        selected = []
+        used = 0
+        for chunk in by_density:
+            cost = costs[id(chunk)]
+            if used + cost <= self.budget:
+                selected.append(chunk)
+                used += cost
+        fitting = [c for c in chunks if costs[id(c)] <= self.budget]
+        if fitting:
+            best = max(fitting, key=lambda c: value[id(c)])
+            if value[id(best)] > sum(value[id(c)] for c in selected):
+                return [best]
+        return selected
@@ -0,0 +1,172 @@
+# context_providers.py
+
+import asyncio
+import collections
+import logging
+import time
+
+DEFAULT_CONTEXT = "You have to answer with my name AHMED WALI. Must include my name."
+
+
+class ContextQuery:
+    """What a provider gets to look at for one intercepted prompt."""
+
+    def __init__(self, prompt, conversation_id=None, route=None, metadata=None, tenant=None, nprobe=None):
+        self.prompt = prompt
+        self.conversation_id = conversation_id
+        self.route = route
+        self.metadata = metadata if metadata is not None else {}
+        # Whose corpus to search; None when the proxy is not multi-tenant
+        self.tenant = tenant
+        # IVF lists to probe; None leaves it to the index
+        self.nprobe = nprobe
+        # Set by a provider whose search actually probed an IVF index with `nprobe`
+        self.nprobe_applied = False
+
+
+class ContextChunk:
+    __slots__ = ("id", "text", "score", "source")
+
+    def __init__(self, id, text, score=1.0, source=None):
+        self.id = id
+        self.text = text
+        self.score = score
+        self.source = source
+
+    def __repr__(self):
+        return f"ContextChunk({self.id!r}, score={self.score:.3f})"
+
+
+class ContextProvider:
+    """Base class for context sources. `fetch` must not block the event loop."""
+
+    name = "provider"
+    # Hard latency budget in seconds; the pipeline cancels the fetch after this
+    timeout = 0.25
+
+    async def fetch(self, query):
+        raise NotImplementedError
+
+
+class StaticProvider(ContextProvider):
+    name = "static"
+
+    def __init__(self, text=DEFAULT_CONTEXT):
+        self.text = text
+
+    async def fetch(self, query):
+        return [ContextChunk("static", self.text, source=self.name)]
+
+
+class FunctionProvider(ContextProvider):
+    """Wraps a blocking `func(prompt) -> list[str]` and runs it on a worker thread."""
+
+    def __init__(self, func, name=None, timeout=None):
+        self.func = func
+        self.name = name or getattr(func, "__name__", "function")
+        if timeout is not None:
+            self.timeout = timeout
+
+    async def fetch(self, query):
+        loop = asyncio.get_running_loop()
+        texts = await loop.run_in_executor(None, self.func, query.prompt)
+        return [
+            ContextChunk(f"{self.name}:{i}", text, score=1.0 / (i + 1), source=self.name)
+            for i, text in enumerate(texts or ())
+        ]
+
+
+class ContextResult:
+    __slots__ = ("chunks", "status", "elapsed")
+
+    def __init__(self, chunks, status, elapsed=0.0):
+        self.chunks = chunks
+        # ok | partial | fallback | shed | empty
+        self.status = status
+        self.elapsed = elapsed
+
+
+class ContextPipeline:
+    """Runs all providers concurrently under a deadline and an in-flight cap.
+
+    A provider that times out or fails contributes its last good result for the
+    same prompt, if there is one, and nothing otherwise. When more than
+    `max_in_flight` retrievals are already running, new ones are shed straight
+    to that fallback so the proxy keeps forwarding at full speed.
+
+    Background retrievals (prefetches of a draft) have their own, smaller
+    `max_background` cap and do not count towards `in_flight`, so they can
+    never push a real request into shedding; past their cap they are shed
+    with no fallback.
+    """
+
+    def __init__(self, providers, deadline=0.5, max_in_flight=16, fallback_size=256, max_background=2):
+        self.providers = list(providers)
+        self.deadline = deadline
+        self.max_in_flight = max_in_flight
+        self.max_background = max_background
+        self.fallback_size = fallback_size
+        self.in_flight = 0
+        self.background = 0
+        self.stats = collections.Counter()
+        self._fallback = collections.OrderedDict()
+
+    async def retrieve(self, query, background=False):
+        start = time.perf_counter()
+        if background:
+            if self.background >= self.max_background:
+                self.stats["background_shed"] += 1
+                return ContextResult([], "shed", time.perf_counter() - start)
+            self.background += 1
+        elif self.in_flight >= self.max_in_flight:
+            self.stats["shed"] += 1
+            chunks = self._fallback_chunks(query)
+            return ContextResult(chunks, "shed", time.perf_counter() - start)
+        else:
+            self.in_flight += 1
+        try:
+            results = await asyncio.gather(*(self._fetch_one(p, query) for p in self.providers))
+        finally:
+            if background:
+                self.background -= 1
+            else:
+                self.in_flight -= 1
+
+        chunks = []
+        failed = 0
+        for provider_chunks, ok in results:
+            chunks.extend(provider_chunks)
+            failed += not ok
+        if not failed:
+            status = "ok" if chunks else "empty"
+        else:
+            status = "partial" if failed < len(self.providers) else "fallback"
+        self.stats[status] += 1
+        return ContextResult(chunks, status, time.perf_counter() - start)
+
+    async def _fetch_one(self, provider, query):
+        budget = min(provider.timeout, self.deadline)
+        try:
+            chunks = await asyncio.wait_for(provider.fetch(query), budget)
+        except asyncio.TimeoutError:
+            self.stats[f"{provider.name}_timeout"] += 1
+            logging.warning(f"Context provider {provider.name} exceeded {budget * 1000:.0f}ms budget")
+            return self._fallback.get((provider.name, query.tenant, query.prompt), []), False
+        except Exception as e:
+            self.stats[f"{provider.name}_error"] += 1
+            logging.error(f"Context provider {provider.name} failed: {e}")
+            return self._fallback.get((provider.name, query.tenant, query.prompt), []), False
+
+        chunks = list(chunks or ())
+        key = (provider.name, query.tenant, query.prompt)
+        self._fallback[key] = chunks
+        self._fallback.move_to_end(key)
+        if len(self._fallback) > self.fallback_size:
+            self._fallback.popitem(last=False)
+        return chunks, True
+
+    def _fallback_chunks(self, query):
+        chunks = []
+        for provider in self.providers:
+            chunks.extend(self._fallback.get((provider.name, query.tenant, query.prompt), ()))
+        return chunks
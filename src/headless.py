@@ -0,0 +1,260 @@
+# headless.py
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+
+def enable_reuse_port():
+    """Make every TCP listener this process opens set SO_REUSEPORT.
+
+    Each worker binds its own socket to the same address and the kernel
+    spreads incoming connections across them, so no process hands off
+    accepted sockets and a crashed worker only loses its own connections.
+    mitmproxy opens its listener through `asyncio.start_server`, which is why
+    the switch lives there.
+    """
+    start_server = asyncio.start_server
+
+    async def reuse_port_start_server(*args, **kwargs):
+        kwargs.setdefault("reuse_port", True)
+        return await start_server(*args, **kwargs)
+
+    asyncio.start_server = reuse_port_start_server
+
+
+def check_reuse_port(host, port):
+    # Fail in the supervisor, before forking, if the address can't be shared
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((host, port))
+
+
+def worker_main(slot, config):
+    # Runs in the forked child: one mitmproxy master on this process's own event loop
+    multiprocessing.current_process().name = f"worker-{slot}"
+    # Forget the supervisor's handlers; the worker installs its own on the proxy loop
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    enable_reuse_port()
+    from mitmproxy_integration import MitmProxyThread
+
+    capture = None
+    if config["capture_dir"]:
+        from capture import FlowCapture
+        capture = FlowCapture(config["capture_dir"], prefix=f"flows-w{slot}")
+    metrics_port = config["metrics_port"] + slot if config["metrics_port"] else None
+    # The memory log has a single writer, so each worker keeps its own
+    memory = None
+    if config["memory_dir"]:
+        from memory_store import ConversationMemory
+        memory = ConversationMemory(os.path.join(config["memory_dir"], f"worker-{slot}"))
+    response_cache = None
+    if config["response_cache_dir"]:
+        from response_cache import ResponseCache
+        response_cache = ResponseCache(os.path.join(config["response_cache_dir"], f"worker-{slot}"))
+    # Shards are memory-mapped, so workers that open the same tenant share its pages
+    tenants = tenant_resolver = None
+    if config["tenant_dir"]:
+        from tenants import ShardedIndex, TenantResolver, parse_port_map
+        tenants = ShardedIndex(config["tenant_dir"], rss_budget=config["tenant_rss_mb"] << 20)
+        tenant_resolver = TenantResolver(parse_port_map(config["tenant_ports"]))
+    # A conversation that moves to another worker just gets its context in full again
+    ledger = None
+    if config["delta_context"]:
+        from injection_ledger import InjectionLedger
+        ledger = InjectionLedger()
+    probe_budget = None
+    if config["nprobe"]:
+        from ivf_index import ProbeBudget
+        probe_budget = ProbeBudget(config["nprobe"], min_nprobe=config["min_nprobe"])
+
+    # The index is opened with numpy.memmap, so every worker reads the same page-cache pages
+    proxy = MitmProxyThread(
+        config["port"],
+        listen_host=config["host"],
+        allowed_hosts=config["allowed_hosts"],
+        index_path=config["index_dir"],
+        capture=capture,
+        metrics_port=metrics_port,
+        memory=memory,
+        response_cache=response_cache,
+        tenants=tenants,
+        tenant_resolver=tenant_resolver,
+        ledger=ledger,
+        probe_budget=probe_budget,
+        context_budget=config["context_budget"] or None,
+    )
+
+    draining = []
+
+    def drain():
+        if not draining:
+            draining.append(asyncio.ensure_future(proxy.drain(config["drain_timeout"]), loop=proxy.loop))
+
+    proxy.loop.add_signal_handler(signal.SIGTERM, drain)
+    proxy.loop.add_signal_handler(signal.SIGINT, drain)
+    logging.info(f"Worker {slot} (pid {os.getpid()}) serving {config['host']}:{config['port']}")
+    # Run the proxy on this process's main thread instead of starting the thread
+    proxy.run()
+    logging.info(f"Worker {slot} exited")
+
+
+class Supervisor:
+    """Forks `workers` proxy processes that share one listening address and keeps them alive.
+
+    A worker that dies while the supervisor is running is restarted in its slot,
+    with exponential backoff if it keeps dying right after start. SIGTERM/SIGINT
+    drain every worker (stop accepting, finish open connections) before exiting;
+    SIGHUP restarts workers one at a time, e.g. to pick up a rebuilt index.
+    """
+
+    def __init__(self, workers, config, min_uptime=5.0, max_backoff=30.0):
+        self.workers = workers
+        self.config = config
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+        self.mp = multiprocessing.get_context("fork")
+        self.procs = {}
+        self.started = {}
+        self.backoff = {}
+        # slot -> monotonic time its backed-off replacement is due
+        self.respawn_at = {}
+        self.stopping = False
+        self.reload_pending = False
+        self.restarts = 0
+
+    def spawn(self, slot):
+        proc = self.mp.Process(target=worker_main, args=(slot, self.config), name=f"worker-{slot}")
+        proc.start()
+        self.procs[slot] = proc
+        self.started[slot] = time.monotonic()
+
+    def run(self):
+        check_reuse_port(self.config["host"], self.config["port"])
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        for slot in range(self.workers):
+            self.spawn(slot)
+        logging.info(f"Supervising {self.workers} workers on {self.config['host']}:{self.config['port']}")
+
+        while not self.stopping:
+            if self.reload_pending:
+                self.reload_pending = False
+                self.rolling_restart()
+            now = time.monotonic()
+            for slot, due in list(self.respawn_at.items()):
+                if due <= now:
+                    del self.respawn_at[slot]
+                    self.restarts += 1
+                    self.spawn(slot)
+            # Wake for the next due respawn as well as for exits and signals
+            timeout = min([1.0] + [due - now for due in self.respawn_at.values()])
+            sentinels = {proc.sentinel: slot for slot, proc in self.procs.items()}
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=max(0.0, timeout)):
+                if self.stopping:
+                    break
+                self.restart(sentinels[sentinel])
+        self.shutdown()
+
+    def restart(self, slot):
+        proc = self.procs.pop(slot)
+        proc.join()
+        uptime = time.monotonic() - self.started[slot]
+        # Crash loops back off; a worker that ran for a while restarts immediately and resets its slot
+        if uptime < self.min_uptime:
+            delay = self.backoff[slot] = min(self.max_backoff, self.backoff.get(slot, 0.5) * 2)
+        else:
+            delay = 0.0
+            self.backoff.pop(slot, None)
+        logging.error(f"Worker {slot} (pid {proc.pid}) exited with {proc.exitcode} after {uptime:.1f}s, "
+                      f"restarting in {delay:.1f}s")
+        # Scheduled rather than slept, so signals and other slots' exits are handled meanwhile
+        self.respawn_at[slot] = time.monotonic() + delay
+
+    def rolling_restart(self):
+        logging.info("Rolling restart of all workers")
+        for slot in list(self.procs):
+            if self.stopping:
+                return
+            old = self.procs[slot]
+            # Start the replacement first so the port never goes without a listener
+            self.spawn(slot)
+            old.terminate()
+            old.join(self.config["drain_timeout"] + 5)
+            if old.is_alive():
+                old.kill()
+
+    def shutdown(self):
+        logging.info("Draining workers")
+        for proc in self.procs.values():
+            if proc.is_alive():
+                proc.terminate()
+        deadline = time.monotonic() + self.config["drain_timeout"] + 5
+        for proc in self.procs.values():
+            proc.join(max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                logging.warning(f"Killing worker pid {proc.pid} after drain timeout")
+                proc.kill()
+                proc.join()
+        logging.info(f"All workers stopped ({self.restarts} restarts)")
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reload_pending = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the injector without the Qt browser, one proxy process per core")
+    parser.add_argument("--host", default="127.0.0.1", help="Listen address (use 0.0.0.0 to serve other machines)")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--allowed-hosts", default=None, help="Comma-separated hosts to decrypt")
+    parser.add_argument("--index-dir", default=os.environ.get("RAG_INDEX_DIR"))
+    parser.add_argument("--capture-dir", default=os.environ.get("RAG_CAPTURE_DIR"))
+    parser.add_argument("--context-budget", type=int, default=1024, help="Max injected context tokens (0 = no limit)")
+    parser.add_argument("--memory-dir", default=os.environ.get("RAG_MEMORY_DIR"))
+    parser.add_argument("--response-cache-dir", default=os.environ.get("RAG_RESPONSE_CACHE_DIR"),
+                        help="Replay cached replies to repeated prompts (one cache per worker)")
+    parser.add_argument("--tenant-dir", default=os.environ.get("RAG_TENANT_DIR"),
+                        help="One index per tenant in <dir>/<tenant>/, opened on first use")
+    parser.add_argument("--tenant-rss-mb", type=int, default=1024, help="Mapped shard budget per worker")
+    parser.add_argument("--tenant-ports", default=os.environ.get("RAG_TENANT_PORTS"),
+                        help="Extra listen ports mapped to tenants, e.g. 8081=alice,8082=bob")
+    parser.add_argument("--no-delta-context", action="store_true",
+                        help="Inject the full context on every turn, not only chunks the conversation lacks")
+    parser.add_argument("--nprobe", type=int, default=None, help="IVF lists probed per request when idle")
+    parser.add_argument("--min-nprobe", type=int, default=1, help="IVF lists probed per request under load")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Worker i serves /metrics on this port + i")
+    parser.add_argument("--drain-timeout", type=float, default=10.0)
+    args = parser.parse_args()
+
+    Supervisor(args.workers, {
+        "host": args.host,
+        "port": args.port,
+        "allowed_hosts": args.allowed_hosts,
+        "index_dir": args.index_dir,
+        "capture_dir": args.capture_dir,
+        "memory_dir": args.memory_dir,
+        "response_cache_dir": args.response_cache_dir,
+        "tenant_dir": args.tenant_dir,
+        "tenant_rss_mb": args.tenant_rss_mb,
+        "tenant_ports": args.tenant_ports,
+        "context_budget": args.context_budget,
+        "delta_context": not args.no_delta_context,
+        "nprobe": args.nprobe,
+        "min_nprobe": args.min_nprobe,
+        "metrics_port": args.metrics_port,
+        "drain_timeout": args.drain_timeout,
+    }).run()
@@ -0,0 +1,116 @@
+# injection_ledger.py
+
+import collections
+
+REFERENCE_IDS = 6
+
+
+class InjectionPlan:
+    """What one turn injects: the chunks to send and those the conversation already has."""
+
+    __slots__ = ("conversation_id", "send", "repeated", "digests", "text", "bytes_saved")
+
+    def __init__(self, conversation_id, send, repeated, digests, text, bytes_saved=0):
+        self.conversation_id = conversation_id
+        self.send = send
+        self.repeated = repeated
+        self.digests = digests
+        self.text = text
+        self.bytes_saved = bytes_saved
+
+
+def reference_line(chunks):
+    ids = [str(chunk.id) for chunk in chunks[:REFERENCE_IDS]]
+    more = f" and {len(chunks) - len(ids)} more" if len(chunks) > len(ids) else ""
+    return f"(Context given earlier in this conversation still applies: {', '.join(ids)}{more}.)"
+
+
+class _Conversation:
+    __slots__ = ("turn", "chunks")
+
+    def __init__(self):
+        self.turn = 0
+        # chunk id -> (text digest, turn it was last sent on), oldest send first
+        self.chunks = collections.OrderedDict()
+
+
+class InjectionLedger:
+    """Which context chunks each conversation has already been sent.
+
+    ChatGPT keeps the history server-side, so a chunk injected on an earlier
+    turn is still in front of the model; later turns send only new chunks,
+    chunks whose text changed (re-ingested), and chunks last sent more than
+    `refresh_turns` turns ago, since long histories get trimmed. The rest are
+    named in a one-line reference. A plan is committed only once upstream has
+    accepted the turn, and under the conversation id it answered with, so a
+    failed request never hides context from the next one. At most
+    `max_conversations` (LRU) with `max_chunks` each are tracked.
+    """
+
+    def __init__(self, max_conversations=4096, max_chunks=128, refresh_turns=8):
+        self.max_conversations = max_conversations
+        self.max_chunks = max_chunks
+        self.refresh_turns = refresh_turns
+        self.conversations = collections.OrderedDict()
+        self.sent = 0
+        self.repeated = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.conversations)
+
+    def plan(self, conversation_id, packed, separator="\n"):
+        chunks = packed.chunks
+        digests = [hash(chunk.text) for chunk in chunks]
+        conversation = self.conversations.get(conversation_id) if conversation_id else None
+        send, repeated = [], []
+        if conversation is not None:
+            for chunk, digest in zip(chunks, digests):
+                entry = conversation.chunks.get(chunk.id)
+                if entry is not None and entry[0] == digest and conversation.turn - entry[1] < self.refresh_turns:
+                    repeated.append(chunk)
+                else:
+                    send.append(chunk)
+        digests = {chunk.id: digest for chunk, digest in zip(chunks, digests)}
+        if repeated:
+            text = separator.join([reference_line(repeated)] + [chunk.text for chunk in send])
+            saved = len(packed.text.encode("utf-8")) - len(text.encode("utf-8"))
+            # A reference longer than what it stands for isn't worth it; sending again also refreshes
+            if saved > 0:
+                self.sent += len(send)
+                self.repeated += len(repeated)
+                self.bytes_saved += saved
+                return InjectionPlan(conversation_id, send, repeated, digests, text, saved)
+        self.sent += len(chunks)
+        return InjectionPlan(conversation_id, list(chunks), [], digests, packed.text)
+
+    def commit(self, conversation_id, plan):
+        conversation_id = conversation_id or plan.conversation_id
+        if not conversation_id:
+            return
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            conversation = self.conversations[conversation_id] = _Conversation()
+            while len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.conversations.move_to_end(conversation_id)
+        conversation.turn += 1
+        for chunk in plan.send:
+            conversation.chunks[chunk.id] = (plan.digests[chunk.id], conversation.turn)
+            conversation.chunks.move_to_end(chunk.id)
+        while len(conversation.chunks) > self.max_chunks:
+            conversation.chunks.popitem(last=False)
+
+    def stats(self):
+        planned = self.sent + self.repeated
+        return {
+            "conversations": len(self.conversations),
+            "chunks_sent": self.sent,
+            "chunks_repeated": self.repeated,
+            "repeat_rate": self.repeated / planned if planned else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "evictions": self.evictions,
+        }
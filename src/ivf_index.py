@@ -0,0 +1,303 @@
+# ivf_index.py
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from vector_store import SEARCH_BLOCK, VectorStore, quantize, read_header
+
+IVF_ARRAYS = ("centroids", "offsets", "rows", "vectors", "scales")
+# k-means trains on at most this many sampled rows per list
+TRAIN_PER_LIST = 40
+# Rows hashed to tell whether an index still belongs to the store next to it
+FINGERPRINT_ROWS = 64
+
+
+def default_nlist(count):
+    # About 4 * sqrt(n) lists: ~4000 for a million rows, a few hundred rows each
+    return int(np.clip(4 * np.sqrt(max(count, 1)), 1, 65536))
+
+
+def assign_lists(vectors, centroids):
+    # Nearest centroid by dot product (vectors are unit length), a block of rows at a time
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), SEARCH_BLOCK):
+        block = np.asarray(vectors[start:start + SEARCH_BLOCK], dtype=np.float32)
+        lists[start:start + len(block)] = (block @ centroids.T).argmax(axis=1)
+    return lists
+
+
+def train_centroids(sample, nlist, iterations=10, seed=0):
+    """Spherical k-means: `nlist` unit-length centroids for the rows of `sample`.
+
+    Each iteration is one vectorized assignment and one sort-and-reduce update;
+    a list that ends up empty is reseeded with a random sample row.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        lists = assign_lists(sample, centroids)
+        order = np.argsort(lists, kind="stable")
+        counts = np.bincount(lists, minlength=nlist)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts[filled])[:-1]])
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids[filled] = sums / norms
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+    return centroids
+
+
+def _rows(store, rows):
+    vectors = np.asarray(store.vectors[rows], dtype=np.float32)
+    if store.scales is not None:
+        vectors *= store.scales[rows, None]
+    return vectors
+
+
+def fingerprint(store, rows):
+    return hashlib.blake2b(np.ascontiguousarray(store.vectors[:rows]).tobytes(), digest_size=16).hexdigest()
+
+
+def stale_build(path, max_tail=0.1):
+    """Settings of the IVF build in `path` when it has gone stale, else None.
+
+    Stale means rows added or deleted since the build exceed `max_tail` of the
+    rows it indexed; every query scans those exactly or masks them.
+    """
+    path = Path(path)
+    try:
+        with open(path / "ivf.json") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    header = read_header(path)
+    changed = header["count"] - meta["store_count"] + len(set(header.get("deleted", ())) - set(meta["deleted"]))
+    if changed > max_tail * max(meta["store_count"] - len(meta["deleted"]), 1):
+        return {name: meta[name] for name in ("nlist", "nprobe", "dtype")}
+    return None
+
+
+class IVFIndex:
+    """Inverted-file index over a VectorStore, stored next to it with the same row numbers.
+
+    Rows are clustered around k-means centroids, and each list's vectors are
+    copied contiguously into `vectors`, with `rows` mapping them back: list l
+    is `vectors[offsets[l]:offsets[l + 1]]`. The copy is int8 with per-row
+    scales by default, as numpy widens int8 several times faster than float16
+    and it is half the size of a float16 store. A search scores
+    the centroids, then only the `nprobe` nearest lists, read straight from the
+    memory map. Rows appended to the store after the build are scanned exactly
+    and rows deleted since are masked, so the index stays correct between
+    rebuilds; it only gets slower as that tail grows.
+
+    The arrays of one build share a generation in their file names, and
+    `ivf.json` naming it is written last, so a rebuild never changes a file an
+    open index has mapped.
+    """
+
+    def __init__(self, store, meta, arrays):
+        self.store = store
+        self.meta = meta
+        self.nlist = meta["nlist"]
+        self.nprobe = meta["nprobe"]
+        self.indexed_count = meta["store_count"]
+        for name in IVF_ARRAYS:
+            setattr(self, name, arrays.get(name))
+        # Deletions since the build are the only rows in the lists that must be skipped
+        self.deleted_since = np.setdiff1d(store.deleted, np.asarray(meta["deleted"], dtype=np.int64))
+
+    @classmethod
+    def attach(cls, store):
+        # The index for an open store, or None when there is none or it belongs to another build
+        path = Path(store.path)
+        try:
+            with open(path / "ivf.json") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta["dim"] != store.dim or meta["store_count"] > store.count or \
+                fingerprint(store, min(meta["store_count"], FINGERPRINT_ROWS)) != meta["fingerprint"]:
+            logging.warning(f"Ignoring IVF index in {path}: built for a different store, rebuild it")
+            return None
+        arrays = {name: np.load(path / f"ivf-{meta['generation']}_{name}.npy", mmap_mode="r")
+                  for name in IVF_ARRAYS if (path / f"ivf-{meta['generation']}_{name}.npy").exists()}
+        # The centroids are read on every query; keep them in RAM as float32
+        arrays["centroids"] = np.array(arrays["centroids"], dtype=np.float32)
+        return cls(store, meta, arrays)
+
+    @classmethod
+    def build(cls, path, nlist=None, nprobe=None, iterations=10, dtype="int8", seed=0):
+        path = Path(path)
+        start = time.perf_counter()
+        store = VectorStore.open(path)
+        live = np.setdiff1d(np.arange(store.count, dtype=np.int64), store.deleted)
+        if not len(live):
+            raise ValueError(f"No rows to index in {path}")
+        nlist = min(nlist or default_nlist(len(live)), len(live))
+        nprobe = min(nprobe or max(1, nlist // 32), nlist)
+
+        rng = np.random.default_rng(seed)
+        train = live if len(live) <= nlist * TRAIN_PER_LIST else \
+            np.sort(rng.choice(live, nlist * TRAIN_PER_LIST, replace=False))
+        sample = _rows(store, train)
+        # Row scales of an int8 store would weight the means; only directions matter here
+        sample /= np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+        centroids = train_centroids(sample, nlist, iterations, seed)
+        trained = time.perf_counter()
+
+        lists = np.empty(len(live), dtype=np.int32)
+        for i in range(0, len(live), SEARCH_BLOCK):
+            lists[i:i + SEARCH_BLOCK] = assign_lists(store.vectors[live[i:i + SEARCH_BLOCK]], centroids)
+        order = np.argsort(lists, kind="stable")
+        rows = live[order]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=nlist))]).astype(np.int64)
+
+        generation = f"{time.time_ns():x}"
+        arrays = {"centroids": centroids, "offsets": offsets, "rows": rows}
+        for name, array in arrays.items():
+            np.save(path / f"ivf-{generation}_{name}.npy", array)
+        # Written through a memory map a block at a time, so the copy never has to fit in RAM
+        vectors = np.lib.format.open_memmap(path / f"ivf-{generation}_vectors.npy", mode="w+",
+                                            dtype=dtype, shape=(len(rows), store.dim))
+        scales = None
+        if dtype == "int8":
+            scales = np.lib.format.open_memmap(path / f"ivf-{generation}_scales.npy", mode="w+",
+                                               dtype=np.float32, shape=(len(rows),))
+        for i in range(0, len(rows), SEARCH_BLOCK):
+            block = _rows(store, rows[i:i + SEARCH_BLOCK])
+            if dtype == "float32":
+                vectors[i:i + len(block)] = block
+            else:
+                vectors[i:i + len(block)], block_scales = quantize(block, dtype)
+                if scales is not None:
+                    scales[i:i + len(block)] = block_scales
+        vectors.flush()
+        del vectors
+        if scales is not None:
+            scales.flush()
+            del scales
+
+        meta = {
+            "generation": generation,
+            "nlist": nlist,
+            "nprobe": nprobe,
+            "dim": store.dim,
+            "dtype": dtype,
+            "store_count": store.count,
+            "deleted": store.deleted.tolist(),
+            "fingerprint": fingerprint(store, min(store.count, FINGERPRINT_ROWS)),
+        }
+        tmp = path / "ivf.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path / "ivf.json")
+        # Unlinking is safe for a process that still has the previous build mapped
+        for old in path.glob("ivf-*_*.npy"):
+            if not old.name.startswith(f"ivf-{generation}_"):
+                old.unlink()
+        sizes = np.diff(offsets)
+        logging.info(f"Built IVF index: {nlist} lists over {len(rows)} rows (largest {sizes.max()}, "
+                     f"nprobe {nprobe}) in {time.perf_counter() - start:.2f}s "
+                     f"({trained - start:.2f}s training)")
+        store.close()
+        return meta
+
+    def _probe(self, query, lists):
+        # Rows of the probed lists, read in file order
+        lists = np.sort(lists)
+        starts = self.offsets[lists]
+        lengths = self.offsets[lists + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        # Positions of every probed row: each list's start, then a running count within it
+        index = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(total)
+        scores = np.asarray(self.vectors[index], dtype=np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales[index]
+        rows = np.asarray(self.rows[index])
+        if len(self.deleted_since):
+            scores[np.isin(rows, self.deleted_since)] = -np.inf
+        return rows, scores
+
+    def search(self, queries, k=5, nprobe=None):
+        """Approximate top-k rows per query vector, as (rows, scores) like VectorStore.search."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(max(1, nprobe or self.nprobe), self.nlist)
+        coarse = queries @ self.centroids.T
+        if nprobe < self.nlist:
+            probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(self.nlist), coarse.shape)
+        tail = None
+        if self.store.count > self.indexed_count:
+            tail = self.store.search_exact(queries, k, first_row=self.indexed_count)
+
+        results = []
+        for q, (query, lists) in enumerate(zip(queries, probes)):
+            rows, scores = self._probe(query, lists)
+            if tail is not None:
+                rows = np.concatenate([rows, tail[q][0]])
+                scores = np.concatenate([scores, tail[q][1]])
+            if len(scores) > k:
+                keep = np.argpartition(-scores, k - 1)[:k]
+                rows, scores = rows[keep], scores[keep]
+            order = np.argsort(-scores)
+            order = order[np.isfinite(scores[order])]
+            results.append((rows[order], scores[order]))
+        return results
+
+
+class ProbeBudget:
+    """Picks nprobe per request from how busy retrieval is.
+
+    Idle, every request probes `nprobe` lists; as in-flight retrievals approach
+    `busy`, the count falls linearly to `min_nprobe`, trading recall for
+    latency while the proxy is under load. `reduced` counts the searches that
+    were actually narrowed, as reported by the caller through `narrowed()`;
+    picking a smaller nprobe means nothing if no provider has an IVF index.
+    """
+
+    def __init__(self, nprobe, min_nprobe=1, busy=8):
+        self.nprobe = nprobe
+        self.min_nprobe = min(min_nprobe, nprobe)
+        self.busy = max(busy, 1)
+        self.reduced = 0
+
+    def pick(self, in_flight):
+        if in_flight <= 0:
+            return self.nprobe
+        load = min(in_flight / self.busy, 1.0)
+        return max(self.min_nprobe, round(self.nprobe - (self.nprobe - self.min_nprobe) * load))
+
+    def narrowed(self, query):
+        # Whether a provider searched an IVF index with fewer lists than when idle
+        if query.nprobe_applied and query.nprobe is not None and query.nprobe < self.nprobe:
+            self.reduced += 1
+            return True
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an IVF index next to a local RAG index")
+    parser.add_argument("index_dir")
+    parser.add_argument("--nlist", type=int, default=None, help="Number of lists (default about 4 * sqrt(rows))")
+    parser.add_argument("--nprobe", type=int, default=None, help="Lists probed per query by default (nlist / 32)")
+    parser.add_argument("--iterations", type=int, default=10, help="k-means iterations")
+    parser.add_argument("--dtype", choices=["int8", "float16", "float32"], default="int8",
+                        help="Precision of the per-list vector copy")
+    args = parser.parse_args()
+
+    IVFIndex.build(args.index_dir, args.nlist, args.nprobe, args.iterations, args.dtype)
@@ -2,44 +2,187 @@
 
 import sys
 import os
-import time
-from PySide6.QtWidgets import QApplication
-from ui import MainWindow
-from mitmproxy_integration import MitmProxyThread
 import socket
+from concurrent.futures import ThreadPoolExecutor
+from startup import StartupTimer
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def start_proxy(timer, proxy_port, index_path, templates_path):
+    # Runs on a worker thread while the main thread brings up Qt
+    with timer.phase("import proxy"):
+        from mitmproxy_integration import MitmProxyThread
+
+    # Intercepted flows recorded to rotating JSONL off the proxy loop; off unless RAG_CAPTURE_DIR is set
+    capture = None
+    if os.environ.get("RAG_CAPTURE_DIR"):
+        from capture import FlowCapture
+        capture = FlowCapture(
+            os.environ["RAG_CAPTURE_DIR"],
+            compression=os.environ.get("RAG_CAPTURE_COMPRESSION") or None,
+            sample_rate=float(os.environ.get("RAG_CAPTURE_SAMPLE", "1.0")),
+        )
+    # Prometheus metrics and the profiler toggle on localhost, on a free port unless RAG_METRICS_PORT
+    # names one; RAG_METRICS_PORT="" turns it off
+    metrics_port = os.environ.get("RAG_METRICS_PORT", "0")
+
+    # Conversation history recalled into prompts; off unless RAG_MEMORY_DIR is set
+    memory = None
+    if os.environ.get("RAG_MEMORY_DIR"):
+        from memory_store import ConversationMemory
+        with timer.phase("load memory"):
+            memory = ConversationMemory(
+                os.environ["RAG_MEMORY_DIR"],
+                recall_turns=int(os.environ.get("RAG_MEMORY_TURNS", "4")),
+                recall_cross_session=int(os.environ.get("RAG_MEMORY_CROSS_SESSION", "2")),
+            )
+
+    # Replies to repeated prompts served from disk; off unless RAG_RESPONSE_CACHE_DIR is set
+    response_cache = None
+    if os.environ.get("RAG_RESPONSE_CACHE_DIR"):
+        from response_cache import ResponseCache
+        response_cache = ResponseCache(os.environ["RAG_RESPONSE_CACHE_DIR"],
+                                       max_bytes=int(os.environ.get("RAG_RESPONSE_CACHE_MB", "256")) << 20)
+
+    # One index per tenant under RAG_TENANT_DIR/<tenant>/, opened on first use
+    tenants = tenant_resolver = None
+    if os.environ.get("RAG_TENANT_DIR"):
+        from tenants import ShardedIndex, TenantResolver, parse_port_map
+        tenants = ShardedIndex(os.environ["RAG_TENANT_DIR"],
+                               rss_budget=int(os.environ.get("RAG_TENANT_RSS_MB", "1024")) << 20)
+        tenant_resolver = TenantResolver(parse_port_map(os.environ.get("RAG_TENANT_PORTS")))
+
+    # Embedding and ranking in worker processes; RAG_OFFLOAD_WORKERS=0 (default) keeps them on the proxy loop
+    offload = None
+    offload_workers = int(os.environ.get("RAG_OFFLOAD_WORKERS", "0"))
+    if offload_workers and os.path.exists(os.path.join(index_path, "index.json")):
+        from offload import OffloadPool
+        with timer.phase("warm workers"):
+            offload = OffloadPool(index_path, workers=offload_workers)
+            offload.start()
+
+    # Injection templates, compiled once here and again by the watcher whenever the file changes
+    templates = None
+    if os.path.exists(templates_path):
+        from templates import TemplateSet
+        templates = TemplateSet.load(templates_path)
+
+    # Later turns of a conversation skip chunks it was already sent; RAG_DELTA_CONTEXT=0 resends everything
+    ledger = None
+    if os.environ.get("RAG_DELTA_CONTEXT", "1") != "0":
+        from injection_ledger import InjectionLedger
+        ledger = InjectionLedger(refresh_turns=int(os.environ.get("RAG_DELTA_REFRESH_TURNS", "8")))
+
+    # IVF lists probed per request, cut towards RAG_IVF_MIN_NPROBE while retrieval is busy
+    probe_budget = None
+    if os.environ.get("RAG_IVF_NPROBE"):
+        from ivf_index import ProbeBudget
+        probe_budget = ProbeBudget(int(os.environ["RAG_IVF_NPROBE"]),
+                                   min_nprobe=int(os.environ.get("RAG_IVF_MIN_NPROBE", "1")))
+
+    with timer.phase("load index"):
+        proxy_thread = MitmProxyThread(proxy_port, index_path=index_path, capture=capture,
+                                       metrics_port=int(metrics_port) if metrics_port else None,
+                                       memory=memory,
+                                       response_cache=response_cache,
+                                       tenants=tenants, tenant_resolver=tenant_resolver,
+                                       prefetch=os.environ.get("RAG_PREFETCH", "1") != "0",
+                                       prefetch_tenant=os.environ.get("RAG_TENANT"),
+                                       offload=offload,
+                                       templates=templates,
+                                       ledger=ledger,
+                                       probe_budget=probe_budget,
+                                       replay_speed=float(os.environ.get("RAG_REPLAY_SPEED", "1.0")),
+                                       context_budget=int(os.environ.get("RAG_CONTEXT_BUDGET", "1024")) or None)
+    with timer.phase("proxy listen"):
+        proxy_thread.start()
+        proxy_thread.wait_ready(timeout=30)
+    timer.mark("proxy listening")
+    return proxy_thread
+
 
 if __name__ == "__main__":
-    
-    def find_free_port():
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('', 0))
-            return s.getsockname()[1]
+    timer = StartupTimer()
 
     proxy_port = find_free_port()
     cdp_port = find_free_port()
-    
+
     print(f"Starting proxy on port: {proxy_port}")
     print(f"Chrome DevTools on port: {cdp_port}")
-    
+
     os.environ["QTWEBENGINE_REMOTE_DEBUGGING"] = str(cdp_port)
     os.environ["QTWEBENGINE_CHROMIUM_FLAGS"] = f"--proxy-server=127.0.0.1:{str(proxy_port)} --ignore-certificate-errors"
 
-    app = QApplication(sys.argv)
+    # Start the mitmproxy thread (build an index with: python vector_store.py build <docs> rag_index)
+    index_path = os.environ.get("RAG_INDEX_DIR", os.path.join(SRC_DIR, "rag_index"))
+    startup = ThreadPoolExecutor(max_workers=1, thread_name_prefix="startup")
+    templates_path = os.environ.get("RAG_TEMPLATES", os.path.join(SRC_DIR, "templates.json"))
+    proxy_future = startup.submit(start_proxy, timer, proxy_port, index_path, templates_path)
+
+    with timer.phase("qt init"):
+        from PySide6.QtWidgets import QApplication
+        app = QApplication(sys.argv)
+    with timer.phase("import ui"):
+        from ui import MainWindow
 
-    # Start the mitmproxy thread
-    proxy_thread = MitmProxyThread(proxy_port)
-    proxy_thread.start()
+    # Open the window as soon as the proxy is listening, not after a fixed sleep
+    with timer.phase("wait for proxy"):
+        proxy_thread = proxy_future.result()
+    startup.shutdown()
 
-    # Wait for the proxy server to start
-    print("Waiting for proxy to start...")
-    time.sleep(5)
-    print("Proxy should be ready!")
+    # Optionally keep the index in sync with a folder of documents
+    ingest_daemon = None
+    if os.environ.get("RAG_WATCH_DIR"):
+        from ingest import IngestDaemon
+        ingest_daemon = IngestDaemon(os.environ["RAG_WATCH_DIR"], index_path, on_publish=proxy_thread.publish_store)
+        ingest_daemon.start()
 
-    window = MainWindow()
-    window.showMaximized()
+    with timer.phase("create window"):
+        window = MainWindow(tenant=os.environ.get("RAG_TENANT"),
+                            tag_tenant=bool(os.environ.get("RAG_TENANT_DIR")),
+                            freeze_after=float(os.environ.get("RAG_TAB_FREEZE_AFTER", "300")),
+                            memory_budget_mb=int(os.environ.get("RAG_TAB_MEMORY_MB", "2048")))
+        window.showMaximized()
+
+    # The report goes out once the first tab has loaded, the point where the app is usable
+    first_page = window.current_browser()
+
+    def page_loaded(ok):
+        first_page.loadFinished.disconnect(page_loaded)
+        timer.mark("page loaded" if ok else "page load failed")
+        timer.report()
+
+    first_page.loadFinished.connect(page_loaded)
+
+    template_watcher = None
+    if os.path.exists(templates_path):
+        from templates import TemplateWatcher
+        template_watcher = TemplateWatcher(templates_path, on_publish=proxy_thread.publish_templates)
+        template_watcher.start()
+
+    # Start retrieval from the composer draft over the DevTools port; RAG_PREFETCH=0 turns it off
+    prefetcher = None
+    if proxy_thread.prefetch_enabled:
+        from prefetch import CdpPrefetcher
+        prefetcher = CdpPrefetcher(cdp_port, proxy_thread.prefetch)
+        prefetcher.start()
 
     app.exec()
 
+    if prefetcher is not None:
+        prefetcher.stop()
+    if template_watcher is not None:
+        template_watcher.stop()
+    if ingest_daemon is not None:
+        ingest_daemon.stop()
+
     # Shutdown the mitmproxy thread
     proxy_thread.shutdown()
-    proxy_thread.join()
\ No newline at end of file
+    proxy_thread.join()
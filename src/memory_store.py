@@ -0,0 +1,202 @@
+# memory_store.py
+
+import collections
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+
+# Records are written with the conversation id first, so reopening needn't decode whole lines
+_CONVERSATION_RE = re.compile(rb'\{"c": ("(?:[^"\\]|\\.)*")')
+
+
+class Turn:
+    __slots__ = ("conversation_id", "message_id", "role", "text", "ts")
+
+    def __init__(self, conversation_id, message_id, role, text, ts):
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.role = role
+        self.text = text
+        self.ts = ts
+
+    def __repr__(self):
+        return f"Turn({self.conversation_id!r}, {self.role!r}, {self.text[:40]!r})"
+
+
+class ConversationMemory:
+    """Turns of every intercepted conversation, in an append-only log.
+
+    Each record is one JSON line carrying the offset of the previous turn of the
+    same conversation, and an in-memory index maps a conversation id to its last
+    record. The last `tail_turns` turns of the `max_hot` most recently used
+    conversations are kept in memory (LRU), which is all the request path reads;
+    a cold conversation costs one pread per turn to bring back. RAM is bounded by
+    the hot set plus a few dozen bytes of index per conversation.
+    """
+
+    def __init__(self, directory, max_hot=256, tail_turns=16, recent_size=64, max_text_chars=2000,
+                 recall_turns=4, recall_cross_session=2):
+        self.path = Path(directory) / "memory.log"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_hot = max_hot
+        self.tail_turns = tail_turns
+        self.max_text_chars = max_text_chars
+        self.recall_turns = recall_turns
+        self.recall_cross_session = recall_cross_session
+        # conversation_id -> (offset of its last record, number of turns)
+        self.index = {}
+        self.hot = collections.OrderedDict()
+        # Latest turns across all conversations, for cross-session recall
+        self.recent = collections.deque(maxlen=recent_size)
+        self.appended = 0
+        self.disk_loads = 0
+        self.evictions = 0
+        self.path.touch(exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDONLY)
+        self._size = self._scan()
+        self._load_recent()
+        self._file = open(self.path, "ab")
+
+    def _scan(self):
+        # Rebuild the index from the log; a torn last line from a crash is cut off
+        size = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                m = _CONVERSATION_RE.match(line)
+                if m is None or not line.endswith(b"\n"):
+                    break
+                conversation_id = json.loads(m.group(1))
+                _, count = self.index.get(conversation_id, (-1, 0))
+                self.index[conversation_id] = (size, count + 1)
+                size += len(line)
+        if size != self.path.stat().st_size:
+            logging.warning(f"Truncating torn record at offset {size} of {self.path}")
+            os.truncate(self.path, size)
+        logging.info(f"Conversation memory: {len(self.index)} conversations in {self.path}")
+        return size
+
+    def _load_recent(self):
+        # Only the tail of the log feeds cross-session recall; records are at most ~4 bytes per char
+        start = max(0, self._size - self.recent.maxlen * (4 * self.max_text_chars + 256))
+        data = os.pread(self._fd, self._size - start, start)
+        lines = data.split(b"\n")[1 if start else 0:-1]
+        for line in lines[-self.recent.maxlen:]:
+            self.recent.append(self._turn(json.loads(line)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, conversation_id, role, text, message_id=None, ts=None):
+        if not conversation_id or not text:
+            return None
+        if len(text) > self.max_text_chars:
+            text = text[:self.max_text_chars]
+        tail = self._tail(conversation_id)
+        prev, count = self.index.get(conversation_id, (-1, 0))
+        turn = Turn(conversation_id, message_id, role, text, ts or time.time())
+        data = json.dumps({
+            "c": conversation_id, "m": message_id, "r": role, "t": text, "ts": turn.ts, "prev": prev,
+        }, ensure_ascii=False).encode("utf-8") + b"\n"
+        offset = self._size
+        # One small write; the log is never read through this handle, so no fsync
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        self.index[conversation_id] = (offset, count + 1)
+        tail.append(turn)
+        self.recent.append(turn)
+        self.appended += 1
+        return turn
+
+    def last_turns(self, conversation_id, n=None):
+        n = self.tail_turns if n is None else min(n, self.tail_turns)
+        if n <= 0 or conversation_id not in self.index:
+            return []
+        tail = self._tail(conversation_id)
+        return list(tail)[-n:]
+
+    def cross_session(self, conversation_id, n=None):
+        # Most recent turns from any other conversation, oldest first
+        n = self.recall_cross_session if n is None else n
+        turns = []
+        for turn in reversed(self.recent):
+            if len(turns) >= n:
+                break
+            if turn.conversation_id != conversation_id:
+                turns.append(turn)
+        turns.reverse()
+        return turns
+
+    def recall(self, conversation_id, cross_session=True):
+        others = self.cross_session(conversation_id) if cross_session else []
+        return self.last_turns(conversation_id, self.recall_turns), others
+
+    def _tail(self, conversation_id):
+        tail = self.hot.get(conversation_id)
+        if tail is not None:
+            self.hot.move_to_end(conversation_id)
+            return tail
+        tail = collections.deque(self._read_chain(conversation_id), maxlen=self.tail_turns)
+        self.hot[conversation_id] = tail
+        while len(self.hot) > self.max_hot:
+            self.hot.popitem(last=False)
+            self.evictions += 1
+        return tail
+
+    def _read_chain(self, conversation_id):
+        # Walk prev offsets back from the last record; nothing else in the log is touched
+        offset, _ = self.index.get(conversation_id, (-1, 0))
+        if offset < 0:
+            return []
+        self.disk_loads += 1
+        turns = []
+        while offset >= 0 and len(turns) < self.tail_turns:
+            record = json.loads(self._read_line(offset))
+            turns.append(self._turn(record))
+            offset = record["prev"]
+        turns.reverse()
+        return turns
+
+    def _read_line(self, offset):
+        chunk = os.pread(self._fd, 4096, offset)
+        end = chunk.find(b"\n")
+        while end < 0:
+            more = os.pread(self._fd, 65536, offset + len(chunk))
+            if not more:
+                raise ValueError(f"Unterminated memory record at offset {offset}")
+            pos = len(chunk)
+            chunk += more
+            end = chunk.find(b"\n", pos)
+        return chunk[:end]
+
+    @staticmethod
+    def _turn(record):
+        return Turn(record["c"], record.get("m"), record["r"], record["t"], record["ts"])
+
+    def stats(self):
+        return {
+            "conversations": len(self.index),
+            "hot": len(self.hot),
+            "appended": self.appended,
+            "disk_loads": self.disk_loads,
+            "evictions": self.evictions,
+            "log_bytes": self._size,
+        }
+
+    def close(self):
+        self._file.close()
+        os.close(self._fd)
+
+
+def format_memory(turns, others):
+    lines = []
+    if turns:
+        lines.append("Earlier in this conversation:")
+        lines.extend(f"{turn.role.capitalize()}: {turn.text}" for turn in turns)
+    if others:
+        lines.append("From other conversations:")
+        lines.extend(f"{turn.role.capitalize()}: {turn.text}" for turn in others)
+    return "\n".join(lines)
@@ -0,0 +1,264 @@
+# metrics.py
+
+import asyncio
+import bisect
+import io
+import logging
+import pstats
+import time
+from urllib.parse import parse_qs, urlsplit
+
+# Seconds; spans sub-millisecond hook work up to multi-second streams
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Histogram:
+    """One histogram series. `observe` is a bisect and two adds, cheap enough for every flow."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _Family:
+    def __init__(self, name, help, kind, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.series = {}
+
+    def labels(self, *values):
+        # Callers on the hot path keep the returned child instead of looking it up per flow
+        child = self.series.get(values)
+        if child is None:
+            child = self.series[values] = self.factory()
+        return child
+
+
+class MetricsRegistry:
+    """Counters, histograms and callback gauges rendered in Prometheus text format.
+
+    Everything is updated from the proxy loop's thread, so there is no locking.
+    """
+
+    def __init__(self):
+        self.families = []
+        self.gauges = []
+
+    def counter(self, name, help, labelnames=()):
+        family = _Family(name, help, "counter", labelnames, Counter)
+        self.families.append(family)
+        return family if labelnames else family.labels()
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        family = _Family(name, help, "histogram", labelnames, lambda: Histogram(buckets))
+        self.families.append(family)
+        return family if labelnames else family.labels()
+
+    def gauge(self, name, help, func, kind="gauge"):
+        # Sampled only when scraped, e.g. queue depth, or a counter some other object already keeps
+        self.gauges.append((name, help, func, kind))
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, child in family.series.items():
+                labels = list(zip(family.labelnames, values))
+                if family.kind == "counter":
+                    lines.append(f"{family.name}{_labels(labels)} {child.value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(child.buckets + (float("inf"),), child.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{family.name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+                lines.append(f"{family.name}_sum{_labels(labels)} {child.sum}")
+                lines.append(f"{family.name}_count{_labels(labels)} {child.count}")
+        for name, help, func, kind in self.gauges:
+            try:
+                value = func()
+            except Exception as e:
+                logging.warning(f"Gauge {name} failed: {e}")
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Profiler:
+    """Start/stop profiling of the proxy loop at runtime.
+
+    cProfile follows only the thread that enabled it, which is the loop thread
+    when driven from the metrics endpoint. yappi, if installed, samples every
+    thread (provider workers, the capture writer) at the cost of more overhead.
+    """
+
+    def __init__(self):
+        self.engine = None
+        self.profile = None
+        self.started = None
+
+    def start(self, engine="cprofile"):
+        if self.engine is not None:
+            return f"Already profiling with {self.engine}\n"
+        if engine == "yappi":
+            import yappi
+            yappi.set_clock_type("cpu")
+            yappi.start()
+        elif engine == "cprofile":
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            raise ValueError(f"Unknown profiler: {engine}")
+        self.engine = engine
+        self.started = time.monotonic()
+        logging.info(f"Profiling started ({engine})")
+        return f"Profiling started ({engine})\n"
+
+    def stop(self, limit=40, sort="cumulative"):
+        if self.engine is None:
+            return "Not profiling\n"
+        out = io.StringIO()
+        out.write(f"{self.engine} profile over {time.monotonic() - self.started:.1f}s\n")
+        if self.engine == "yappi":
+            import yappi
+            yappi.stop()
+            stats = yappi.convert2pstats(yappi.get_func_stats())
+            yappi.clear_stats()
+            stats.stream = out
+        else:
+            self.profile.disable()
+            stats = pstats.Stats(self.profile, stream=out)
+            self.profile = None
+        stats.sort_stats(sort).print_stats(limit)
+        self.engine = None
+        logging.info("Profiling stopped")
+        return out.getvalue()
+
+
+class MetricsServer:
+    """Minimal HTTP endpoint on the proxy loop.
+
+    GET  /metrics                          Prometheus text format
+    POST /profile/start?engine=cprofile    start profiling (or engine=yappi)
+    POST /profile/stop?limit=40            stop and return the top functions
+
+    The profiler changes state, so it takes POST only, and any request a browser
+    sends with an Origin header is refused: a page in the embedded browser can
+    still fire a cross-origin POST at localhost, it just cannot hide where from.
+    """
+
+    ROUTES = {"/metrics": "GET", "/profile/start": "POST", "/profile/stop": "POST"}
+
+    def __init__(self, registry, host="127.0.0.1", port=9464, profiler=None):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.profiler = profiler or Profiler()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f"Metrics at http://{self.host}:{self.port}/metrics")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5.0)
+            headers = set()
+            while (line := await asyncio.wait_for(reader.readline(), 5.0)) not in (b"\r\n", b"\n", b""):
+                headers.add(line.split(b":", 1)[0].strip().lower())
+            parts = request_line.decode("latin-1").split()
+            url = urlsplit(parts[1]) if len(parts) >= 2 else None
+            if url is None or url.path not in self.ROUTES:
+                status, body = "404 Not Found", "Not found\n"
+            elif b"origin" in headers:
+                status, body = "403 Forbidden", "Cross-origin requests are not allowed\n"
+            elif parts[0] != self.ROUTES[url.path]:
+                status, body = "405 Method Not Allowed", f"{self.ROUTES[url.path]} only\n"
+            else:
+                status, body = self._route(url)
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+            payload = body.encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1") + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, url):
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            if url.path == "/metrics":
+                return "200 OK", self.registry.render()
+            if url.path == "/profile/start":
+                return "200 OK", self.profiler.start(query.get("engine", "cprofile"))
+            if url.path == "/profile/stop":
+                return "200 OK", self.profiler.stop(int(query.get("limit", 40)), query.get("sort", "cumulative"))
+        except (ImportError, ValueError) as e:
+            return "400 Bad Request", f"{e}\n"
+        return "404 Not Found", "Not found\n"
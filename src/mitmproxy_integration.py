@@ -2,121 +2,705 @@
 
 import threading
 import asyncio
+import collections
 import logging
 import json
-from mitmproxy import options
+import time
+from pathlib import Path
+from mitmproxy import options, ctx
 from mitmproxy.tools.dump import DumpMaster
-import re
+from sse_stream import SSEParser, ConversationStreamAssembler, ConversationStreamTap
+from routes import DEFAULT_ALLOWED_HOSTS, compile_routes
+from context_providers import ContextPipeline, ContextQuery, StaticProvider
+from retrieval_cache import RetrievalCache, prompt_key
+from rewrite import PromptRewrite
+from metrics import MetricsRegistry, MetricsServer
+from memory_store import format_memory
+from context_packer import ContextPacker, DEFAULT_BUDGET
+from tenants import TENANT_HEADER, TenantProvider, TenantResolver, valid_tenant
+from templates import TemplateSet
+from response_cache import MODEL_FIELDS, REPLAY_HEADER, CachedResponse, ReplayServer, StreamRecorder, response_key
 
 logging.basicConfig(level=logging.INFO)
 
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+BYTE_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+# Finished prefetches waiting for their prompt to be sent
+PREFETCH_KEEP = 256
+
 class MitmProxyThread(threading.Thread):
-    def __init__(self, port):
+    def __init__(self, port, stream_responses=True, allowed_hosts=None, providers=None, index_path=None, capture=None, routes=None, metrics_port=None, listen_host='127.0.0.1', memory=None, context_budget=DEFAULT_BUDGET, response_cache=None, replay_speed=1.0, tenants=None, tenant_resolver=None, prefetch=False, prefetch_tenant=None, offload=None, templates=None, ledger=None, probe_budget=None):
         super().__init__()
         self.opts = options.Options(
-            listen_host='127.0.0.1',
+            listen_host=listen_host,
             listen_port=port,
             ssl_insecure=True 
         )
+        # Multi-tenant: one index shard per tenant, picked per flow
+        self.tenants = tenants
+        self.tenant_resolver = tenant_resolver or (TenantResolver() if tenants is not None else None)
+        if self.tenant_resolver is not None and self.tenant_resolver.port_map:
+            # Extra listen ports, each mapped to a tenant
+            self.opts.update(mode=["regular"] + [f"regular@{p}" for p in sorted(self.tenant_resolver.port_map)])
+        if providers is None and tenants is not None:
+            providers = [TenantProvider(tenants)]
+        # Embedding and ranking in worker processes, off this loop and the GIL
+        self.offload = offload
+        if providers is None and offload is not None:
+            from offload import OffloadProvider
+            providers = [OffloadProvider(offload)]
+        self.stream_responses = stream_responses
+        self.allowed_hosts = allowed_hosts
+        self.routes = routes
+        self.pipeline = ContextPipeline(providers or default_providers(index_path))
+        self.cache = RetrievalCache()
+        self.packer = ContextPacker(context_budget)
+        self.capture = capture
+        self.memory = memory
+        # Opt-in: repeated prompts are answered from disk by a local replay server
+        self.response_cache = response_cache
+        self.replay_server = ReplayServer(response_cache, speed=replay_speed) if response_cache is not None else None
+        # Injection templates; replaced wholesale by publish_templates
+        self.templates = templates or TemplateSet.builtin()
+        # Retrieval started from drafts in the composer, before the prompt is sent
+        self.prefetch_enabled = prefetch
+        # Drafts come from this browser's profile; resolved once, as the resolver will
+        # resolve the header that profile sends
+        if self.tenant_resolver is None:
+            prefetch_tenant = None
+        elif not valid_tenant(prefetch_tenant):
+            prefetch_tenant = self.tenant_resolver.default
+        self.prefetch_tenant = prefetch_tenant
+        # Chunks each conversation already has; later turns inject only the rest
+        self.ledger = ledger
+        # IVF lists probed per request, fewer while retrieval is busy
+        self.probe_budget = probe_budget
+        self.logger = None
+        self.metrics = MetricsRegistry()
+        if offload is not None:
+            offload.register_metrics(self.metrics)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # Set once the listen socket is bound, or once startup has failed
+        self.ready = threading.Event()
+        self.listen_addrs = []
         self.loop = asyncio.new_event_loop()
         self.m = None
 
     def run(self):
         asyncio.set_event_loop(self.loop)
-        self.loop.run_until_complete(self.start_proxy())
+        try:
+            self.loop.run_until_complete(self.start_proxy())
+        finally:
+            self.ready.set()
+            # Closed here, on the loop's thread, once no hook can append any more
+            if self.memory is not None:
+                self.memory.close()
+            if self.tenants is not None:
+                self.tenants.close()
+            if self.offload is not None:
+                logging.info(f"Offload pool: {self.offload.stats()}")
+                self.offload.close()
+
+    def wait_ready(self, timeout=None):
+        if not self.ready.wait(timeout):
+            raise TimeoutError(f"Proxy not listening after {timeout}s")
+        if not self.listen_addrs:
+            raise RuntimeError("Proxy failed to start listening")
+        return self.listen_addrs
+
+    def _on_running(self, listen_addrs):
+        self.listen_addrs = listen_addrs
+        self.ready.set()
 
     async def start_proxy(self):
         self.m = DumpMaster(self.opts, with_termlog=False, with_dumper=False)
-        self.m.addons.add(RequestResponseLogger())
+        self.logger = RequestResponseLogger(
+            stream_responses=self.stream_responses,
+            routes=self.routes,
+            pipeline=self.pipeline,
+            cache=self.cache,
+            packer=self.packer,
+            capture=self.capture,
+            metrics=self.metrics,
+            memory=self.memory,
+            response_cache=self.response_cache,
+            replay_server=self.replay_server,
+            tenants=self.tenants,
+            tenant_resolver=self.tenant_resolver,
+            prefetch=self.prefetch_enabled,
+            templates=self.templates,
+            ledger=self.ledger,
+            probe_budget=self.probe_budget,
+        )
+        self.m.addons.add(self.logger)
+        self.m.addons.add(ReadySignal(self._on_running))
+        if self.allowed_hosts:
+            self.m.options.update(allowed_hosts=self.allowed_hosts)
+        if self.replay_server is not None:
+            await self.replay_server.start()
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, port=self.metrics_port)
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logging.error(f"Could not serve metrics on port {self.metrics_port}: {e}")
         logging.info("Starting mitmproxy server...")
         await self.m.run()
-        logging.info("mitmproxy server started.")
+        logging.info("mitmproxy server stopped.")
+
+    def prefetch(self, prompt):
+        # Called from the DevTools watcher thread with the text typed so far
+        if self.logger is not None:
+            asyncio.run_coroutine_threadsafe(self.logger.prefetch(prompt, self.prefetch_tenant), self.loop)
+
+    def publish_templates(self, templates):
+        # Called from the template watcher thread, which already compiled them
+        self.templates = templates
+        if self.logger is not None:
+            self.loop.call_soon_threadsafe(self.logger.swap_templates, templates)
+
+    def invalidate_cache(self):
+        # Safe to call from any thread, e.g. after the corpus was re-indexed
+        self.loop.call_soon_threadsafe(self.cache.invalidate)
+
+    def publish_store(self, store):
+        # Called from the ingestion thread, which also pays for opening the lexical index;
+        # only the swap itself runs on the proxy loop
+        provider = store_provider(store)
+        self.loop.call_soon_threadsafe(self._swap_provider, provider)
+
+    def _swap_provider(self, provider):
+        providers = [p for p in self.pipeline.providers if getattr(p, "store", None) is None and not isinstance(p, StaticProvider)]
+        replaced = [p for p in self.pipeline.providers if getattr(p, "store", None) is not None]
+        # One reference assignment: a request sees either the old list or the new one
+        self.pipeline.providers = [provider] + providers
+        self.cache.invalidate()
+        for old in replaced:
+            # Closes the old store once searches still running on it finish; the offload
+            # pool's store has no leases and is closed with the pool
+            if hasattr(old, "retire"):
+                old.retire()
+        logging.info(f"Published RAG index with {provider.store.live_count} live chunks ({provider.name})")
+
+    async def drain(self, timeout=10.0):
+        # Stop accepting, let open connections finish (up to `timeout`), then stop the master
+        logging.info("Draining: no longer accepting connections")
+        self.m.options.update(server=False)
+        proxyserver = self.m.addons.get("proxyserver")
+        deadline = self.loop.time() + timeout
+        while proxyserver.connections and self.loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if proxyserver.connections:
+            logging.warning(f"Drain timed out with {len(proxyserver.connections)} connections open")
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.replay_server is not None:
+            self.replay_server.close()
+        if self.capture is not None:
+            await self.loop.run_in_executor(None, self.capture.close)
+        self.m.shutdown()
 
     def shutdown(self):
         logging.info("Shutting down mitmproxy server...")
+        if self.metrics_server is not None:
+            self.loop.call_soon_threadsafe(self.metrics_server.close)
+        if self.replay_server is not None:
+            self.loop.call_soon_threadsafe(self.replay_server.close)
+        # Master.run() returns once it has shut down, which ends run_until_complete() in run()
         self.loop.call_soon_threadsafe(self.m.shutdown)
-        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.capture is not None:
+            self.capture.close()
         logging.info("mitmproxy server shut down.")
 
+class ReadySignal:
+    # mitmproxy fires `running` only after every proxy server is listening
+    def __init__(self, on_ready):
+        self.on_ready = on_ready
+
+    def running(self):
+        self.on_ready(ctx.master.addons.get("proxyserver").listen_addrs())
+
+def default_providers(index_path=None):
+    # Use the local vector index when one has been built, else the static demo context
+    if index_path and (Path(index_path) / "index.json").exists():
+        from vector_store import VectorStore
+        store = VectorStore.open(index_path)
+        logging.info(f"Loaded RAG index with {store.count} chunks from {index_path}")
+        return [store_provider(store)]
+    logging.info("No RAG index found, injecting static context")
+    return [StaticProvider()]
+
+def store_provider(store):
+    # Hybrid lexical+vector scoring when a BM25 index matching the store exists
+    from bm25 import BM25Index, HybridProvider
+    from vector_store import VectorStoreProvider
+    if BM25Index.is_fresh(store.path, store):
+        return HybridProvider(store, BM25Index.open(store.path))
+    return VectorStoreProvider(store)
+
 class RequestResponseLogger:
-    def request(self, flow):
-        # Log ALL requests to see what's happening
-        print(f"Request: {flow.request.method} {flow.request.url}")
-        
-        # Check if URL contains conversation endpoint (works for both backend-anon and backend-api)
-        if "/conversation" in flow.request.url and "chatgpt.com" in flow.request.url:
-            print("INTERCEPTED CHATGPT REQUEST!")
+    def __init__(self, stream_responses=True, routes=None, pipeline=None, cache=None, capture=None, metrics=None, memory=None, packer=None,
+                 response_cache=None, replay_server=None, tenants=None, tenant_resolver=None, prefetch=False,
+                 templates=None, ledger=None, probe_budget=None):
+        # Stream /conversation SSE to the browser as it arrives instead of buffering it
+        self.stream_responses = stream_responses
+        self.pipeline = pipeline or ContextPipeline([StaticProvider()])
+        self.cache = cache or RetrievalCache()
+        # Dedupes retrieved chunks and fits them to a token budget before they are cached
+        self.packer = packer or ContextPacker()
+        # Flow records go to a background writer; nothing on this path blocks on I/O
+        self.capture = capture
+        # Per-conversation history: written from responses, recalled into prompts
+        self.memory = memory
+        self.response_cache = response_cache
+        self.replay_server = replay_server
+        self.tenants = tenants
+        self.tenant_resolver = tenant_resolver
+        self.templates = templates or TemplateSet.builtin()
+        self.template_reloads = 0
+        self.ledger = ledger
+        self.probe_budget = probe_budget
+        self.prefetch_enabled = prefetch
+        # prompt key -> (task, start) while a prefetch runs, then -> its retrieval time until used
+        self.prefetching = {}
+        self.prefetched = collections.OrderedDict()
+        self.prefetch_saved = 0.0
+        self.route_list = routes
+        self.routes = compile_routes(DEFAULT_ALLOWED_HOSTS, routes)
+        self.metrics = metrics or MetricsRegistry()
+        self.register_metrics(self.metrics)
+        self.cpu_start = time.process_time()
+
+    def register_metrics(self, registry):
+        # Children are resolved once here so each hook pays only for observe()/inc()
+        stage = registry.histogram("rag_stage_seconds", "Time spent in each proxy stage", ("stage",))
+        self.t_route_match = stage.labels("route_match")
+        self.t_body_parse = stage.labels("body_parse")
+        self.t_retrieval = stage.labels("context_retrieval")
+        self.t_memory = stage.labels("memory_recall")
+        self.t_assembly = stage.labels("prompt_assembly")
+        self.t_serialize = stage.labels("reserialize")
+        self.t_upstream_ttfb = stage.labels("upstream_ttfb")
+        self.t_first_token = stage.labels("time_to_first_token")
+        self.t_stream = stage.labels("stream_duration")
+        flows = registry.counter("rag_flows_total", "Flows by how the proxy handled them", ("result",))
+        self.c_intercepted = flows.labels("intercepted")
+        self.c_decrypted = flows.labels("decrypted")
+        self.c_passthrough = flows.labels("passthrough")
+        self.c_failed = flows.labels("failed")
+        self.c_context = registry.counter("rag_context_total", "Context lookups by outcome", ("status",))
+        self.c_bytes_injected = registry.counter("rag_bytes_injected_total", "Request bytes added by injection")
+        self.h_bytes_injected = registry.histogram("rag_injected_bytes", "Request bytes added by injection per turn",
+                                                   buckets=BYTE_BUCKETS)
+        self.h_tokens_injected = registry.histogram("rag_injected_tokens", "Context tokens injected per request",
+                                                    buckets=TOKEN_BUCKETS)
+        dropped = registry.counter("rag_chunks_dropped_total", "Retrieved chunks left out of the context", ("reason",))
+        self.c_dropped_duplicate = dropped.labels("duplicate")
+        self.c_dropped_budget = dropped.labels("budget")
+        prefetch = registry.counter("rag_prefetch_total", "Composer prefetches and how requests used them", ("result",))
+        self.c_prefetch_started = prefetch.labels("started")
+        self.c_prefetch_hit = prefetch.labels("hit")
+        self.c_prefetch_partial = prefetch.labels("partial")
+        self.c_prefetch_miss = prefetch.labels("miss")
+        self.c_prefetch_unused = prefetch.labels("unused")
+        self.c_prefetch_skipped = prefetch.labels("skipped")
+        self.h_prefetch_saved = registry.histogram("rag_prefetch_saved_seconds",
+                                                   "Retrieval time taken off the request path by prefetching")
+        registry.gauge("rag_template_reloads_total", "Injection template sets published",
+                       lambda: self.template_reloads, kind="counter")
+        registry.gauge("rag_pipeline_in_flight", "Retrievals currently running", lambda: self.pipeline.in_flight)
+        registry.gauge("rag_cache_entries", "Retrieval cache size", lambda: self.cache.stats()["size"])
+        registry.gauge("rag_cache_hits_total", "Retrieval cache hits", lambda: self.cache.hits, kind="counter")
+        registry.gauge("rag_cache_misses_total", "Retrieval cache misses", lambda: self.cache.misses, kind="counter")
+        if self.capture is not None:
+            registry.gauge("rag_capture_dropped_total", "Capture records dropped on a full queue",
+                           lambda: self.capture.dropped, kind="counter")
+            registry.gauge("rag_capture_queued", "Capture records waiting to be written",
+                           lambda: self.capture.queue.qsize())
+        if self.memory is not None:
+            registry.gauge("rag_memory_conversations", "Conversations in the memory log", lambda: len(self.memory))
+            registry.gauge("rag_memory_hot", "Conversations with turns held in memory", lambda: len(self.memory.hot))
+            registry.gauge("rag_memory_turns_total", "Turns appended to the memory log",
+                           lambda: self.memory.appended, kind="counter")
+        if self.response_cache is not None:
+            registry.gauge("rag_response_cache_entries", "Cached responses on disk", lambda: len(self.response_cache))
+            registry.gauge("rag_response_cache_bytes", "Size of the response cache", lambda: self.response_cache.total_bytes)
+            registry.gauge("rag_response_cache_hits_total", "Responses replayed from the cache",
+                           lambda: self.response_cache.hits, kind="counter")
+            registry.gauge("rag_response_cache_misses_total", "Cacheable requests sent upstream",
+                           lambda: self.response_cache.misses, kind="counter")
+        if self.ledger is not None:
+            chunks = registry.counter("rag_context_chunks_total", "Packed chunks by whether the conversation had them",
+                                      ("result",))
+            self.c_chunks_sent = chunks.labels("sent")
+            self.c_chunks_repeated = chunks.labels("repeated")
+            registry.gauge("rag_ledger_conversations", "Conversations whose injected chunks are tracked",
+                           lambda: len(self.ledger))
+            registry.gauge("rag_ledger_bytes_saved_total", "Context bytes not re-sent to a conversation",
+                           lambda: self.ledger.bytes_saved, kind="counter")
+        if self.probe_budget is not None:
+            registry.gauge("rag_ivf_nprobe_reduced_total", "Requests that probed fewer IVF lists under load",
+                           lambda: self.probe_budget.reduced, kind="counter")
+        if self.tenants is not None:
+            registry.gauge("rag_tenant_shards_open", "Tenant index shards currently open", lambda: len(self.tenants))
+            registry.gauge("rag_tenant_mapped_bytes", "Bytes mapped by open tenant shards",
+                           lambda: self.tenants.mapped_bytes)
+            registry.gauge("rag_tenant_shard_opens_total", "Tenant shards opened", lambda: self.tenants.opens, kind="counter")
+            registry.gauge("rag_tenant_shard_hits_total", "Lookups served by an open shard",
+                           lambda: self.tenants.hits, kind="counter")
+            registry.gauge("rag_tenant_shard_evictions_total", "Tenant shards closed to stay under the RSS budget",
+                           lambda: self.tenants.evictions, kind="counter")
+
+    def load(self, loader):
+        loader.add_option(
+            "allowed_hosts",
+            str,
+            DEFAULT_ALLOWED_HOSTS,
+            "Comma-separated list of hosts to decrypt; all other TLS is passed through"
+        )
+
+    def configure(self, updated):
+        if "allowed_hosts" in updated:
+            self.routes = compile_routes(ctx.options.allowed_hosts, self.route_list)
+            logging.info(f"Route table compiled for hosts: {', '.join(sorted(self.routes.allowed_hosts))}")
+
+    def tls_clienthello(self, data):
+        # Never decrypt hosts no route cares about
+        host = data.client_hello.sni
+        if host is None and data.context.server.address:
+            host = data.context.server.address[0]
+        if not self.routes.intercepts_host(host):
+            data.ignore_connection = True
+            self.c_passthrough.inc()
+
+    def swap_templates(self, templates):
+        # One reference assignment on the loop; flows already past it keep the set they read
+        self.templates = templates
+        self.template_reloads += 1
+        logging.info(f"Published templates v{templates.version}: {', '.join(sorted(templates.templates))}")
+
+    def http_connect(self, flow):
+        if self.tenant_resolver is not None:
+            self.tenant_resolver.http_connect(flow)
+
+    def requestheaders(self, flow):
+        start = time.perf_counter()
+        route = self.routes.match_flow(flow)
+        self.t_route_match.observe(time.perf_counter() - start)
+        flow.metadata["route"] = route
+        if self.tenant_resolver is not None:
+            # Resolved on every decrypted flow so the tenant header never goes upstream
+            flow.metadata["tenant"] = self.tenant_resolver.resolve(flow)
+        else:
+            # A browser profile may still tag requests; the header is ours either way
+            flow.request.headers.pop(TENANT_HEADER, None)
+        if route is None:
+            flow.request.stream = True
+            self.c_decrypted.inc()
+        else:
+            self.c_intercepted.inc()
+
+    def error(self, flow):
+        self.c_failed.inc()
+
+    def done(self):
+        cpu = time.process_time() - self.cpu_start
+        logging.info(
+            f"Proxy CPU: {cpu:.2f}s, intercepted={self.c_intercepted.value} decrypted={self.c_decrypted.value} "
+            f"passthrough={self.c_passthrough.value} failed={self.c_failed.value}"
+        )
+        logging.info(f"Retrieval cache: {self.cache.stats()}")
+        if self.capture is not None:
+            logging.info(f"Flow capture: {self.capture.stats()}")
+        if self.memory is not None:
+            logging.info(f"Conversation memory: {self.memory.stats()}")
+        if self.response_cache is not None:
+            logging.info(f"Response cache: {self.response_cache.stats()}")
+        if self.tenants is not None:
+            logging.info(f"Tenant shards: {self.tenants.stats()}")
+        if self.prefetch_enabled:
+            logging.info(f"Prefetch: {self.prefetch_stats()}")
+        if self.ledger is not None:
+            logging.info(f"Injection ledger: {self.ledger.stats()}")
+
+    async def request(self, flow):
+        route = flow.metadata.get("route")
+        if route is not None and route.inject:
+            logging.debug(f"Intercepted {flow.request.method} {flow.request.url}")
             try:
-                payload_json = json.loads(flow.request.content)
-                print(f"Original payload: {json.dumps(payload_json, indent=2)}")
-                original_prompt = payload_json['messages'][0]['content']['parts'][0]
-                modified_prompt = f"You have to answer with my name AHMED WALI. Must include my name. Prompt: {original_prompt}"
-                payload_json['messages'][0]['content']['parts'][0] = modified_prompt
+                body = flow.request.content
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug(f"Original payload: {json.dumps(json.loads(body), indent=2)}")
+                # Only the prompt string is decoded; the rest of the body is copied as bytes
+                start = time.perf_counter()
+                rewrite = PromptRewrite(body)
+                original_prompt = rewrite.prompt
+                tenant = flow.metadata.get("tenant")
+                query = ContextQuery(original_prompt, rewrite.conversation_id, route, tenant=tenant)
+                if self.probe_budget is not None:
+                    query.nprobe = self.probe_budget.pick(self.pipeline.in_flight)
+                self.t_body_parse.observe(time.perf_counter() - start)
 
-                # Serialize the modified payload
-                modified_payload = json.dumps(payload_json)
+                # Providers run concurrently on this loop; other flows keep moving meanwhile
+                start = time.perf_counter()
+                if self.prefetch_enabled:
+                    await self.use_prefetch(query)
+                packed, status = await self.build_context(query)
+                self.t_retrieval.observe(time.perf_counter() - start)
+                self.c_context.labels(status).inc()
+                context = packed.text
+                if self.ledger is not None and packed.chunks:
+                    # Chunks an earlier turn of this conversation carried are only referred to
+                    plan = self.ledger.plan(query.conversation_id, packed, self.packer.separator)
+                    self.c_chunks_sent.inc(len(plan.send))
+                    self.c_chunks_repeated.inc(len(plan.repeated))
+                    flow.metadata["injection_plan"] = plan
+                    context = plan.text
 
-                # Update Content-Length header
-                flow.request.headers['Content-Length'] = str(len(modified_payload.encode('utf-8')))
+                memory = ""
+                if self.memory is not None:
+                    # The user turn is stored with the reply, once a new conversation has its id
+                    flow.metadata["user_turn"] = (query.conversation_id, rewrite.message_id, original_prompt)
+                    start = time.perf_counter()
+                    # Other conversations may belong to other tenants
+                    memory = format_memory(*self.memory.recall(query.conversation_id, cross_session=tenant is None))
+                    self.t_memory.observe(time.perf_counter() - start)
+                # Read once: a reload landing mid-flow can't mix template versions
+                template = self.templates.for_route(route)
+                preferences = self.templates.preferences_for(tenant) if "preferences" in template.slots else ""
+                if not (context or memory or preferences):
+                    self.record("request", url=flow.request.url, conversation_id=query.conversation_id,
+                                prompt=original_prompt, status=status, injected=False, tenant=tenant)
+                    await self.cached_response(flow, route, rewrite, original_prompt)
+                    return
+                start = time.perf_counter()
+                modified_prompt = template.render(original_prompt, context, memory, preferences)
+                count = self.packer.counter.count
+                injected_tokens = count(context) + count(memory) + count(preferences)
+                self.t_assembly.observe(time.perf_counter() - start)
+                self.h_tokens_injected.observe(injected_tokens)
 
-                # Update the request content with the modified payload
-                flow.request.content = modified_payload.encode('utf-8')
+                start = time.perf_counter()
+                modified_payload = rewrite.apply(modified_prompt)
+                # Update Content-Length header and the request content with the modified payload
+                flow.request.headers['Content-Length'] = str(len(modified_payload))
+                flow.request.content = modified_payload
+                self.t_serialize.observe(time.perf_counter() - start)
+                injected_bytes = len(modified_payload) - len(body)
+                self.c_bytes_injected.inc(injected_bytes)
+                self.h_bytes_injected.observe(injected_bytes)
 
-                print(f"Modified Prompt: {modified_prompt}")
-            except (json.JSONDecodeError, KeyError, IndexError) as e:
-                print(f"Error modifying prompt: {e}")
+                self.record("request", url=flow.request.url, conversation_id=query.conversation_id,
+                            prompt=original_prompt, modified_prompt=modified_prompt, status=status, injected=True,
+                            injected_tokens=injected_tokens, injected_bytes=injected_bytes, tenant=tenant,
+                            template=template.name)
+                await self.cached_response(flow, route, rewrite, modified_prompt)
+            except (json.JSONDecodeError, KeyError, IndexError, TypeError) as e:
+                self.c_failed.inc()
+                logging.warning(f"Error modifying prompt: {e}")
+                self.record("error", url=flow.request.url, error=str(e))
+        elif route is not None and route.cache_responses and self.response_cache is not None:
+            try:
+                rewrite = PromptRewrite(flow.request.content)
+                await self.cached_response(flow, route, rewrite, rewrite.prompt)
+            except (json.JSONDecodeError, KeyError, IndexError, TypeError) as e:
+                logging.debug(f"Not caching {flow.request.url}: {e}")
+
+    async def cached_response(self, flow, route, rewrite, prompt):
+        # Keyed by the prompt as sent upstream, so a hit implies the same injected context
+        if self.response_cache is None or not route.cache_responses:
+            return
+        fields = {field: rewrite.read((field,)) for field in MODEL_FIELDS}
+        if flow.metadata.get("tenant") is not None:
+            fields["tenant"] = flow.metadata["tenant"]
+        key = response_key(prompt, fields)
+        response = None
+        if self.response_cache.has(key):
+            # Read here, off the loop, and handed to the replay server, so an eviction
+            # before the replay connects cannot answer the browser with a 404
+            response = await asyncio.get_running_loop().run_in_executor(None, self.response_cache.get, key)
+        if response is not None:
+            flow.request.scheme = "http"
+            flow.request.host = self.replay_server.host
+            flow.request.port = self.replay_server.port
+            flow.request.headers[REPLAY_HEADER] = self.replay_server.hold(response)
+            flow.metadata["response_cache"] = "hit"
+        else:
+            flow.metadata["response_cache_key"] = key
+
+    def store_response(self, key, status, headers, chunks):
+        headers = [(name, value) for name, value in headers.items() if name.lower() in ("content-type", "content-encoding")]
+        # Written off the loop; entries can be a few hundred KB
+        asyncio.get_running_loop().run_in_executor(
+            None, self.response_cache.put, key, CachedResponse(status, headers, chunks))
+
+    def record(self, kind, **fields):
+        if self.capture is not None:
+            self.capture.capture(kind, **fields)
+
+    async def prefetch(self, prompt, tenant=None):
+        key = prompt_key(prompt, tenant)
+        if key in self.prefetching or key in self.prefetched or self.cache.has(prompt, tenant):
+            return
+        self.c_prefetch_started.inc()
+        start = time.perf_counter()
+        # A background retrieval: it has its own cap and never takes a slot a sent prompt needs
+        task = asyncio.ensure_future(self.build_context(ContextQuery(prompt, tenant=tenant), background=True))
+        self.prefetching[key] = (task, start)
+        try:
+            _, status = await task
+        except Exception as e:
+            logging.debug(f"Prefetch failed: {e}")
+            return
+        finally:
+            del self.prefetching[key]
+        if status == "shed":
+            self.c_prefetch_skipped.inc()
+            return
+        self.prefetched[key] = time.perf_counter() - start
+        while len(self.prefetched) > PREFETCH_KEEP:
+            self.prefetched.popitem(last=False)
+            self.c_prefetch_unused.inc()
+
+    async def use_prefetch(self, query):
+        key = prompt_key(query.prompt, query.tenant)
+        running = self.prefetching.get(key)
+        if running is not None:
+            # Sent before its prefetch finished: wait for that one rather than retrieve twice
+            task, start = running
+            saved = time.perf_counter() - start
+            try:
+                _, status = await asyncio.shield(task)
+            except Exception:
+                # build_context below retrieves on its own
+                return
+            if status == "shed":
+                self.c_prefetch_miss.inc()
+                return
+            self.prefetched.pop(key, None)
+            self.c_prefetch_partial.inc()
+        elif key in self.prefetched and self.cache.has(query.prompt, query.tenant):
+            saved = self.prefetched.pop(key)
+            self.c_prefetch_hit.inc()
+        else:
+            self.c_prefetch_miss.inc()
+            return
+        self.prefetch_saved += saved
+        self.h_prefetch_saved.observe(saved)
+
+    def prefetch_stats(self):
+        used = self.c_prefetch_hit.value + self.c_prefetch_partial.value
+        requests = used + self.c_prefetch_miss.value
+        return {
+            "started": self.c_prefetch_started.value,
+            "hits": self.c_prefetch_hit.value,
+            "partial": self.c_prefetch_partial.value,
+            "misses": self.c_prefetch_miss.value,
+            "unused": self.c_prefetch_unused.value,
+            "skipped": self.c_prefetch_skipped.value,
+            "hit_rate": used / requests if requests else 0.0,
+            "saved_seconds": round(self.prefetch_saved, 3),
+        }
+
+    async def build_context(self, query, background=False):
+        # The packed chunks are cached, not just their text, so the ledger can tell them apart
+        packed = self.cache.get(query.prompt, query.tenant)
+        if packed is not None:
+            return packed, "cached"
+        result = await self.pipeline.retrieve(query, background)
+        packed = self.packer.pack(result.chunks)
+        self.c_dropped_duplicate.inc(packed.duplicates)
+        self.c_dropped_budget.inc(packed.over_budget)
+        # Degraded results (timeouts, shedding, a narrowed IVF probe) are not worth remembering
+        narrowed = self.probe_budget is not None and self.probe_budget.narrowed(query)
+        if result.status in ("ok", "empty") and not narrowed:
+            self.cache.put(query.prompt, packed, query.tenant)
+        return packed, result.status
+
+    def responseheaders(self, flow):
+        if flow.metadata.get("route") is None:
+            flow.response.stream = True
+            return
+        hit = flow.metadata.get("response_cache") == "hit"
+        if flow.request.timestamp_end and flow.response.timestamp_start and not hit:
+            self.t_upstream_ttfb.observe(flow.response.timestamp_start - flow.request.timestamp_end)
+        content_type = flow.response.headers.get("Content-Type", "")
+        if self.stream_responses:
+            if content_type.startswith("text/event-stream"):
+                flow.response.stream = ConversationStreamTap(
+                    on_done=lambda assembler, flow=flow: self.stream_done(flow, assembler),
+                    content_encoding=flow.response.headers.get("Content-Encoding"),
+                    on_first_text=lambda assembler, flow=flow: self.first_token(flow),
+                )
+        key = flow.metadata.get("response_cache_key")
+        if key is not None and flow.response.status_code == 200 and content_type.startswith("text/event-stream"):
+            if flow.response.stream:
+                # Record what passes through; the buffered path stores the body in `response`
+                flow.response.stream = StreamRecorder(
+                    flow.response.stream,
+                    on_complete=lambda chunks, flow=flow: self.store_response(
+                        key, 200, flow.response.headers, chunks),
+                )
+
+    def first_token(self, flow):
+        # As the user sees it: from the browser's request to the first words of the reply
+        self.t_first_token.observe(time.time() - flow.request.timestamp_start)
+
+    def stream_done(self, flow, assembler):
+        if flow.response.timestamp_start:
+            self.t_stream.observe(time.time() - flow.response.timestamp_start)
+        final_text = assembler.final_text()
+        self.record("response", url=flow.request.url, status_code=flow.response.status_code,
+                    conversation_id=assembler.conversation_id, message_id=assembler.message_id(),
+                    final_text=final_text, streamed=True)
+        self.remember(flow, assembler.conversation_id, assembler.message_id(), final_text)
+        self.commit_injection(flow, assembler.conversation_id)
 
     def response(self, flow):
-        print(f"Response: {flow.response.status_code} {flow.request.url}")
-        if "/conversation" in flow.request.url and "chatgpt.com" in flow.request.url:
-            if flow.response.content:
-                try:
-                    final_text = extract_final_text(flow.response.content)
-                    print(flow.response.content)
-                    print(f"Final Response Text: {final_text}")
-                except Exception as e:
-                    print(f"Error extracting final text: {e}")
+        if flow.metadata.get("route") is not None and flow.response.content:
+            if flow.response.timestamp_end:
+                self.t_stream.observe(flow.response.timestamp_end - flow.response.timestamp_start)
+            try:
+                assembler = parse_response(flow.response.content)
+                final_text = assembler.final_text()
+            except Exception as e:
+                logging.warning(f"Error extracting final text: {e}")
+                assembler = final_text = None
+            self.record("response", url=flow.request.url, status_code=flow.response.status_code,
+                        final_text=final_text, body=flow.response.content, streamed=False)
+            if assembler is not None:
+                self.remember(flow, assembler.conversation_id, assembler.message_id(), final_text)
+                self.commit_injection(flow, assembler.conversation_id)
+            key = flow.metadata.get("response_cache_key")
+            if key is not None and flow.response.status_code == 200 and \
+                    flow.response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                self.store_response(key, 200, flow.response.headers, [(flow.response.raw_content, 0.0)])
+
+    def remember(self, flow, conversation_id, message_id, final_text):
+        user_turn = flow.metadata.get("user_turn")
+        if self.memory is None or user_turn is None or flow.response.status_code != 200:
+            return
+        conversation_id = conversation_id or user_turn[0]
+        self.memory.append(conversation_id, "user", user_turn[2], message_id=user_turn[1])
+        self.memory.append(conversation_id, "assistant", final_text, message_id=message_id)
+
+    def commit_injection(self, flow, conversation_id):
+        # Only a turn upstream answered puts its chunks in the conversation; a replayed reply never reached it
+        plan = flow.metadata.get("injection_plan")
+        if plan is None or flow.response.status_code != 200 or flow.metadata.get("response_cache") == "hit":
+            return
+        self.ledger.commit(conversation_id, plan)
+
+def parse_response(response_bytes):
+    # Run a buffered body through the same state machine the streaming path uses
+    parser = SSEParser()
+    assembler = ConversationStreamAssembler()
+    for event, data in parser.feed(response_bytes) + parser.close():
+        assembler.feed_event(event, data)
+        if assembler.done:
+            break
+    return assembler
 
 def extract_final_text(response_bytes):
-    # Decode the bytes to a string
-    response_str = response_bytes.decode('utf-8')
-    
-    # Initialize variables
-    content_parts = []
-    
-    # Split the response into lines
-    lines = response_str.strip().split('\n')
-
-    # Regular expressions to match event and data lines
-    event_re = re.compile(r'^event: (\w+)$')
-    data_re = re.compile(r'^data: (.*)$')
-    
-    # Initialize an iterator over the lines
-    lines_iter = iter(lines)
-    
-    for line in lines_iter:
-        event_match = event_re.match(line)
-        if event_match:
-            event_type = event_match.group(1)
-            # Get the next line, which should be the data
-            data_line = next(lines_iter, '').strip()
-            data_match = data_re.match(data_line)
-            if data_match:
-                data_content = data_match.group(1)
-                if data_content == '[DONE]':
-                    break  # End of response
-                try:
-                    data_json = json.loads(data_content)
-                except json.JSONDecodeError:
-                    continue  # Skip invalid JSON
-                if event_type == 'delta':
-                    v = data_json.get('v', '')
-                    if isinstance(v, str) and v != 'finished_successfully':
-                        content_parts.append(v)
-                    elif isinstance(v, list):
-                        for change in v:
-                            cv = change.get('v', '')
-                            if isinstance(cv, str) and cv != 'finished_successfully':
-                                content_parts.append(cv)
-    # Return the reconstructed text
-    return ''.join(content_parts)
\ No newline at end of file
+    return parse_response(response_bytes).final_text()
@@ -0,0 +1,314 @@
+# offload.py
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from context_providers import ContextChunk, ContextProvider
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+# Set in each worker process by _init_worker
+_worker = {}
+
+
+class BatchLayout:
+    """Byte layout of one shared-memory batch slot.
+
+    The parent writes prompts as UTF-8 into `text` with their end offsets in
+    `offsets`, and each prompt's IVF nprobe in `nprobes` (0 for the index
+    default); the worker writes up to k (row, score) results per prompt, and
+    how many it found in `counts`. Only the slot number and batch size are
+    pickled across the process boundary.
+    """
+
+    def __init__(self, max_batch, k, text_bytes):
+        self.max_batch = max_batch
+        self.k = k
+        self.text_bytes = text_bytes
+        # Widest dtypes first, so every array starts aligned
+        self.fields = (
+            ("rows", np.int64, max_batch * k),
+            ("scores", np.float32, max_batch * k),
+            ("offsets", np.int32, max_batch + 1),
+            ("counts", np.int32, max_batch),
+            ("nprobes", np.int32, max_batch),
+            ("text", np.uint8, text_bytes),
+        )
+        self.size = sum(np.dtype(dtype).itemsize * n for _, dtype, n in self.fields)
+
+    def views(self, buf):
+        views = {}
+        offset = 0
+        for name, dtype, n in self.fields:
+            views[name] = np.ndarray((n,), dtype=dtype, buffer=buf, offset=offset)
+            offset += np.dtype(dtype).itemsize * n
+        return views
+
+
+def _init_worker(index_path, segment_names, layout, k):
+    # Runs once per worker process: the index, the ranker and the slot views outlive every batch
+    from mitmproxy_integration import store_provider
+    from vector_store import VectorStore
+
+    provider = store_provider(VectorStore.open(index_path))
+    provider.k = k
+    segments = [shared_memory.SharedMemory(name=name) for name in segment_names]
+    _worker.update(provider=provider, segments=segments, slots=[layout.views(s.buf) for s in segments])
+    # Pay for imports, page faults and the hashing cache before the first real prompt
+    _rank(["warm up the embedder"])
+
+
+def _warm(hold):
+    # Held briefly so that concurrent warm jobs land on different workers
+    time.sleep(hold)
+    return os.getpid()
+
+
+def _rank(texts, nprobes=None):
+    provider = _worker["provider"]
+    nprobes = nprobes or [None] * len(texts)
+    if hasattr(provider, "rank"):
+        # Hybrid: vector + BM25 candidates fused per prompt
+        return [provider.rank(text, nprobe) for text, nprobe in zip(texts, nprobes)]
+    store = provider.store
+    queries = store.embedder.embed(texts)
+    ranked = [None] * len(texts)
+    # One search per distinct nprobe; under steady load a batch usually shares one
+    for nprobe in set(nprobes):
+        picked = [i for i, n in enumerate(nprobes) if n == nprobe]
+        for i, (rows, scores) in zip(picked, store.search(queries[picked], provider.k, nprobe)):
+            ranked[i] = [(int(row), float(score)) for row, score in zip(rows, scores) if score >= provider.min_score]
+    return ranked
+
+
+def _run_batch(slot, count):
+    start = time.perf_counter()
+    views = _worker["slots"][slot]
+    offsets = views["offsets"]
+    text = views["text"]
+    texts = [text[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8", "ignore") for i in range(count)]
+    nprobes = [int(n) or None for n in views["nprobes"][:count]]
+    k = len(views["rows"]) // len(views["counts"])
+    for i, ranked in enumerate(_rank(texts, nprobes)):
+        ranked = ranked[:k]
+        views["counts"][i] = len(ranked)
+        for j, (row, score) in enumerate(ranked):
+            views["rows"][i * k + j] = row
+            views["scores"][i * k + j] = score
+    return time.perf_counter() - start
+
+
+class MicroBatcher:
+    """Collects items submitted within `window` seconds into one call of `run_batch`.
+
+    A batch goes out when it has `max_batch` items or `max_bytes` of payload,
+    or when the window after its first item ends. `run_batch(items)` is a
+    coroutine returning one result per item. Must be used from one event loop.
+    """
+
+    def __init__(self, run_batch, max_batch=16, window=0.002, max_bytes=None, size=len):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.window = window
+        self.max_bytes = max_bytes
+        self.size = size
+        self.pending = []
+        self.pending_bytes = 0
+        self._timer = None
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        item_bytes = self.size(item)
+        if self.max_bytes is not None and self.pending and self.pending_bytes + item_bytes > self.max_bytes:
+            self.flush()
+        self.pending.append((item, future))
+        self.pending_bytes += item_bytes
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        batch, self.pending, self.pending_bytes = self.pending, [], 0
+        asyncio.ensure_future(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            # The submitter may have given up (provider timeout) while the batch ran
+            if not future.done():
+                future.set_result(result)
+
+
+class OffloadPool:
+    """Process pool that embeds and ranks prompts against the local index.
+
+    Workers are spawned and warmed by `start()`, and each opens the index and
+    its ranker (hybrid when a fresh BM25 index exists) once. Prompts arriving
+    within `batch_window` are micro-batched; a batch is written into one of
+    2 x `workers` shared-memory slots, so the proxy loop only waits on a future.
+    Chunk text is read back in the parent from its own memmapped store. The
+    workers keep the index they started with; a re-published index is served
+    in-process by the store provider that replaces this one.
+    """
+
+    def __init__(self, index_path, workers=2, k=4, max_batch=16, batch_window=0.002, max_prompt_bytes=8192):
+        self.index_path = index_path
+        self.workers = workers
+        self.k = k
+        self.max_prompt_bytes = max_prompt_bytes
+        self.layout = BatchLayout(max_batch, k, max_batch * max_prompt_bytes)
+        self.batcher = MicroBatcher(self.run_batch, max_batch, batch_window, max_bytes=self.layout.text_bytes,
+                                    size=lambda item: len(item[0]))
+        self.store = None
+        self.executor = None
+        self.segments = []
+        self.slots = []
+        self.free_slots = None
+        self.waiting = 0
+        self.in_flight = 0
+        self.batches = 0
+        self.prompts = 0
+        self.h_batch_wait = self.h_batch_compute = self.h_batch_total = self.h_batch_size = None
+
+    def start(self):
+        from vector_store import VectorStore
+
+        start = time.perf_counter()
+        self.store = VectorStore.open(self.index_path)
+        self.segments = [shared_memory.SharedMemory(create=True, size=self.layout.size)
+                         for _ in range(2 * self.workers)]
+        self.slots = [self.layout.views(s.buf) for s in self.segments]
+        self.free_slots = asyncio.Queue()
+        for slot in range(len(self.segments)):
+            self.free_slots.put_nowait(slot)
+        # spawn: forking a process that already runs the proxy and Qt threads is not safe
+        self.executor = ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(str(self.index_path), [s.name for s in self.segments], self.layout, self.k),
+        )
+        # As many concurrent jobs as workers makes the executor start all of them now; repeat
+        # until each has answered, i.e. finished its initializer
+        pids = set()
+        deadline = time.monotonic() + 120
+        while len(pids) < self.workers and time.monotonic() < deadline:
+            pids |= {f.result() for f in [self.executor.submit(_warm, 0.05) for _ in range(self.workers)]}
+        logging.info(f"Offload pool: {len(pids)} workers warm in {(time.perf_counter() - start) * 1000:.0f}ms "
+                     f"({len(self.segments)} x {self.layout.size // 1024} KB shared batch slots)")
+
+    def register_metrics(self, registry):
+        stage = registry.histogram("rag_offload_batch_seconds", "Offloaded batch latency by phase", ("phase",))
+        self.h_batch_wait = stage.labels("slot_wait")
+        self.h_batch_compute = stage.labels("compute")
+        self.h_batch_total = stage.labels("total")
+        self.h_batch_size = registry.histogram("rag_offload_batch_size", "Prompts per offloaded batch",
+                                               buckets=BATCH_SIZE_BUCKETS)
+        registry.gauge("rag_offload_queue_depth", "Prompts waiting for a batch or a free worker",
+                       lambda: len(self.batcher.pending) + self.waiting)
+        registry.gauge("rag_offload_in_flight", "Batches running in worker processes", lambda: self.in_flight)
+
+    async def search(self, prompt, nprobe=None):
+        data = prompt.encode("utf-8")[:self.max_prompt_bytes]
+        return await self.batcher.submit((data, nprobe))
+
+    async def run_batch(self, items):
+        start = time.perf_counter()
+        self.waiting += len(items)
+        try:
+            slot = await self.free_slots.get()
+        finally:
+            self.waiting -= len(items)
+        waited = time.perf_counter() - start
+        try:
+            views = self.slots[slot]
+            offsets = views["offsets"]
+            offsets[0] = 0
+            for i, (data, nprobe) in enumerate(items):
+                end = offsets[i] + len(data)
+                views["text"][offsets[i]:end] = np.frombuffer(data, dtype=np.uint8)
+                offsets[i + 1] = end
+                views["nprobes"][i] = nprobe or 0
+            self.in_flight += 1
+            try:
+                compute = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, _run_batch, slot, len(items))
+            finally:
+                self.in_flight -= 1
+            results = []
+            for i in range(len(items)):
+                n = int(views["counts"][i])
+                base = i * self.k
+                results.append(list(zip(views["rows"][base:base + n].tolist(),
+                                        views["scores"][base:base + n].tolist())))
+        finally:
+            self.free_slots.put_nowait(slot)
+        self.batches += 1
+        self.prompts += len(items)
+        if self.h_batch_total is not None:
+            self.h_batch_wait.observe(waited)
+            self.h_batch_compute.observe(compute)
+            self.h_batch_total.observe(time.perf_counter() - start)
+            self.h_batch_size.observe(len(items))
+        return results
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "batches": self.batches,
+            "prompts": self.prompts,
+            "mean_batch": self.prompts / self.batches if self.batches else 0.0,
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        # The numpy views pin the buffers; they must go before the segments can close
+        self.slots = []
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+        if self.store is not None:
+            self.store.close()
+
+
+class OffloadProvider(ContextProvider):
+    name = "offload"
+
+    def __init__(self, pool, timeout=None):
+        self.pool = pool
+        # Set so an index published by the ingest daemon replaces this provider
+        self.store = pool.store
+        if timeout is not None:
+            self.timeout = timeout
+
+    async def fetch(self, query):
+        # The workers opened the same index as the parent's store, IVF included
+        if query.nprobe is not None and self.pool.store.ann is not None:
+            query.nprobe_applied = True
+        chunks = []
+        for row, score in await self.pool.search(query.prompt, query.nprobe):
+            meta = self.pool.store.chunk(row)
+            chunks.append(ContextChunk(meta["id"], meta["text"], score, meta.get("source", self.name)))
+        return chunks
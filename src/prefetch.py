@@ -0,0 +1,141 @@
+# prefetch.py
+
+import json
+import logging
+import threading
+import urllib.request
+from urllib.parse import urlparse
+
+import websocket
+
+from routes import DEFAULT_ALLOWED_HOSTS
+
+BINDING = "__ragPrefetch"
+
+# Installed in every ChatGPT page: debounces input in the composer and hands the
+# text to the CDP binding, so only settled drafts cross the DevTools socket
+COMPOSER_SCRIPT = """
+(() => {
+  if (window.__ragPrefetchHooked) return;
+  window.__ragPrefetchHooked = true;
+  let timer = null;
+  document.addEventListener('input', (event) => {
+    const target = event.target;
+    const box = target && target.closest && target.closest('#prompt-textarea, textarea, [contenteditable="true"]');
+    if (!box) return;
+    clearTimeout(timer);
+    timer = setTimeout(() => {
+      const text = box.tagName === 'TEXTAREA' ? box.value : box.innerText;
+      if (typeof window.%(binding)s === 'function') window.%(binding)s(text);
+    }, %(debounce_ms)d);
+  }, true);
+})();
+"""
+
+
+def list_targets(cdp_port, timeout=2.0):
+    with urllib.request.urlopen(f"http://127.0.0.1:{cdp_port}/json/list", timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+class CdpPrefetcher(threading.Thread):
+    """Watches the ChatGPT composer over the DevTools port and reports drafts.
+
+    Every `poll_interval` the target list is polled; each ChatGPT page gets its
+    own watcher that installs COMPOSER_SCRIPT and a Runtime binding. Drafts of at
+    least `min_chars` that differ from the last one from the same page go to
+    `on_text(text)`, which is expected to start retrieval on the proxy loop.
+    """
+
+    def __init__(self, cdp_port, on_text, hosts=DEFAULT_ALLOWED_HOSTS, debounce=0.3, min_chars=8, poll_interval=2.0):
+        super().__init__(daemon=True, name="cdp-prefetch")
+        self.cdp_port = cdp_port
+        self.on_text = on_text
+        self.hosts = {h.strip() for h in hosts.split(",") if h.strip()}
+        self.debounce = debounce
+        self.min_chars = min_chars
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.watchers = {}
+        self.drafts = 0
+
+    def run(self):
+        logging.info(f"Prefetching retrieval from the composer via DevTools on port {self.cdp_port}")
+        while not self.stop_event.is_set():
+            try:
+                self.poll_targets()
+            except (OSError, ValueError) as e:
+                # The browser opens the DevTools port after the proxy is up
+                logging.debug(f"DevTools not reachable yet: {e}")
+            self.stop_event.wait(self.poll_interval)
+
+    def poll_targets(self):
+        for target in list_targets(self.cdp_port):
+            if target.get("type") != "page" or "webSocketDebuggerUrl" not in target:
+                continue
+            if urlparse(target.get("url", "")).hostname not in self.hosts:
+                continue
+            watcher = self.watchers.get(target["id"])
+            if watcher is None or not watcher.is_alive():
+                watcher = TargetWatcher(self, target["webSocketDebuggerUrl"])
+                self.watchers[target["id"]] = watcher
+                watcher.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for watcher in self.watchers.values():
+            watcher.close()
+
+    def draft(self, text):
+        self.drafts += 1
+        try:
+            self.on_text(text)
+        except Exception as e:
+            logging.warning(f"Prefetch failed to start: {e}")
+
+
+class TargetWatcher(threading.Thread):
+    # One DevTools session per page; blocks on the socket until the page goes away
+
+    def __init__(self, prefetcher, url):
+        super().__init__(daemon=True, name="cdp-target")
+        self.prefetcher = prefetcher
+        self.url = url
+        self.ws = None
+        self.last_text = None
+        self._next_id = 0
+
+    def send(self, method, **params):
+        self._next_id += 1
+        self.ws.send(json.dumps({"id": self._next_id, "method": method, "params": params}))
+
+    def run(self):
+        script = COMPOSER_SCRIPT % {"binding": BINDING, "debounce_ms": int(self.prefetcher.debounce * 1000)}
+        try:
+            # Qt's Chromium rejects DevTools sockets that carry an Origin it wasn't told to allow
+            self.ws = websocket.create_connection(self.url, timeout=5, suppress_origin=True)
+            self.ws.settimeout(None)
+            self.send("Runtime.enable")
+            self.send("Runtime.addBinding", name=BINDING)
+            self.send("Page.addScriptToEvaluateOnNewDocument", source=script)
+            self.send("Runtime.evaluate", expression=script)
+            logging.info(f"Watching composer input on {self.url}")
+            while not self.prefetcher.stop_event.is_set():
+                message = json.loads(self.ws.recv())
+                if message.get("method") == "Runtime.bindingCalled" and message["params"].get("name") == BINDING:
+                    self.on_draft(message["params"].get("payload", ""))
+        except (OSError, ValueError, websocket.WebSocketException) as e:
+            logging.debug(f"DevTools session ended for {self.url}: {e}")
+        finally:
+            self.close()
+
+    def on_draft(self, text):
+        text = text.strip()
+        if len(text) < self.prefetcher.min_chars or text == self.last_text:
+            return
+        self.last_text = text
+        self.prefetcher.draft(text)
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
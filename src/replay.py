@@ -0,0 +1,360 @@
+# replay.py
+
+import argparse
+import asyncio
+import difflib
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_URL = "https://chatgpt.com/backend-api/conversation"
+# RequestResponseLogger stage children -> report names; "total" is the whole hook pair
+STAGES = {
+    "t_route_match": "route_match",
+    "t_body_parse": "body_parse",
+    "t_retrieval": "context_retrieval",
+    "t_memory": "memory_recall",
+    "t_assembly": "prompt_assembly",
+    "t_serialize": "reserialize",
+}
+
+# Set in each worker process by _init_worker
+_worker = {}
+
+
+class StageSamples:
+    """Stands in for a histogram child and keeps every observation, so percentiles are exact."""
+
+    __slots__ = ("samples",)
+
+    def __init__(self):
+        self.samples = []
+
+    def observe(self, value):
+        self.samples.append(value)
+
+    def drain(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class RecordSink:
+    # Takes the logger's capture records, which carry the context status and what was injected
+
+    def __init__(self):
+        self.records = []
+
+    def capture(self, kind, **fields):
+        fields["kind"] = kind
+        self.records.append(fields)
+        return True
+
+
+def _open(path):
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.suffix == ".zst":
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")), encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def corpus_files(paths):
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(p for p in path.iterdir() if ".jsonl" in p.name))
+        else:
+            files.append(path)
+    return files
+
+
+def load_corpus(paths, limit=None):
+    """Yields (id, url, body bytes, tenant) for every replayable request record.
+
+    A record with a `body` (the raw /conversation payload, as a string or an
+    object) is replayed as is. Flow capture records only keep the prompt, so
+    for those a payload of the browser's shape is built around it, with ids
+    derived from the record's position so that two runs send identical bytes.
+    """
+    count = 0
+    for path in corpus_files(paths):
+        with _open(path) as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping malformed line {path}:{line_no}")
+                    continue
+                if record.get("kind", "request") != "request" or (record.get("body") is None and "prompt" not in record):
+                    continue
+                record_id = str(record.get("id", f"{path.name}:{line_no}"))
+                yield record_id, record.get("url") or DEFAULT_URL, payload_bytes(record_id, record), record.get("tenant")
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+
+def payload_bytes(record_id, record):
+    body = record.get("body")
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    if body is not None:
+        return json.dumps(body).encode("utf-8")
+    ids = uuid.uuid5(uuid.NAMESPACE_URL, record_id)
+    return json.dumps({
+        "action": "next",
+        "messages": [{
+            "id": str(ids),
+            "author": {"role": "user"},
+            "content": {"content_type": "text", "parts": [record["prompt"]]},
+            "metadata": {},
+        }],
+        "conversation_id": record.get("conversation_id"),
+        "parent_message_id": str(uuid.uuid5(ids, "parent")),
+        "model": "auto",
+    }).encode("utf-8")
+
+
+def _init_worker(config, started):
+    # Runs once per worker process: the index, ranker and templates outlive every batch
+    from context_packer import ContextPacker
+    from context_providers import ContextPipeline
+    from mitmproxy_integration import RequestResponseLogger, default_providers
+    from templates import TemplateSet
+
+    logging.getLogger().setLevel(config["log_level"])
+    templates = TemplateSet.load(config["templates"]) if config["templates"] else None
+    ledger = None
+    if config["delta_context"]:
+        from injection_ledger import InjectionLedger
+        ledger = InjectionLedger()
+    sink = RecordSink()
+    logger = RequestResponseLogger(
+        stream_responses=False,
+        pipeline=ContextPipeline(default_providers(config["index_dir"])),
+        packer=ContextPacker(config["context_budget"] or None),
+        capture=sink,
+        templates=templates,
+        ledger=ledger,
+    )
+    stages = {name: StageSamples() for name in STAGES.values()}
+    for attr, name in STAGES.items():
+        setattr(logger, attr, stages[name])
+    _worker.update(logger=logger, sink=sink, stages=stages, loop=asyncio.new_event_loop(), started=started)
+    # Pay for first-call imports and page faults before anything is timed
+    _replay_batch([("warm-up", DEFAULT_URL, payload_bytes("warm-up", {"prompt": "warm up the pipeline"}), None)])
+    logger.cache.invalidate()
+
+
+def _wait_started(_):
+    # Holds this worker until every worker has initialized, so each takes exactly one
+    _worker["started"].wait()
+    return os.getpid()
+
+
+def _make_flow(url, body):
+    from mitmproxy import connection, http
+
+    request = http.Request.make("POST", url, body, {"content-type": "application/json"})
+    client = connection.Client(peername=("127.0.0.1", 0), sockname=("127.0.0.1", 0))
+    flow = http.HTTPFlow(client, connection.Server(address=(request.host, request.port)))
+    flow.request = request
+    return flow
+
+
+def _replay_batch(batch):
+    # The same hook pair a live flow goes through: route match, then retrieval, packing and rewrite
+    logger = _worker["logger"]
+    sink = _worker["sink"]
+    loop = _worker["loop"]
+    results = []
+    totals = []
+    for record_id, url, body, tenant in batch:
+        flow = _make_flow(url, body)
+        sink.records.clear()
+        start = time.perf_counter()
+        logger.requestheaders(flow)
+        if tenant is not None:
+            flow.metadata["tenant"] = tenant
+        loop.run_until_complete(logger.request(flow))
+        elapsed = time.perf_counter() - start
+        plan = flow.metadata.get("injection_plan")
+        if plan is not None:
+            # No upstream here: every turn counts as answered, under the id it was sent with
+            logger.ledger.commit(plan.conversation_id, plan)
+        totals.append(elapsed)
+        route = flow.metadata.get("route")
+        record = sink.records[-1] if sink.records else {}
+        content = flow.request.content
+        results.append({
+            "id": record_id,
+            "url": url,
+            "route": route.name if route is not None else None,
+            # No record: the URL matched no injecting route
+            "status": record.get("status") or record.get("kind") or "passthrough",
+            "injected": record.get("injected", False),
+            "injected_tokens": record.get("injected_tokens", 0),
+            "injected_bytes": record.get("injected_bytes", 0),
+            "template": record.get("template"),
+            "seconds": round(elapsed, 6),
+            "body": content.decode("utf-8", "replace") if content != body else None,
+        })
+    samples = {name: stage.drain() for name, stage in _worker["stages"].items()}
+    samples["total"] = totals
+    return results, samples, os.getpid()
+
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def replay(paths, workers=os.cpu_count() or 1, batch_size=64, limit=None, **config):
+    """Runs a capture corpus through the request hooks in a process pool.
+
+    Returns (results in corpus order, stage samples in seconds, wall seconds,
+    worker pids). Every worker builds its own logger, pipeline and retrieval
+    cache, so repeated prompts hit the cache as they would in one proxy. Wall
+    time starts once all workers have initialized; startup is logged apart.
+    """
+    config = {"index_dir": None, "templates": None, "context_budget": 1024, "delta_context": False,
+              "log_level": logging.WARNING, **config}
+    results = []
+    samples = {name: [] for name in (*STAGES.values(), "total")}
+    pids = set()
+    started = multiprocessing.Barrier(workers)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(config, started)) as executor:
+        start = time.perf_counter()
+        list(executor.map(_wait_started, range(workers)))
+        logging.info(f"Started {workers} workers in {time.perf_counter() - start:.2f}s")
+        start = time.perf_counter()
+        for batch_results, batch_samples, pid in executor.map(_replay_batch, batches(load_corpus(paths, limit), batch_size)):
+            results.extend(batch_results)
+            for name, values in batch_samples.items():
+                samples[name].extend(values)
+            pids.add(pid)
+        wall = time.perf_counter() - start
+    return results, samples, wall, pids
+
+
+def stage_table(samples):
+    lines = [f"{'stage':<20} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+    for name, values in samples.items():
+        if not values:
+            continue
+        p50, p90, p99 = np.percentile(values, (50, 90, 99)) * 1000
+        lines.append(f"{name:<20} {len(values):>7} {p50:>9.3f} {p90:>9.3f} {p99:>9.3f} {max(values) * 1000:>9.3f}")
+    return "\n".join(lines)
+
+
+def read_results(path):
+    with open(path, encoding="utf-8") as f:
+        return {record["id"]: record for record in map(json.loads, filter(str.strip, f))}
+
+
+def _pretty(body):
+    if body is None:
+        return ["(not rewritten)"]
+    try:
+        return json.dumps(json.loads(body), indent=2, ensure_ascii=False).splitlines()
+    except json.JSONDecodeError:
+        return body.splitlines()
+
+
+def compare(results, baseline):
+    """Splits results by how their rewritten payload compares with a baseline run.
+
+    Returns (changed ids, ids missing from the baseline, baseline ids not replayed).
+    """
+    changed = [r["id"] for r in results if r["id"] in baseline and r["body"] != baseline[r["id"]]["body"]]
+    seen = {r["id"] for r in results}
+    added = [r["id"] for r in results if r["id"] not in baseline]
+    missing = [record_id for record_id in baseline if record_id not in seen]
+    return changed, added, missing
+
+
+def payload_diff(record_id, old, new):
+    return "\n".join(difflib.unified_diff(_pretty(old), _pretty(new), f"baseline/{record_id}", f"replay/{record_id}",
+                                          lineterm=""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured /conversation requests through the rewrite "
+                                                 "pipeline, without a browser, proxy or network")
+    parser.add_argument("corpus", nargs="+", help="JSONL files or capture directories (.jsonl, .jsonl.gz, .jsonl.zst)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=64, help="Records per task sent to a worker")
+    parser.add_argument("--limit", type=int, default=None, help="Replay at most this many records")
+    parser.add_argument("--index-dir", default=os.environ.get("RAG_INDEX_DIR"))
+    parser.add_argument("--templates", default=os.environ.get("RAG_TEMPLATES"), help="Template config to render with")
+    parser.add_argument("--context-budget", type=int, default=1024, help="Max injected context tokens (0 = no limit)")
+    parser.add_argument("--delta-context", action="store_true",
+                        help="Inject only chunks a conversation was not sent before (records of one "
+                             "conversation should be contiguous, as batches go to different workers)")
+    parser.add_argument("--output", help="Write one result per record here, for use as a later --baseline")
+    parser.add_argument("--baseline", help="Results of an earlier run to diff rewritten payloads against")
+    parser.add_argument("--show-diffs", type=int, default=5, help="Print at most this many payload diffs")
+    parser.add_argument("--fail-on-diff", action="store_true", help="Exit 1 when any rewritten payload changed")
+    parser.add_argument("--max-slowdown", type=float, default=None,
+                        help="Exit 1 when the median per-record time exceeds the baseline's by this factor")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    results, samples, wall, pids = replay(args.corpus, args.workers, args.batch_size, args.limit,
+                                          index_dir=args.index_dir, templates=args.templates,
+                                          context_budget=args.context_budget, delta_context=args.delta_context)
+    if not results:
+        sys.exit("No replayable request records found")
+
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    rewritten = sum(1 for r in results if r["body"] is not None)
+    injected = sum(r["injected_bytes"] for r in results)
+    print(f"Replayed {len(results)} records in {wall:.2f}s on {len(pids)} workers: "
+          f"{len(results) / wall:.0f} records/s, {rewritten} rewritten, "
+          f"{injected / max(rewritten, 1):.0f} bytes injected per rewritten record")
+    print("Context status: " + ", ".join(f"{status}={n}" for status, n in sorted(statuses.items(), key=str)))
+    print(stage_table(samples))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        print(f"Results written to {args.output}")
+
+    failed = False
+    if args.baseline:
+        baseline = read_results(args.baseline)
+        changed, added, missing = compare(results, baseline)
+        print(f"Against {args.baseline}: {len(changed)} payloads changed, {len(added)} new records, "
+              f"{len(missing)} baseline records not replayed")
+        by_id = {r["id"]: r for r in results}
+        for record_id in changed[:args.show_diffs]:
+            print(payload_diff(record_id, baseline[record_id]["body"], by_id[record_id]["body"]))
+        failed = args.fail_on_diff and bool(changed)
+        if args.max_slowdown is not None:
+            before = float(np.median([r["seconds"] for r in baseline.values()]))
+            after = float(np.median(samples["total"]))
+            print(f"Median per-record time: {before * 1000:.3f}ms -> {after * 1000:.3f}ms ({after / before:.2f}x)")
+            failed = failed or after > before * args.max_slowdown
+    sys.exit(1 if failed else 0)
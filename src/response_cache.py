@@ -0,0 +1,246 @@
+# response_cache.py
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from pathlib import Path
+
+# Request fields besides the prompt that change what the model sends back
+MODEL_FIELDS = ("model", "system_hints", "supported_encodings")
+REPLAY_HEADER = "X-Rag-Replay"
+
+
+def response_key(prompt, model_fields):
+    material = json.dumps([prompt, model_fields], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(material.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class CachedResponse:
+    __slots__ = ("status", "headers", "chunks")
+
+    def __init__(self, status, headers, chunks):
+        self.status = status
+        # [(name, value)], only the ones needed to replay the body as-is
+        self.headers = headers
+        # [(bytes, seconds since the previous chunk)]
+        self.chunks = chunks
+
+
+class ResponseCache:
+    """SSE response bodies on disk, keyed by rewritten prompt + model fields, LRU by size.
+
+    One file per entry: a JSON line with the status, headers and chunk lengths
+    and gaps, then the raw (possibly compressed) body. File mtimes carry the LRU
+    order across restarts. `get` and `put` read and write files of up to
+    several MB and are meant to run on a worker thread.
+    """
+
+    def __init__(self, directory, max_bytes=256 << 20):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        for path in sorted(self.directory.glob("*.sse"), key=lambda p: p.stat().st_mtime):
+            size = path.stat().st_size
+            self._entries[path.stem] = size
+            self.total_bytes += size
+        self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def has(self, key):
+        # The request hook's in-memory check; the hit itself is counted by get()
+        with self._lock:
+            if key in self._entries:
+                return True
+            self.misses += 1
+            return False
+
+    def _path(self, key):
+        return self.directory / f"{key}.sse"
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                # Evicted since has() passed
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+            os.utime(self._path(key))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Dropping unreadable cached response {key}: {e}")
+            self._forget(key)
+            self.misses += 1
+            return None
+        chunks = []
+        pos = 0
+        for length, gap in meta["chunks"]:
+            chunks.append((body[pos:pos + length], gap))
+            pos += length
+        self.hits += 1
+        return CachedResponse(meta["status"], meta["headers"], chunks)
+
+    def put(self, key, response):
+        body = b"".join(chunk for chunk, _ in response.chunks)
+        meta = {
+            "status": response.status,
+            "headers": response.headers,
+            "chunks": [(len(chunk), round(gap, 4)) for chunk, gap in response.chunks],
+            "created": time.time(),
+        }
+        data = json.dumps(meta).encode("utf-8") + b"\n" + body
+        if len(data) > self.max_bytes:
+            return False
+        path = self._path(key)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self.stores += 1
+            self._evict()
+        return True
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def _forget(self, key):
+        with self._lock:
+            self.total_bytes -= self._entries.pop(key, 0)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+
+class StreamRecorder:
+    """Wraps a `flow.response.stream` callable and keeps each chunk with its arrival gap.
+
+    Recording is abandoned once the body passes `max_bytes`; `on_complete`
+    gets the chunk list when mitmproxy signals the end of the stream.
+    """
+
+    def __init__(self, inner, on_complete, max_bytes=8 << 20):
+        self.inner = inner
+        self.on_complete = on_complete
+        self.max_bytes = max_bytes
+        self.chunks = []
+        self.size = 0
+        self._last = time.monotonic()
+
+    def __call__(self, chunk):
+        if self.chunks is not None:
+            now = time.monotonic()
+            if chunk:
+                self.chunks.append((chunk, now - self._last))
+                self.size += len(chunk)
+                if self.size > self.max_bytes:
+                    self.chunks = None
+            else:
+                self.on_complete(self.chunks)
+                self.chunks = None
+            self._last = now
+        return self.inner(chunk) if callable(self.inner) else chunk
+
+
+class ReplayServer:
+    """Local HTTP server on the proxy loop that streams cached responses.
+
+    The request hook reads a hit from the cache itself and `hold`s it here, then
+    redirects the flow with the returned token in the X-Rag-Replay header. An
+    eviction after that point cannot turn the hit into a 404. The reply goes
+    back through mitmproxy's normal streaming path, chunk by chunk with the
+    recorded gaps scaled by `speed` (0 sends it all at once). Held responses
+    that are never asked for expire after `hold_ttl` seconds.
+    """
+
+    def __init__(self, cache, host="127.0.0.1", port=0, speed=1.0, hold_ttl=60.0):
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.hold_ttl = hold_ttl
+        # token -> (response, monotonic time it was held), oldest first
+        self.held = collections.OrderedDict()
+        self.server = None
+
+    def hold(self, response):
+        now = time.monotonic()
+        while self.held and now - next(iter(self.held.values()))[1] > self.hold_ttl:
+            self.held.popitem(last=False)
+        token = secrets.token_hex(16)
+        self.held[token] = (response, now)
+        return token
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f"Response replay server on {self.host}:{self.port}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+            headers = {}
+            for line in head.decode("latin-1").split("\r\n")[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length:
+                await reader.readexactly(length)
+            response, _ = self.held.pop(headers.get(REPLAY_HEADER.lower(), ""), (None, None))
+            if response is None:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+            lines = [f"HTTP/1.1 {response.status} OK"]
+            lines += [f"{name}: {value}" for name, value in response.headers]
+            lines += ["Transfer-Encoding: chunked", "Connection: close", "X-Rag-Cache: hit", "", ""]
+            writer.write("\r\n".join(lines).encode("latin-1"))
+            for chunk, gap in response.chunks:
+                if self.speed and gap > 0.0005:
+                    await asyncio.sleep(gap / self.speed)
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
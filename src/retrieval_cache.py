@@ -0,0 +1,82 @@
+# retrieval_cache.py
+
+import collections
+import hashlib
+import time
+
+
+def normalize_prompt(prompt):
+    # Case and whitespace differences shouldn't cost another retrieval
+    return " ".join(prompt.casefold().split())
+
+
+def prompt_key(prompt, tenant=None):
+    h = hashlib.blake2b(normalize_prompt(prompt).encode("utf-8"), digest_size=16)
+    if tenant is not None:
+        # Same prompt, different corpus: never share context across tenants
+        h.update(b"\0" + tenant.encode("utf-8"))
+    return h.digest()
+
+
+class RetrievalCache:
+    """Bounded LRU of packed context, keyed on the normalized prompt, with a TTL."""
+
+    def __init__(self, max_entries=1024, ttl=300.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, prompt, tenant=None):
+        key = prompt_key(prompt, tenant)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def has(self, prompt, tenant=None):
+        # A lookup that doesn't count towards the hit rate or the LRU order
+        entry = self._entries.get(prompt_key(prompt, tenant))
+        return entry is not None and entry[0] > self.clock()
+
+    def put(self, prompt, value, tenant=None):
+        key = prompt_key(prompt, tenant)
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self):
+        # Call whenever the corpus behind the providers changes
+        self._entries.clear()
+        self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
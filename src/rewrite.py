@@ -0,0 +1,191 @@
+# rewrite.py
+
+import json
+import re
+
+PROMPT_PATH = ("messages", 0, "content", "parts", 0)
+
+# A string of any length is skipped with one regex match; a container costs one
+# Python step per bracket or string inside it, never a decode
+_STRING_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+# Inside a container only strings and brackets matter; strings are consumed whole
+_TOKEN_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]', re.S)
+_SCALAR_RE = re.compile(rb'[^,\]}\s]+')
+_WS_RE = re.compile(rb'[ \t\r\n]*')
+
+
+class ShapeError(ValueError):
+    pass
+
+
+def _ws(buf, pos):
+    return _WS_RE.match(buf, pos).end()
+
+
+def _skip_value(buf, pos):
+    ch = buf[pos:pos + 1]
+    if ch == b'"':
+        m = _STRING_RE.match(buf, pos)
+        if m is None:
+            raise ShapeError("unterminated string")
+        return m.end()
+    if ch in (b"{", b"["):
+        depth = 0
+        for m in _TOKEN_RE.finditer(buf, pos):
+            c = buf[m.start()]
+            if c == 0x22:  # '"'
+                continue
+            depth += 1 if c in (0x7B, 0x5B) else -1
+            if depth == 0:
+                return m.end()
+        raise ShapeError("unterminated container")
+    m = _SCALAR_RE.match(buf, pos)
+    if m is None:
+        raise ShapeError(f"unexpected byte at {pos}")
+    return m.end()
+
+
+def _member(buf, pos, key):
+    # pos is at '{'; returns the start of `key`'s value or None
+    encoded = json.dumps(key).encode("utf-8")
+    pos = _ws(buf, pos + 1)
+    if buf[pos:pos + 1] == b"}":
+        return None
+    while True:
+        end = _skip_value(buf, pos)
+        name = buf[pos:end]
+        if name != encoded and b"\\" in name:
+            name = json.dumps(json.loads(name)).encode("utf-8")
+        pos = _ws(buf, end)
+        if buf[pos:pos + 1] != b":":
+            raise ShapeError("expected ':'")
+        pos = _ws(buf, pos + 1)
+        if name == encoded:
+            return pos
+        pos = _ws(buf, _skip_value(buf, pos))
+        sep = buf[pos:pos + 1]
+        if sep == b"}":
+            return None
+        if sep != b",":
+            raise ShapeError("expected ',' or '}'")
+        pos = _ws(buf, pos + 1)
+
+
+def _element(buf, pos, index):
+    # pos is at '['; returns the start of element `index` or None
+    pos = _ws(buf, pos + 1)
+    if buf[pos:pos + 1] == b"]":
+        return None
+    for _ in range(index):
+        pos = _ws(buf, _skip_value(buf, pos))
+        sep = buf[pos:pos + 1]
+        if sep == b"]":
+            return None
+        if sep != b",":
+            raise ShapeError("expected ',' or ']'")
+        pos = _ws(buf, pos + 1)
+    return pos
+
+
+def find_value(buf, path):
+    """Byte span (start, end) of the JSON value at `path`, or None if it isn't there.
+
+    Only the containers along the path are walked; everything else is skipped
+    without being decoded.
+    """
+    pos = _ws(buf, 0)
+    for key in path:
+        opener = buf[pos:pos + 1]
+        if isinstance(key, str):
+            if opener != b"{":
+                return None
+            pos = _member(buf, pos, key)
+        else:
+            if opener != b"[":
+                return None
+            pos = _element(buf, pos, key)
+        if pos is None:
+            return None
+    return pos, _skip_value(buf, pos)
+
+
+def read_value(buf, path, default=None):
+    span = find_value(buf, path)
+    if span is None:
+        return default
+    return json.loads(buf[span[0]:span[1]])
+
+
+class PromptRewrite:
+    """Reads `messages[0].content.parts[0]` out of a request body and splices a new one in.
+
+    The fast path decodes only the prompt string and copies the rest of the body
+    byte for byte. If the body doesn't have the expected shape (for example the
+    first part is an image pointer) it falls back to a full parse and rewrites
+    the first text part instead.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.payload = None
+        self.fast = True
+        try:
+            span = find_value(body, PROMPT_PATH)
+        except (ShapeError, ValueError):
+            span = None
+        if span is not None and body[span[0]:span[0] + 1] == b'"':
+            self.span = span
+            self.prompt = json.loads(body[span[0]:span[1]])
+        else:
+            self._parse_fully()
+
+    def _parse_fully(self):
+        self.fast = False
+        self.payload = json.loads(self.body)
+        parts = self.payload["messages"][0]["content"]["parts"]
+        for i, part in enumerate(parts):
+            if isinstance(part, str):
+                self.part_index = i
+                self.prompt = part
+                return
+        raise KeyError("no text part in messages[0]")
+
+    @property
+    def conversation_id(self):
+        if self.payload is not None:
+            return self.payload.get("conversation_id")
+        try:
+            return read_value(self.body, ("conversation_id",))
+        except (ShapeError, ValueError):
+            return None
+
+    @property
+    def message_id(self):
+        if self.payload is not None:
+            return self.payload["messages"][0].get("id")
+        try:
+            return read_value(self.body, ("messages", 0, "id"))
+        except (ShapeError, ValueError):
+            return None
+
+    def read(self, path, default=None):
+        # Any other field of the request, e.g. ("model",), without a full parse
+        if self.payload is not None:
+            value = self.payload
+            for key in path:
+                try:
+                    value = value[key]
+                except (KeyError, IndexError, TypeError):
+                    return default
+            return value
+        try:
+            return read_value(self.body, path, default)
+        except (ShapeError, ValueError):
+            return default
+
+    def apply(self, new_prompt):
+        if self.fast:
+            start, end = self.span
+            return b"".join((self.body[:start], json.dumps(new_prompt).encode("utf-8"), self.body[end:]))
+        self.payload["messages"][0]["content"]["parts"][self.part_index] = new_prompt
+        return json.dumps(self.payload).encode("utf-8")
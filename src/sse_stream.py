@@ -0,0 +1,277 @@
+# sse_stream.py
+
+import json
+import logging
+import zlib
+
+
+class SSEParser:
+    """Incremental text/event-stream parser that works directly on bytes."""
+
+    def __init__(self):
+        # Only the unterminated tail of the current line is ever buffered
+        self._line = bytearray()
+        self._event = b""
+        self._data = []
+        self._after_cr = False
+
+    def feed(self, chunk):
+        events = []
+        start = 0
+        n = len(chunk)
+
+        # A CRLF split across two chunks: drop the LF we already handled
+        if self._after_cr and n and chunk[0] == 0x0A:
+            start = 1
+        self._after_cr = False
+
+        while start < n:
+            lf = chunk.find(b"\n", start)
+            cr = chunk.find(b"\r", start, lf if lf != -1 else n)
+            end = cr if cr != -1 else lf
+            if end == -1:
+                self._line += chunk[start:]
+                break
+
+            if self._line:
+                self._line += chunk[start:end]
+                line = bytes(self._line)
+                self._line.clear()
+            else:
+                line = chunk[start:end]
+
+            start = end + 1
+            if end == cr:
+                if start < n:
+                    if chunk[start] == 0x0A:
+                        start += 1
+                else:
+                    self._after_cr = True
+
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def close(self):
+        # Flush a final event that wasn't followed by a blank line
+        events = []
+        if self._line:
+            event = self._process_line(bytes(self._line))
+            self._line.clear()
+            if event is not None:
+                events.append(event)
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line):
+        if not line:
+            return self._dispatch()
+        if line[0] == 0x3A:  # ':' starts a comment
+            return None
+
+        colon = line.find(b":")
+        if colon == -1:
+            field, value = line, b""
+        else:
+            field = line[:colon]
+            value = line[colon + 1:]
+            if value[:1] == b" ":
+                value = value[1:]
+
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value
+        return None
+
+    def _dispatch(self):
+        if not self._data:
+            self._event = b""
+            return None
+        event = self._event.decode("utf-8", "replace") or "message"
+        data = b"\n".join(self._data).decode("utf-8", "replace")
+        self._event = b""
+        self._data = []
+        return event, data
+
+
+class ConversationStreamAssembler:
+    """Rebuilds the assistant message from ChatGPT's `delta` patch stream."""
+
+    def __init__(self):
+        self.messages = {}
+        self.conversation_id = None
+        self.done = False
+        self._current = 0
+        self._last_path = None
+        self._last_op = None
+
+    def feed_event(self, event, data):
+        if self.done:
+            return
+        if data == "[DONE]":
+            self.done = True
+            return
+        try:
+            payload = json.loads(data)
+        except json.JSONDecodeError:
+            return
+
+        if event == "delta":
+            self._apply_delta(payload)
+        elif isinstance(payload, dict):
+            if payload.get("conversation_id"):
+                self.conversation_id = payload["conversation_id"]
+            # Older, non-delta streams send the full message every time
+            if isinstance(payload.get("message"), dict):
+                self.messages[self._current] = payload
+
+    def _apply_delta(self, delta):
+        if not isinstance(delta, dict):
+            return
+        if "c" in delta:
+            self._current = delta["c"]
+
+        # A bare {"v": ...} repeats the previous path and operation
+        path = delta.get("p", self._last_path)
+        op = delta.get("o", self._last_op)
+        if path is None:
+            path = ""
+        if op is None:
+            op = "append" if path else "add"
+        self._last_path, self._last_op = path, op
+
+        if op == "patch":
+            for change in delta.get("v") or ():
+                if isinstance(change, dict):
+                    self._apply_op(change.get("p", ""), change.get("o", "replace"), change.get("v"))
+        else:
+            self._apply_op(path, op, delta.get("v"))
+
+    def _apply_op(self, path, op, value):
+        if path == "":
+            if op in ("add", "replace") and isinstance(value, dict):
+                self.messages[self._current] = value
+                if value.get("conversation_id"):
+                    self.conversation_id = value["conversation_id"]
+            return
+
+        doc = self.messages.get(self._current)
+        if doc is None:
+            return
+        keys = path.strip("/").split("/")
+        parent = doc
+        try:
+            for key in keys[:-1]:
+                parent = parent[int(key)] if isinstance(parent, list) else parent.setdefault(key, {})
+            last = keys[-1]
+            if isinstance(parent, list):
+                last = int(last)
+                if last == len(parent) and op in ("add", "append"):
+                    parent.append(value if op == "add" else _empty_like(value))
+
+            if op == "append":
+                current = parent[last] if _has(parent, last) else _empty_like(value)
+                parent[last] = current + value
+            elif op in ("add", "replace"):
+                parent[last] = value
+            elif op == "truncate":
+                parent[last] = parent[last][:value]
+            elif op == "remove":
+                del parent[last]
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logging.debug(f"Skipping delta {op} {path}: {e}")
+
+    def final_text(self):
+        chosen = None
+        for index in sorted(self.messages):
+            message = self.messages[index].get("message") or {}
+            role = (message.get("author") or {}).get("role")
+            if role == "assistant" or chosen is None:
+                chosen = message
+        if chosen is None:
+            return ""
+        parts = (chosen.get("content") or {}).get("parts") or []
+        return "".join(p for p in parts if isinstance(p, str))
+
+    def message_id(self):
+        for index in sorted(self.messages, reverse=True):
+            message = self.messages[index].get("message") or {}
+            if (message.get("author") or {}).get("role") == "assistant":
+                return message.get("id")
+        return None
+
+
+def _has(container, key):
+    if isinstance(container, list):
+        return 0 <= key < len(container)
+    return key in container
+
+
+def _empty_like(value):
+    if isinstance(value, list):
+        return []
+    return "" if isinstance(value, str) else value
+
+
+def _make_decoder(content_encoding):
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return lambda chunk: chunk
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    if encoding == "deflate":
+        return zlib.decompressobj().decompress
+    if encoding == "br":
+        import brotli
+        return brotli.Decompressor().process
+    if encoding == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+    return None
+
+
+class ConversationStreamTap:
+    """`flow.response.stream` callable: forwards chunks untouched while parsing them."""
+
+    def __init__(self, on_done, content_encoding=None, on_first_text=None):
+        self.parser = SSEParser()
+        self.assembler = ConversationStreamAssembler()
+        self.on_done = on_done
+        # Called once, with the assembler, as soon as the reply has any text
+        self.on_first_text = on_first_text
+        self.bytes_seen = 0
+        self._decode = _make_decoder(content_encoding)
+        self._reported = False
+        if self._decode is None:
+            logging.warning(f"Unsupported Content-Encoding {content_encoding!r}, not parsing stream")
+
+    def __call__(self, chunk):
+        if self._decode is not None and not self._reported:
+            try:
+                self._feed(chunk)
+            except Exception as e:
+                logging.error(f"Error parsing response stream: {e}")
+                self._decode = None
+        return chunk
+
+    def _feed(self, chunk):
+        self.bytes_seen += len(chunk)
+        if chunk:
+            events = self.parser.feed(self._decode(chunk))
+        else:
+            # mitmproxy signals end-of-stream with an empty chunk
+            events = self.parser.close()
+        for event, data in events:
+            self.assembler.feed_event(event, data)
+            if self.assembler.done:
+                break
+        if self.on_first_text is not None and events and self.assembler.final_text():
+            self.on_first_text(self.assembler)
+            self.on_first_text = None
+        if self.assembler.done or not chunk:
+            self._reported = True
+            self.on_done(self.assembler)
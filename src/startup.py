@@ -0,0 +1,61 @@
+# startup.py
+
+import logging
+import threading
+import time
+
+
+class StartupTimer:
+    """Wall-clock phases of application startup, possibly overlapping across threads.
+
+    Create it first thing in `main` so every offset is relative to process start,
+    wrap each phase in `with timer.phase(name):`, `mark()` instants such as the
+    proxy listening, and call `report()` once the first page has loaded.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def mark(self, name):
+        # A zero-length phase, for events like "proxy listening"
+        now = time.perf_counter() - self.origin
+        with self.lock:
+            self.phases.append((name, threading.current_thread().name, now, now))
+
+    def _record(self, name, start, end):
+        with self.lock:
+            self.phases.append((name, threading.current_thread().name, start - self.origin, end - self.origin))
+
+    def elapsed(self):
+        return time.perf_counter() - self.origin
+
+    def report(self):
+        lines = [f"Startup timing ({self.elapsed() * 1000:.0f} ms total):"]
+        for name, thread, start, end in sorted(self.phases, key=lambda p: p[2]):
+            lines.append(
+                f"  {start * 1000:7.0f} ms  +{(end - start) * 1000:6.0f} ms  {name} [{thread}]"
+            )
+        report = "\n".join(lines)
+        logging.info(report)
+        return report
+
+
+class _Phase:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer._record(self.name, self.start, time.perf_counter())
+        return False
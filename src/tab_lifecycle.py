@@ -0,0 +1,199 @@
+# tab_lifecycle.py
+
+import logging
+import os
+import time
+
+from PySide6.QtCore import QObject, QTimer
+from PySide6.QtWebEngineCore import QWebEnginePage
+
+Lifecycle = QWebEnginePage.LifecycleState
+
+FREEZE_AFTER = 300.0
+MEMORY_BUDGET_MB = 2048
+CHECK_INTERVAL_MS = 15000
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_STATE_MARKS = {Lifecycle.Active: "", Lifecycle.Frozen: "❄ ", Lifecycle.Discarded: "⏾ "}
+
+
+def renderer_usage(pid):
+    # (RSS bytes, CPU seconds) of a renderer process, from /proc; None where unavailable
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            rss = int(f.read().split()[1]) * _PAGE_SIZE
+        with open(f"/proc/{pid}/stat") as f:
+            # Fields after the parenthesised command name; utime and stime are 14 and 15
+            fields = f.read().rpartition(")")[2].split()
+        return rss, (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class TabState:
+    __slots__ = ("view", "title", "last_active")
+
+    def __init__(self, view):
+        self.view = view
+        self.title = "New Tab"
+        self.last_active = time.monotonic()
+
+
+class TabLifecycleManager(QObject):
+    """Freezes idle background tabs and discards them under a renderer memory budget.
+
+    Every check, a background tab idle for `freeze_after` seconds is frozen
+    (timers and network polling stop, memory is kept) if Qt recommends it, and
+    while the renderers together use more than `memory_budget_mb`, the least
+    recently used background tabs are discarded (renderer memory released).
+    A discarded tab keeps its URL, history and title; it reloads only when it is
+    selected again. Per-tab renderer RSS and CPU go to the tab tooltips, and
+    the totals to `on_stats`, e.g. a status bar.
+    """
+
+    def __init__(self, tabs, freeze_after=FREEZE_AFTER, memory_budget_mb=MEMORY_BUDGET_MB,
+                 interval_ms=CHECK_INTERVAL_MS, on_stats=None, parent=None):
+        super().__init__(parent)
+        self.tabs = tabs
+        self.freeze_after = freeze_after
+        self.memory_budget = memory_budget_mb << 20
+        self.on_stats = on_stats
+        self.states = {}
+        # pid -> (RSS bytes, CPU share) of each renderer at the last check
+        self.renderers = {}
+        self._cpu = {}
+        self._current = None
+        self.frozen = 0
+        self.discarded = 0
+        self._last_check = time.monotonic()
+        self.tabs.currentChanged.connect(self.activate)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.check)
+        self.timer.start(interval_ms)
+
+    def add(self, view):
+        state = TabState(view)
+        self.states[view] = state
+        view.titleChanged.connect(lambda title, view=view: self.set_title(view, title))
+        view.page().lifecycleStateChanged.connect(lambda _, view=view: self.refresh_label(view))
+        return state
+
+    def remove(self, view):
+        self.states.pop(view, None)
+
+    def set_title(self, view, title):
+        state = self.states.get(view)
+        # A discarded page reports an empty title until it is reloaded
+        if state is not None and title:
+            state.title = title
+            self.refresh_label(view)
+
+    def refresh_label(self, view):
+        state = self.states.get(view)
+        index = self.tabs.indexOf(view)
+        if state is None or index < 0:
+            return
+        lifecycle = view.page().lifecycleState()
+        self.tabs.setTabText(index, _STATE_MARKS.get(lifecycle, "") + state.title)
+        renderer = self.renderers.get(view.page().renderProcessPid())
+        usage = f"{renderer[0] / 1e6:.0f} MB, {renderer[1] * 100:.1f}% CPU" if renderer else "no renderer"
+        self.tabs.setTabToolTip(index, f"{state.title}\n{lifecycle.name}: {usage}")
+
+    def activate(self, index):
+        now = time.monotonic()
+        # The idle clock of the tab being left starts now
+        if self._current in self.states:
+            self.states[self._current].last_active = now
+        view = self._current = self.tabs.widget(index)
+        state = self.states.get(view)
+        if state is None:
+            return
+        state.last_active = now
+        page = view.page()
+        previous = page.lifecycleState()
+        if previous != Lifecycle.Active:
+            # Lazy restore: a discarded page reloads its URL only now
+            page.setLifecycleState(Lifecycle.Active)
+            logging.info(f"Restored tab {state.title!r} from {previous.name}")
+
+    def check(self):
+        now = time.monotonic()
+        elapsed = max(now - self._last_check, 1e-6)
+        self._last_check = now
+        current = self.tabs.currentWidget()
+        if current in self.states:
+            self.states[current].last_active = now
+
+        # Tabs of the same site can share a renderer, so usage is sampled per process
+        renderers = {}
+        cpu_totals = {}
+        for view in self.states:
+            pid = view.page().renderProcessPid()
+            if pid in renderers:
+                continue
+            usage = renderer_usage(pid)
+            if usage is not None:
+                rss, cpu = usage
+                previous = self._cpu.get(pid)
+                renderers[pid] = (rss, (cpu - previous) / elapsed if previous is not None else 0.0)
+                cpu_totals[pid] = cpu
+        self.renderers = renderers
+        self._cpu = cpu_totals
+
+        for view, state in self.states.items():
+            page = view.page()
+            if view is current or page.lifecycleState() != Lifecycle.Active:
+                continue
+            if now - state.last_active >= self.freeze_after and page.recommendedState() != Lifecycle.Active:
+                page.setLifecycleState(Lifecycle.Frozen)
+                self.frozen += 1
+                logging.info(f"Froze tab {state.title!r} after {now - state.last_active:.0f}s idle")
+
+        resident = {pid: rss for pid, (rss, _) in renderers.items()}
+        total = sum(resident.values())
+        if total > self.memory_budget:
+            background = sorted((s for v, s in self.states.items() if v is not current), key=lambda s: s.last_active)
+            for state in background:
+                if total <= self.memory_budget:
+                    break
+                page = state.view.page()
+                if page.lifecycleState() == Lifecycle.Discarded:
+                    continue
+                pid = page.renderProcessPid()
+                # Only a renderer no other tab uses is actually released
+                if sum(1 for v in self.states if v.page().renderProcessPid() == pid) == 1:
+                    total -= resident.pop(pid, 0)
+                if page.lifecycleState() == Lifecycle.Active:
+                    page.setLifecycleState(Lifecycle.Frozen)
+                page.setLifecycleState(Lifecycle.Discarded)
+                self.discarded += 1
+                logging.info(f"Discarded tab {state.title!r} to stay under {self.memory_budget >> 20} MB")
+
+        for view in self.states:
+            self.refresh_label(view)
+        if self.on_stats is not None:
+            self.on_stats(self.stats())
+
+    def stats(self):
+        counts = {Lifecycle.Active: 0, Lifecycle.Frozen: 0, Lifecycle.Discarded: 0}
+        for view in self.states:
+            counts[view.page().lifecycleState()] += 1
+        return {
+            "tabs": len(self.states),
+            "active": counts[Lifecycle.Active],
+            "frozen": counts[Lifecycle.Frozen],
+            "discarded": counts[Lifecycle.Discarded],
+            "renderer_mb": sum(rss for rss, _ in self.renderers.values()) / 1e6,
+            "cpu_percent": sum(rate for _, rate in self.renderers.values()) * 100,
+            "freezes": self.frozen,
+            "discards": self.discarded,
+        }
+
+
+def format_stats(stats):
+    return (f"{stats['tabs']} tabs: {stats['active']} active, {stats['frozen']} frozen, "
+            f"{stats['discarded']} discarded | renderers {stats['renderer_mb']:.0f} MB, "
+            f"{stats['cpu_percent']:.1f}% CPU")
@@ -0,0 +1,141 @@
+# templates.py
+
+import json
+import logging
+import os
+import string
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_TEMPLATE = "{context} Prompt: {prompt}"
+SLOTS = ("prompt", "context", "memory", "preferences")
+
+
+class CompiledTemplate:
+    """An injection template turned into one generated function, once, at load time.
+
+    Slots are `{prompt}`, `{context}`, `{memory}` and `{preferences}`; `{{`/`}}`
+    are literal braces. Rendering is a single string concatenation. When the
+    template has no `{memory}` slot, recalled memory is folded into `{context}`.
+    """
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        parts = []
+        slots = set()
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            if literal:
+                parts.append(repr(literal))
+            if field is None:
+                continue
+            if field not in SLOTS or spec or conversion:
+                raise ValueError(f"Template {name!r}: unsupported slot {{{field}}}; use one of {', '.join(SLOTS)}")
+            parts.append(field)
+            slots.add(field)
+        if "prompt" not in slots:
+            raise ValueError(f"Template {name!r} has no {{prompt}} slot, the user's prompt would be dropped")
+        self.slots = frozenset(slots)
+        # Literals are repr()'d and slot names are from SLOTS, so the generated code is just a concatenation
+        code = f"def render(prompt, context, memory, preferences):\n    return {' + '.join(parts) or repr('')}\n"
+        namespace = {}
+        exec(compile(code, f"<template {name}>", "exec"), namespace)
+        self._render = namespace["render"]
+
+    def render(self, prompt, context="", memory="", preferences=""):
+        if "memory" not in self.slots and memory:
+            context = f"{memory}\n{context}" if context else memory
+        return self._render(prompt, context, memory, preferences)
+
+    def __repr__(self):
+        return f"CompiledTemplate({self.name!r})"
+
+
+class TemplateSet:
+    """Compiled templates plus which route uses which, replaced as a whole on reload.
+
+    Config file (JSON):
+        {"templates": {"default": "{context} Prompt: {prompt}", ...},
+         "routes": {"<route name>": "<template name>"},
+         "preferences": "text" or {"default": "text", "<tenant>": "text"}}
+    Routes without an entry use "default".
+    """
+
+    def __init__(self, templates, routes=None, preferences=None, version=0):
+        self.templates = templates
+        self.routes = dict(routes or {})
+        self.preferences = preferences if isinstance(preferences, dict) else {"default": preferences or ""}
+        self.version = version
+        self.default = templates["default"]
+        for route, name in self.routes.items():
+            if name not in templates:
+                raise ValueError(f"Route {route!r} uses unknown template {name!r}")
+
+    @classmethod
+    def builtin(cls):
+        return cls({"default": CompiledTemplate("default", DEFAULT_TEMPLATE)})
+
+    @classmethod
+    def load(cls, path, version=0):
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        sources = dict(config.get("templates", {}))
+        sources.setdefault("default", DEFAULT_TEMPLATE)
+        templates = {name: CompiledTemplate(name, source) for name, source in sources.items()}
+        return cls(templates, config.get("routes"), config.get("preferences"), version)
+
+    def for_route(self, route):
+        name = self.routes.get(route.name) if route is not None else None
+        return self.templates[name] if name is not None else self.default
+
+    def preferences_for(self, tenant=None):
+        if tenant is not None and tenant in self.preferences:
+            return self.preferences[tenant]
+        return self.preferences.get("default", "")
+
+
+class TemplateWatcher(threading.Thread):
+    """Polls a template config file and publishes a freshly compiled TemplateSet on change.
+
+    Parsing and compiling happen on this thread; `on_publish(template_set)` is
+    expected to swap the reference on the proxy loop. A file that fails to load
+    is logged and the previous templates stay in place.
+    """
+
+    def __init__(self, path, on_publish, interval=1.0):
+        super().__init__(daemon=True, name="template-watcher")
+        self.path = Path(path)
+        self.on_publish = on_publish
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.version = 0
+        self._stamp = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def run(self):
+        logging.info(f"Watching {self.path} for template changes")
+        while not self.stop_event.wait(self.interval):
+            stamp = self._stat()
+            if stamp is None or stamp == self._stamp:
+                continue
+            self._stamp = stamp
+            start = time.perf_counter()
+            try:
+                templates = TemplateSet.load(self.path, self.version + 1)
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                logging.error(f"Keeping current templates, {self.path} failed to load: {e}")
+                continue
+            self.version = templates.version
+            logging.info(f"Compiled {len(templates.templates)} templates (v{self.version}) "
+                         f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+            self.on_publish(templates)
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,255 @@
+# tenants.py
+
+import asyncio
+import base64
+import binascii
+import collections
+import logging
+import os
+import re
+import time
+import weakref
+from pathlib import Path
+
+from context_providers import ContextProvider
+
+TENANT_HEADER = "X-Rag-Tenant"
+DEFAULT_TENANT = "default"
+
+# Tenant names become directory names under the shard root
+_TENANT_RE = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}")
+# Files a shard keeps mapped while open; chunks.jsonl is read through a file handle
+_MAPPED_SUFFIXES = (".bin", ".idx", ".npy")
+
+
+def valid_tenant(name):
+    return bool(name) and _TENANT_RE.fullmatch(name) is not None
+
+
+def process_rss():
+    # Resident set size in bytes, or None where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class TenantResolver:
+    """Picks the tenant of a flow.
+
+    In order: the X-Rag-Tenant header (set by the browser profile), the user name
+    of a Basic Proxy-Authorization (on the CONNECT for HTTPS, so it is remembered
+    per client connection), then the proxy port the client connected to. Anything
+    else, or a name that is not a valid directory name, gets `default`.
+    """
+
+    def __init__(self, port_map=None, default=DEFAULT_TENANT, header=TENANT_HEADER):
+        self.port_map = dict(port_map or {})
+        self.default = default
+        self.header = header
+        self._connections = weakref.WeakKeyDictionary()
+
+    def http_connect(self, flow):
+        tenant = self._from_proxy_auth(flow.request.headers)
+        if tenant is not None:
+            self._connections[flow.client_conn] = tenant
+
+    def resolve(self, flow):
+        # The header is ours, never the upstream's
+        tenant = flow.request.headers.pop(self.header, None)
+        if tenant is None:
+            tenant = self._from_proxy_auth(flow.request.headers)
+            if tenant is not None:
+                flow.request.headers.pop("Proxy-Authorization", None)
+        if tenant is None:
+            tenant = self._connections.get(flow.client_conn)
+        if tenant is None and flow.client_conn.sockname:
+            tenant = self.port_map.get(flow.client_conn.sockname[1])
+        return tenant if valid_tenant(tenant) else self.default
+
+    @staticmethod
+    def _from_proxy_auth(headers):
+        scheme, _, credentials = headers.get("Proxy-Authorization", "").partition(" ")
+        if scheme.lower() != "basic":
+            return None
+        try:
+            user = base64.b64decode(credentials, validate=True).decode("utf-8").partition(":")[0]
+        except (binascii.Error, UnicodeDecodeError):
+            return None
+        return user or None
+
+
+def parse_port_map(spec):
+    # "8081=alice,8082=bob" -> {8081: "alice", 8082: "bob"}
+    port_map = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        port, _, tenant = item.partition("=")
+        port_map[int(port)] = tenant.strip()
+    return port_map
+
+
+class Shard:
+    __slots__ = ("tenant", "provider", "mapped_bytes", "opened_at", "hits", "leases", "retired")
+
+    def __init__(self, tenant, provider, mapped_bytes):
+        self.tenant = tenant
+        self.provider = provider
+        self.mapped_bytes = mapped_bytes
+        self.opened_at = time.monotonic()
+        self.hits = 0
+        # Searches running against this shard; it is not closed while any are
+        self.leases = 0
+        # Dropped from the open set while leased; the last release closes it
+        self.retired = False
+
+
+class ShardedIndex:
+    """One vector index per tenant under `root/<tenant>/`, opened on first use.
+
+    Shards are memory-mapped, so what an open shard can pin in RAM is the size of
+    its mapped files; the open set is kept under `rss_budget` bytes of those by
+    closing the least recently used shards. A shard larger than the whole budget
+    is still opened, alone. Shards are opened on a worker thread, and a shard is
+    leased for as long as a search runs against it, so eviction skips it and
+    `invalidate` defers its close to the last `release`. Opens and evictions are
+    logged at INFO with the process RSS, hits at DEBUG; `stats()` has the totals.
+    """
+
+    def __init__(self, root, rss_budget=1 << 30, open_shard=None):
+        self.root = Path(root)
+        self.rss_budget = rss_budget
+        self.open_shard = open_shard or open_store_provider
+        self.shards = collections.OrderedDict()
+        # tenant -> task opening its shard, shared by every request that arrives meanwhile
+        self.opening = {}
+        self.mapped_bytes = 0
+        self.opens = 0
+        self.hits = 0
+        self.evictions = 0
+        self.missing = 0
+
+    def __len__(self):
+        return len(self.shards)
+
+    async def acquire(self, tenant):
+        # The tenant's shard, leased until release(); None when the tenant has no index
+        shard = self.shards.get(tenant)
+        if shard is not None:
+            self.shards.move_to_end(tenant)
+            shard.hits += 1
+            self.hits += 1
+            logging.debug(f"Tenant shard hit: {tenant} ({shard.hits} hits)")
+        else:
+            opening = self.opening.get(tenant)
+            if opening is None:
+                path = self.root / tenant
+                if not valid_tenant(tenant) or not (path / "index.json").exists():
+                    self.missing += 1
+                    return None
+                opening = self.opening[tenant] = asyncio.ensure_future(self._open(tenant, path))
+                opening.add_done_callback(lambda _: self.opening.pop(tenant, None))
+            # A request that times out must not cancel the open the others are waiting on
+            shard = await asyncio.shield(opening)
+        shard.leases += 1
+        return shard
+
+    def release(self, shard):
+        shard.leases -= 1
+        if not shard.leases and shard.retired:
+            self._close(shard)
+
+    async def _open(self, tenant, path):
+        start = time.perf_counter()
+        # Opening reads the header, the BM25 vocabulary and the IVF fingerprint; none of it belongs on the loop
+        size, provider = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: (mapped_size(path), self.open_shard(path)))
+        self._evict(self.rss_budget - size)
+        shard = Shard(tenant, provider, size)
+        self.shards[tenant] = shard
+        self.mapped_bytes += size
+        self.opens += 1
+        logging.info(
+            f"Opened tenant shard {tenant}: {size / 1e6:.1f} MB mapped in {(time.perf_counter() - start) * 1000:.1f}ms "
+            f"({len(self.shards)} open, {self.mapped_bytes / 1e6:.1f} MB, rss={_mb(process_rss())})"
+        )
+        return shard
+
+    def _evict(self, limit):
+        # Least recently used first; a leased shard has a search running and stays open
+        for tenant in [tenant for tenant, shard in self.shards.items() if not shard.leases]:
+            if self.mapped_bytes <= max(limit, 0):
+                break
+            shard = self.shards.pop(tenant)
+            self._close(shard)
+            self.evictions += 1
+            logging.info(
+                f"Evicted tenant shard {tenant} after {shard.hits} hits, {time.monotonic() - shard.opened_at:.0f}s open "
+                f"({len(self.shards)} open, {self.mapped_bytes / 1e6:.1f} MB, rss={_mb(process_rss())})"
+            )
+
+    def _close(self, shard):
+        self.mapped_bytes -= shard.mapped_bytes
+        store = getattr(shard.provider, "store", None)
+        if store is not None:
+            # Drops the memmaps; the pages go once nothing references them
+            store.close()
+
+    def invalidate(self, tenant):
+        # Call after a tenant's index was rebuilt; the next request reopens it
+        shard = self.shards.pop(tenant, None)
+        if shard is None:
+            return
+        if shard.leases:
+            shard.retired = True
+        else:
+            self._close(shard)
+        logging.info(f"Closed tenant shard {tenant} for reload")
+
+    def close(self):
+        while self.shards:
+            self._close(self.shards.popitem()[1])
+
+    def stats(self):
+        return {
+            "open": len(self.shards),
+            "mapped_bytes": self.mapped_bytes,
+            "opens": self.opens,
+            "hits": self.hits,
+            "evictions": self.evictions,
+            "missing": self.missing,
+            "rss": process_rss(),
+        }
+
+
+def mapped_size(path):
+    return sum(p.stat().st_size for p in Path(path).iterdir() if p.suffix in _MAPPED_SUFFIXES)
+
+
+def open_store_provider(path):
+    from mitmproxy_integration import store_provider
+    from vector_store import VectorStore
+    return store_provider(VectorStore.open(path))
+
+
+def _mb(size):
+    return "n/a" if size is None else f"{size / 1e6:.0f} MB"
+
+
+class TenantProvider(ContextProvider):
+    """Searches the shard of the query's tenant; a tenant without an index gets nothing."""
+
+    name = "tenants"
+
+    def __init__(self, index):
+        self.index = index
+
+    async def fetch(self, query):
+        shard = await self.index.acquire(query.tenant or DEFAULT_TENANT)
+        if shard is None:
+            return []
+        # The search runs on a worker thread that a timeout cannot stop, so the lease is
+        # released when the search itself finishes, not when this fetch is cancelled
+        search = asyncio.ensure_future(shard.provider.fetch(query))
+        search.add_done_callback(lambda _: self.index.release(shard))
+        return await asyncio.shield(search)
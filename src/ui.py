@@ -3,25 +3,53 @@
 from PySide6.QtGui import QAction
 from PySide6.QtWidgets import QMainWindow, QTabWidget, QToolBar, QLineEdit
 from PySide6.QtWebEngineWidgets import QWebEngineView
-from PySide6.QtWebEngineCore import QWebEnginePage
+from PySide6.QtWebEngineCore import QWebEnginePage, QWebEngineProfile, QWebEngineUrlRequestInterceptor
 from PySide6.QtCore import QUrl
+from routes import DEFAULT_ALLOWED_HOSTS
+from tenants import TENANT_HEADER
+from tab_lifecycle import FREEZE_AFTER, MEMORY_BUDGET_MB, TabLifecycleManager, format_stats
 
 class CustomWebEnginePage(QWebEnginePage):
     def certificateError(self, error):
         # Accept all SSL certificate errors
         return True
 
+class TenantHeaderInterceptor(QWebEngineUrlRequestInterceptor):
+    # Tags requests to intercepted hosts with the profile name; the proxy strips it again
+    def __init__(self, tenant, parent=None):
+        super().__init__(parent)
+        self.tenant = tenant.encode()
+        self.hosts = tuple(DEFAULT_ALLOWED_HOSTS.split(','))
+
+    def interceptRequest(self, info):
+        if info.requestUrl().host() in self.hosts:
+            info.setHttpHeader(TENANT_HEADER.encode(), self.tenant)
+
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, tenant=None, freeze_after=FREEZE_AFTER, memory_budget_mb=MEMORY_BUDGET_MB, tag_tenant=True):
         super(MainWindow, self).__init__()
         self.setWindowTitle('PyBrowser')
 
+        # A named profile per tenant: separate cookies/storage, and, when the proxy has
+        # per-tenant indexes (`tag_tenant`), the header it picks the index by
+        self.profile = None
+        if tenant:
+            self.profile = QWebEngineProfile(tenant, self)
+            if tag_tenant:
+                self.interceptor = TenantHeaderInterceptor(self.profile.storageName(), self)
+                self.profile.setUrlRequestInterceptor(self.interceptor)
+
         # Create tab widget
         self.tabs = QTabWidget()
         self.tabs.setTabsClosable(True)
         self.tabs.tabCloseRequested.connect(self.close_tab)
         self.setCentralWidget(self.tabs)
 
+        # Background tabs are frozen when idle and discarded under memory pressure
+        self.lifecycle = TabLifecycleManager(
+            self.tabs, freeze_after, memory_budget_mb,
+            on_stats=lambda stats: self.statusBar().showMessage(format_stats(stats)), parent=self)
+
         # Create toolbar
         toolbar = QToolBar()
         self.addToolBar(toolbar)
@@ -57,15 +85,15 @@ class MainWindow(QMainWindow):
 
     def add_tab(self):
         browser = QWebEngineView()
-        page = CustomWebEnginePage(browser)
+        page = CustomWebEnginePage(self.profile, browser) if self.profile else CustomWebEnginePage(browser)
         browser.setPage(page)
         browser.setUrl(QUrl('https://chat.openai.com'))
 
+        # Registered first so it sees the tab become current; it also keeps the tab title
+        self.lifecycle.add(browser)
         self.tabs.addTab(browser, 'New Tab')
         self.tabs.setCurrentWidget(browser)
 
-        browser.titleChanged.connect(
-            lambda title, browser=browser: self.tabs.setTabText(self.tabs.indexOf(browser), title))
         browser.urlChanged.connect(
             lambda url, browser=browser: self.update_url(url) if self.tabs.currentWidget() == browser else None)
 
@@ -74,6 +102,7 @@ class MainWindow(QMainWindow):
             self.close()
         else:
             browser_widget = self.tabs.widget(index)
+            self.lifecycle.remove(browser_widget)
             browser_widget.deleteLater()
             self.tabs.removeTab(index)
 
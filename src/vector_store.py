@@ -0,0 +1,436 @@
+# vector_store.py
+
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from context_providers import ContextChunk, ContextProvider
+
+logging.basicConfig(level=logging.INFO)
+
+TOKEN_RE = re.compile(r"\w+")
+FORMAT_VERSION = 1
+# Rows scored per block, so int8/float16 rows are widened a slice at a time
+SEARCH_BLOCK = 65536
+DATA_FILES = ("vectors.bin", "scales.bin", "chunks.jsonl", "chunks.idx")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+@functools.lru_cache(maxsize=65536)
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class HashingEmbedder:
+    """Offline embedder: signed feature hashing of unigrams and bigrams.
+
+    No model and no network. Quality is lexical rather than semantic, which is
+    enough to make the store useful until a real model is plugged in.
+    """
+
+    def __init__(self, dim=384, ngrams=2):
+        self.dim = dim
+        self.ngrams = ngrams
+
+    def config(self):
+        return {"type": "hashing", "dim": self.dim, "ngrams": self.ngrams}
+
+    def embed(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            features = list(tokens)
+            for n in range(2, self.ngrams + 1):
+                features.extend(" ".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+            for feature in features:
+                h = _feature_hash(feature)
+                out[row, h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+        # Sublinear term frequency, then unit length so dot product == cosine
+        np.copysign(np.log1p(np.abs(out)), out, out=out)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        out /= norms
+        return out
+
+
+def embedder_from_config(config):
+    if config.get("type") != "hashing":
+        raise ValueError(f"Unknown embedder type: {config.get('type')}")
+    return HashingEmbedder(dim=config["dim"], ngrams=config.get("ngrams", 2))
+
+
+def chunk_text(text, max_chars=800, overlap=100):
+    # Paragraph-aware windows; long paragraphs are split with a small overlap
+    chunks = []
+    current = ""
+    for para in re.split(r"\n\s*\n", text):
+        para = para.strip()
+        if not para:
+            continue
+        while len(para) > max_chars:
+            cut = para.rfind(" ", 0, max_chars)
+            cut = cut if cut > max_chars // 2 else max_chars
+            chunks.append(para[:cut].strip())
+            para = para[max(cut - overlap, 0):].strip()
+        if current and len(current) + len(para) + 2 > max_chars:
+            chunks.append(current)
+            current = para
+        else:
+            current = f"{current}\n\n{para}" if current else para
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def quantize(vectors, dtype):
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype == "int8":
+        # Symmetric per-row scale
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        q = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return q, scales.astype(np.float32)
+    raise ValueError(f"Unsupported dtype: {dtype}")
+
+
+class VectorStore:
+    """Chunk metadata plus a contiguous embedding matrix, opened with numpy.memmap.
+
+    Layout of an index directory:
+        index.json    header: count, dim, dtype, embedder config, deleted rows (written last)
+        vectors.bin   count x dim rows of float16 or int8
+        scales.bin    float32 per-row scales (int8 only)
+        chunks.jsonl  one metadata record per row
+        chunks.idx    uint64 byte offset of each record in chunks.jsonl
+
+    Rows are only ever appended. Removing a document tombstones its rows in the
+    header, and the header is replaced atomically after the data files are synced,
+    so an open store never sees a partially written batch.
+    """
+
+    def __init__(self, path, header):
+        self.path = Path(path)
+        self.header = header
+        self.count = header["count"]
+        self.dim = header["dim"]
+        self.dtype = header["dtype"]
+        self.embedder = embedder_from_config(header["embedder"])
+        self.deleted = np.asarray(sorted(header.get("deleted", ())), dtype=np.int64)
+        self.vectors = _memmap(self.path / "vectors.bin", self.dtype, (self.count, self.dim))
+        self.scales = None
+        if self.dtype == "int8":
+            self.scales = _memmap(self.path / "scales.bin", np.float32, (self.count,))
+        self.offsets = _memmap(self.path / "chunks.idx", np.uint64, (self.count,))
+        self._chunks_file = open(self.path / "chunks.jsonl", "rb")
+        # Providers read chunks from executor threads; a seek and its readline must not interleave
+        self._chunks_lock = threading.Lock()
+        # Approximate index over these rows (ivf_index.py), used by search() when present
+        self.ann = None
+
+    @property
+    def live_count(self):
+        return self.count - len(self.deleted)
+
+    @classmethod
+    def open(cls, path):
+        header = read_header(path)
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index version: {header.get('version')}")
+        store = cls(path, header)
+        if (store.path / "ivf.json").exists():
+            from ivf_index import IVFIndex
+            store.ann = IVFIndex.attach(store)
+        return store
+
+    @classmethod
+    def build(cls, path, records, embedder=None, dtype="float16", batch_size=256):
+        # records: iterable of dicts with at least "text"
+        create_index(path, embedder, dtype, overwrite=True)
+        append_records(path, records, batch_size)
+        return cls.open(path)
+
+    def close(self):
+        self._chunks_file.close()
+        self.vectors = self.scales = self.offsets = self.ann = None
+
+    def chunk(self, row):
+        with self._chunks_lock:
+            self._chunks_file.seek(int(self.offsets[row]))
+            line = self._chunks_file.readline()
+        return json.loads(line)
+
+    def search(self, queries, k=5, nprobe=None):
+        """Top-k rows for each query vector. Returns a list of (rows, scores) per query.
+
+        With an IVF index attached only `nprobe` of its lists are scanned (the
+        index's default when None); otherwise every row is.
+        """
+        if self.ann is not None:
+            return self.ann.search(queries, k, nprobe)
+        return self.search_exact(queries, k)
+
+    def search_exact(self, queries, k=5, first_row=0):
+        # Scores every row from `first_row` on
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.live_count <= 0 or first_row >= self.count:
+            empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+            return [empty for _ in queries]
+        k = min(k, self.count - first_row)
+        best_rows = None
+        best_scores = None
+        for start in range(first_row, self.count, SEARCH_BLOCK):
+            block = self.vectors[start:start + SEARCH_BLOCK]
+            scores = block.astype(np.float32) @ queries.T
+            if self.scales is not None:
+                scores *= self.scales[start:start + SEARCH_BLOCK, None]
+            if len(self.deleted):
+                lo, hi = np.searchsorted(self.deleted, [start, start + len(block)])
+                scores[self.deleted[lo:hi] - start] = -np.inf
+            rows = np.broadcast_to(np.arange(start, start + len(block))[:, None], scores.shape)
+            if best_scores is not None:
+                scores = np.concatenate([best_scores, scores])
+                rows = np.concatenate([best_rows, rows])
+            # Keep only the running top-k per query between blocks
+            if len(scores) > k:
+                keep = np.argpartition(-scores, k - 1, axis=0)[:k]
+                scores = np.take_along_axis(scores, keep, axis=0)
+                rows = np.take_along_axis(rows, keep, axis=0)
+            best_scores, best_rows = scores, rows
+
+        results = []
+        for q in range(len(queries)):
+            order = np.argsort(-best_scores[:, q])
+            order = order[np.isfinite(best_scores[order, q])]
+            results.append((best_rows[order, q], best_scores[order, q]))
+        return results
+
+    def query(self, text, k=5, nprobe=None):
+        rows, scores = self.search(self.embedder.embed([text]), k, nprobe)[0]
+        return [(self.chunk(row), float(score)) for row, score in zip(rows, scores)]
+
+
+def read_header(path):
+    with open(Path(path) / "index.json") as f:
+        return json.load(f)
+
+
+def write_header(path, header):
+    # The header is the commit point: readers only ever see `count` finished rows
+    tmp = Path(path) / "index.json.tmp"
+    with open(tmp, "w") as f:
+        json.dump(header, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, Path(path) / "index.json")
+
+
+def create_index(path, embedder=None, dtype="float16", overwrite=False):
+    path = Path(path)
+    if not overwrite and (path / "index.json").exists():
+        return read_header(path)
+    embedder = embedder or HashingEmbedder()
+    path.mkdir(parents=True, exist_ok=True)
+    for name in DATA_FILES:
+        open(path / name, "wb").close()
+    header = {
+        "version": FORMAT_VERSION,
+        "count": 0,
+        "meta_bytes": 0,
+        "dim": embedder.dim,
+        "dtype": dtype,
+        "embedder": embedder.config(),
+        "deleted": [],
+    }
+    write_header(path, header)
+    return header
+
+
+def append_records(path, records, batch_size=256, delete_rows=(), header_updates=None):
+    """Embed and append records, tombstone `delete_rows`, then commit the header.
+
+    Returns the row number of the first appended record and how many were appended.
+    """
+    path = Path(path)
+    header = read_header(path)
+    embedder = embedder_from_config(header["embedder"])
+    dtype = header["dtype"]
+    first_row = header["count"]
+    _truncate_to_commit(path, header)
+
+    count = first_row
+    with open(path / "vectors.bin", "ab") as vec_f, \
+            open(path / "scales.bin", "ab") as scale_f, \
+            open(path / "chunks.jsonl", "ab") as meta_f, \
+            open(path / "chunks.idx", "ab") as idx_f:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                count += _write_batch(batch, embedder, dtype, vec_f, scale_f, meta_f, idx_f, count)
+                batch = []
+        if batch:
+            count += _write_batch(batch, embedder, dtype, vec_f, scale_f, meta_f, idx_f, count)
+        meta_bytes = meta_f.tell()
+        for f in (vec_f, scale_f, meta_f, idx_f):
+            f.flush()
+            os.fsync(f.fileno())
+
+    header["count"] = count
+    header["meta_bytes"] = meta_bytes
+    header["deleted"] = sorted(set(header.get("deleted", ())).union(delete_rows))
+    header.update(header_updates or {})
+    write_header(path, header)
+    return first_row, count - first_row
+
+
+def _truncate_to_commit(path, header):
+    # Drop bytes a crashed writer left past the last committed header
+    count = header["count"]
+    itemsize = np.dtype(header["dtype"]).itemsize
+    sizes = {
+        "vectors.bin": count * header["dim"] * itemsize,
+        "scales.bin": count * 4 if header["dtype"] == "int8" else 0,
+        "chunks.jsonl": header.get("meta_bytes", 0),
+        "chunks.idx": count * 8,
+    }
+    for name, size in sizes.items():
+        with open(path / name, "ab") as f:
+            if f.tell() != size:
+                f.truncate(size)
+
+
+def _write_batch(batch, embedder, dtype, vec_f, scale_f, meta_f, idx_f, first_row):
+    vectors, scales = quantize(embedder.embed([r["text"] for r in batch]), dtype)
+    vec_f.write(vectors.tobytes())
+    if scales is not None:
+        scale_f.write(scales.tobytes())
+    offsets = np.empty(len(batch), dtype=np.uint64)
+    for i, record in enumerate(batch):
+        record = dict(record)
+        record.setdefault("id", f"chunk-{first_row + i}")
+        offsets[i] = meta_f.tell()
+        meta_f.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+    idx_f.write(offsets.tobytes())
+    return len(batch)
+
+
+def _memmap(path, dtype, shape):
+    if shape[0] == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+class StoreProvider(ContextProvider):
+    """Base for providers that search a VectorStore; subclasses implement `search`.
+
+    Searches run on executor threads, which a provider timeout cannot stop, so
+    each one holds a lease until its thread returns. `retire()` closes the
+    store once the last lease is released: a swapped-out index is closed
+    without being pulled from under a running search.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.leases = 0
+        self.retired = False
+
+    def search(self, prompt, nprobe=None):
+        raise NotImplementedError
+
+    async def fetch(self, query):
+        if query.nprobe is not None and self.store.ann is not None:
+            query.nprobe_applied = True
+        # Embedding, scoring and the chunk reads all block; keep them off the proxy loop
+        self.leases += 1
+        search = asyncio.get_running_loop().run_in_executor(None, self.search, query.prompt, query.nprobe)
+        search.add_done_callback(self._release)
+        return await asyncio.shield(search)
+
+    def retire(self):
+        self.retired = True
+        if not self.leases:
+            self.store.close()
+
+    def _release(self, search):
+        self.leases -= 1
+        if not search.cancelled():
+            # Retrieved here too, so a search that outlived its timeout doesn't log as unhandled
+            search.exception()
+        if self.retired and not self.leases:
+            self.store.close()
+
+
+class VectorStoreProvider(StoreProvider):
+    name = "vectors"
+
+    def __init__(self, store, k=4, min_score=0.1):
+        super().__init__(store)
+        self.k = k
+        self.min_score = min_score
+
+    def search(self, prompt, nprobe=None):
+        chunks = []
+        for meta, score in self.store.query(prompt, self.k, nprobe):
+            if score < self.min_score:
+                continue
+            chunks.append(ContextChunk(meta["id"], meta["text"], score, meta.get("source", self.name)))
+        return chunks
+
+
+def iter_directory_records(docs_dir, max_chars=800):
+    for path in sorted(Path(docs_dir).rglob("*")):
+        if path.is_file() and path.suffix.lower() in (".txt", ".md"):
+            text = path.read_text(encoding="utf-8", errors="replace")
+            for i, chunk in enumerate(chunk_text(text, max_chars)):
+                yield {"id": f"{path.relative_to(docs_dir)}#{i}", "text": chunk, "source": str(path)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query a local RAG index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_cmd = sub.add_parser("build", help="Index every .txt/.md file under a directory")
+    build_cmd.add_argument("docs_dir")
+    build_cmd.add_argument("index_dir")
+    build_cmd.add_argument("--dtype", choices=["float16", "int8"], default="float16")
+    build_cmd.add_argument("--dim", type=int, default=384)
+    build_cmd.add_argument("--no-lexical", action="store_true", help="Skip building the BM25 index")
+    build_cmd.add_argument("--ivf", action="store_true", help="Also build an IVF index, for corpora of millions of chunks")
+    query_cmd = sub.add_parser("query", help="Run a query against an index")
+    query_cmd.add_argument("index_dir")
+    query_cmd.add_argument("text")
+    query_cmd.add_argument("-k", type=int, default=5)
+    query_cmd.add_argument("--nprobe", type=int, default=None, help="IVF lists to probe, if the index has one")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        store = VectorStore.build(args.index_dir, iter_directory_records(args.docs_dir),
+                                  HashingEmbedder(dim=args.dim), dtype=args.dtype)
+        logging.info(f"Indexed {store.count} chunks in {time.perf_counter() - start:.2f}s")
+        if not args.no_lexical:
+            from bm25 import BM25Index
+            BM25Index.build(args.index_dir)
+        if args.ivf:
+            from ivf_index import IVFIndex
+            IVFIndex.build(args.index_dir)
+    else:
+        store = VectorStore.open(args.index_dir)
+        start = time.perf_counter()
+        hits = store.query(args.text, args.k, args.nprobe)
+        logging.info(f"Query took {(time.perf_counter() - start) * 1000:.2f}ms")
+        for meta, score in hits:
+            print(f"{score:.3f}  {meta['id']}  {meta['text'][:100]!r}")
@@ -0,0 +1,218 @@
+# certs.py
+
+import datetime
+import logging
+import os
+import re
+from pathlib import Path
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+logging.basicConfig(level=logging.INFO)
+
+CA_VALIDITY = datetime.timedelta(days=3650)
+# Cached leaves are reissued once they get this close to expiry
+LEAF_RENEW_BEFORE = datetime.timedelta(days=7)
+
+
+def ensure_ca(cert_dir, key_size=2048):
+    """Load the proxy CA from `cert_dir`, generating it in-process the first time.
+
+    Same subject and extensions the old `openssl req` + openssl.cnf produced.
+    Returns (cert_path, key_path).
+    """
+    cert_dir = Path(cert_dir)
+    cert_dir.mkdir(parents=True, exist_ok=True)
+    ca_cert = cert_dir / "mitmproxy-ca.pem"
+    ca_key = cert_dir / "mitmproxy-ca.key"
+    if ca_cert.exists() and ca_key.exists():
+        return ca_cert, ca_key
+
+    logging.info("Generating new CA certificate...")
+    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    name = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, "Custom Proxy CA"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Your Company"),
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "US"),
+    ])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + CA_VALIDITY)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(
+            x509.KeyUsage(
+                digital_signature=False, content_commitment=False, key_encipherment=False,
+                data_encipherment=False, key_agreement=False, key_cert_sign=True, crl_sign=True,
+                encipher_only=False, decipher_only=False,
+            ),
+            critical=True,
+        )
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    _write_secret(ca_key, key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ))
+    ca_cert.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    return ca_cert, ca_key
+
+
+def install_ca(confdir, ca_cert_path, ca_key_path):
+    """Make mitmproxy sign with our CA instead of generating its own in `confdir`.
+
+    mitmproxy reads `<confdir>/mitmproxy-ca.pem` (key followed by cert). Without
+    it, the first start pays for an RSA key generation and the browser is
+    handed leaves from a CA whose SPKI we never pinned.
+    """
+    confdir = Path(confdir)
+    confdir.mkdir(parents=True, exist_ok=True)
+    cert_pem = Path(ca_cert_path).read_bytes()
+    combined = Path(ca_key_path).read_bytes() + cert_pem
+    target = confdir / "mitmproxy-ca.pem"
+    if target.exists() and target.read_bytes() == combined:
+        return False
+    _write_secret(target, combined)
+    (confdir / "mitmproxy-ca-cert.pem").write_bytes(cert_pem)
+    logging.info(f"Installed proxy CA into {confdir}")
+    return True
+
+
+def _write_secret(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+
+
+class LeafCertCache:
+    """Per-host leaf certificates persisted across restarts.
+
+    Like mitmproxy's own leaves, they carry the CA's public key, so each file
+    holds only the certificate and mitmproxy pairs it with the CA key it
+    already has. A cached leaf is used only while it is valid for at least
+    LEAF_RENEW_BEFORE and was signed by the current CA.
+    """
+
+    def __init__(self, directory, ca_cert_path, ca_key_path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ca_cert = x509.load_pem_x509_certificate(Path(ca_cert_path).read_bytes())
+        self._ca_key_path = Path(ca_key_path)
+        self._ca_key = None
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+
+    def path_for(self, host):
+        return self.directory / f"{re.sub(r'[^A-Za-z0-9.*-]', '_', host.lower()).replace('*', '_wildcard_')}.pem"
+
+    def load(self, host):
+        path = self.path_for(host)
+        try:
+            cert = x509.load_pem_x509_certificate(path.read_bytes())
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if not self._usable(cert):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cert
+
+    def save(self, host, cert):
+        path = self.path_for(host)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+        os.replace(tmp, path)
+        self.written += 1
+
+    def issue(self, host):
+        # mitmproxy's own generator, so warmed leaves look exactly like on-demand ones
+        from mitmproxy.certs import dummy_cert
+        if self._ca_key is None:
+            self._ca_key = serialization.load_pem_private_key(self._ca_key_path.read_bytes(), None)
+        cert = dummy_cert(self._ca_key, self.ca_cert, host, [x509.DNSName(host)])._cert
+        self.save(host, cert)
+        return cert
+
+    def warm(self, hosts):
+        """Make sure every host has a usable cached leaf. Returns the number issued."""
+        issued = 0
+        for host in hosts:
+            if self.load(host) is None:
+                self.issue(host)
+                issued += 1
+        return issued
+
+    def _usable(self, cert):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if cert.not_valid_after_utc - now < LEAF_RENEW_BEFORE:
+            return False
+        if cert.public_key() != self.ca_cert.public_key():
+            return False
+        try:
+            cert.verify_directly_issued_by(self.ca_cert)
+        except (InvalidSignature, ValueError, TypeError):
+            return False
+        return True
+
+
+class PersistentCertStore:
+    """mitmproxy addon that serves leaves from a LeafCertCache, keyed by SNI.
+
+    The cached leaf only has to cover the name the browser asked for, so on a
+    restart a known host is served from disk without mitmproxy's upstream-first
+    certificate build and signature. Leaves mitmproxy does generate are written
+    back. `warm_hosts` are loaded when the proxy starts running.
+    """
+
+    def __init__(self, cache, warm_hosts=()):
+        self.cache = cache
+        self.warm_hosts = list(warm_hosts)
+        self.entries = {}
+        self.tlsconfig = None
+
+    def running(self):
+        from mitmproxy import ctx
+        self.tlsconfig = ctx.master.addons.get("tlsconfig")
+        generate = self.tlsconfig.get_cert
+
+        def get_cert(conn_context):
+            sni = conn_context.client.sni
+            if not sni:
+                return generate(conn_context)
+            entry = self.entries.get(sni) or self._load(sni)
+            if entry is None:
+                entry = generate(conn_context)
+                self.cache.save(sni, entry.cert._cert)
+                self.entries[sni] = entry
+            return entry
+
+        # tlsconfig calls self.get_cert(context) for every client handshake
+        self.tlsconfig.get_cert = get_cert
+        loaded = sum(self._load(host) is not None for host in self.warm_hosts)
+        logging.info(f"Leaf certificate cache: {loaded} warm hosts loaded from {self.cache.directory}")
+
+    def configure(self, updated):
+        # A new confdir or cert list means a new CertStore and possibly a new CA key
+        if "certs" in updated or "confdir" in updated:
+            self.entries.clear()
+
+    def _load(self, host):
+        from mitmproxy.certs import Cert, CertStoreEntry
+        cert = self.cache.load(host)
+        if cert is None:
+            return None
+        store = self.tlsconfig.certstore
+        entry = CertStoreEntry(Cert(cert), store.default_privatekey, store.default_chain_file, store.default_chain_certs)
+        self.entries[host] = entry
+        return entry
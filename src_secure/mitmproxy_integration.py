@@ -4,36 +4,58 @@ import threading
 import asyncio
 import logging
 import json
+import time
+import collections
 import os  # Added to handle paths
 from mitmproxy import options, ctx
 from mitmproxy.tools.dump import DumpMaster
 import re
 from pathlib import Path
+from routes import DEFAULT_ALLOWED_HOSTS, compile_routes
+from certs import LeafCertCache, PersistentCertStore, install_ca
 
 logging.basicConfig(level=logging.INFO)
 
 logging.info("Importing mitmproxy_integration.py")
 
 class MitmProxyThread(threading.Thread):
-    def __init__(self, ca_cert_path, ca_key_path, port):
+    def __init__(self, ca_cert_path, ca_key_path, port, confdir=None, warm_hosts=None, leaf_cache=True, options_overrides=None):
         logging.info("Initializing MitmProxyThread...")
         super().__init__()
         self.opts = options.Options(
             listen_host='127.0.0.1',
             listen_port=port,
             ssl_insecure=False,
-            certs=[str(ca_cert_path)],
             key_size=2048,
+        )
+        # Registered by the tlsconfig and RequestResponseLogger addons, so applied once DumpMaster has loaded them
+        self.addon_options = dict(
             tls_version_client_min="TLS1_2",
             tls_version_client_max="TLS1_3",
             tls_version_server_min="TLS1_2",
-            tls_version_server_max="TLS1_3"
+            tls_version_server_max="TLS1_3",
         )
-        
-        self.confdir = Path(__file__).parent / "proxy_data"
+        self.addon_options.update(options_overrides or {})
+
+        self.confdir = Path(confdir) if confdir else Path(__file__).parent / "proxy_data"
         self.confdir.mkdir(exist_ok=True)
         self.opts.confdir = str(self.confdir)
-        
+        # mitmproxy signs leaves with the CA in its confdir; make that the CA Chrome pins
+        install_ca(self.confdir, ca_cert_path, ca_key_path)
+
+        # Leaves persist in proxy_data/leaf-certs; the intercepted hosts are issued before the first connection
+        self.cert_cache = None
+        if leaf_cache:
+            if warm_hosts is None:
+                warm_hosts = [h.strip() for h in self.addon_options.get("allowed_hosts", DEFAULT_ALLOWED_HOSTS).split(",") if h.strip()]
+            self.warm_hosts = warm_hosts
+            self.cert_cache = LeafCertCache(self.confdir / "leaf-certs", ca_cert_path, ca_key_path)
+            issued = self.cert_cache.warm(warm_hosts)
+            logging.info(f"Leaf certificates for {len(warm_hosts)} hosts ready ({issued} issued)")
+
+        # Set once the listen socket is bound, or once startup has failed
+        self.ready = threading.Event()
+        self.listen_addrs = []
         self.loop = asyncio.new_event_loop()
         self.m = None
         logging.info("MitmProxyThread initialized.")
@@ -45,12 +67,30 @@ class MitmProxyThread(threading.Thread):
             self.loop.run_until_complete(self.start_proxy())
         except Exception as e:
             logging.error(f"MitmProxyThread encountered an error: {e}")
+        finally:
+            self.ready.set()
         logging.info("MitmProxyThread run method completed.")
 
+    def wait_ready(self, timeout=None):
+        if not self.ready.wait(timeout):
+            raise TimeoutError(f"Proxy not listening after {timeout}s")
+        if not self.listen_addrs:
+            raise RuntimeError("Proxy failed to start listening")
+        return self.listen_addrs
+
+    def _on_running(self, listen_addrs):
+        self.listen_addrs = listen_addrs
+        logging.info(f"Proxy listening on {listen_addrs}")
+        self.ready.set()
+
     async def start_proxy(self):
         logging.info("Starting mitmproxy server...")
         self.m = DumpMaster(self.opts, with_termlog=False, with_dumper=False)
         self.m.addons.add(RequestResponseLogger())
+        if self.cert_cache is not None:
+            self.m.addons.add(PersistentCertStore(self.cert_cache, self.warm_hosts))
+        self.m.addons.add(ReadySignal(self._on_running))
+        self.m.options.update(**self.addon_options)
         try:
             await self.m.run()
         except Exception as e:
@@ -67,24 +107,65 @@ class MitmProxyThread(threading.Thread):
         logging.info("Event loop stopped.")
         logging.info("mitmproxy server shut down.")
 
+class ReadySignal:
+    # mitmproxy fires `running` only after every proxy server is listening
+    def __init__(self, on_ready):
+        self.on_ready = on_ready
+
+    def running(self):
+        self.on_ready(ctx.master.addons.get("proxyserver").listen_addrs())
+
 class RequestResponseLogger:
+    def __init__(self, routes=None):
+        self.route_list = routes
+        self.routes = compile_routes(DEFAULT_ALLOWED_HOSTS, routes)
+        self.stats = collections.Counter()
+        self.cpu_start = time.process_time()
+
     def load(self, loader):
         logging.info("Loading RequestResponseLogger addon...")
         loader.add_option(
             "allowed_hosts", 
             str, 
-            "chat.openai.com",
-            "Comma-separated list of allowed hosts"
+            DEFAULT_ALLOWED_HOSTS,
+            "Comma-separated list of hosts to decrypt; all other TLS is passed through"
         )
         logging.info("RequestResponseLogger addon loaded.")
 
+    def configure(self, updated):
+        # allowed_hosts is the input to the compiled route table
+        if "allowed_hosts" in updated:
+            self.routes = compile_routes(ctx.options.allowed_hosts, self.route_list)
+            logging.info(f"Route table compiled for hosts: {', '.join(sorted(self.routes.allowed_hosts))}")
+
+    def tls_clienthello(self, data):
+        host = data.client_hello.sni
+        if host is None and data.context.server.address:
+            host = data.context.server.address[0]
+        if not self.routes.intercepts_host(host):
+            data.ignore_connection = True
+            self.stats["passthrough_connections"] += 1
+
+    def requestheaders(self, flow):
+        route = self.routes.match_flow(flow)
+        flow.metadata["route"] = route
+        if route is None:
+            flow.request.stream = True
+            self.stats["decrypted_flows"] += 1
+        else:
+            self.stats["intercepted_flows"] += 1
+
+    def done(self):
+        cpu = time.process_time() - self.cpu_start
+        logging.info(
+            f"Proxy CPU: {cpu:.2f}s, intercepted={self.stats['intercepted_flows']} "
+            f"decrypted={self.stats['decrypted_flows']} passthrough={self.stats['passthrough_connections']}"
+        )
+
     def request(self, flow):
-        print(f"🌐 Request: {flow.request.method} {flow.request.url}")
-        logging.info(f"Processing request: {flow.request.method} {flow.request.url}")
-        
-        # Flexible URL matching - works with backend-anon, backend-api, or future changes
-        if "/conversation" in flow.request.url and "chatgpt.com" in flow.request.url:
-            print("🔥 INTERCEPTED CHATGPT REQUEST!")
+        route = flow.metadata.get("route")
+        if route is not None and route.inject:
+            print(f"🔥 INTERCEPTED CHATGPT REQUEST! {flow.request.method} {flow.request.url}")
             logging.info(f"Allowed host detected: {flow.request.pretty_host}")
             try:
                 payload_json = json.loads(flow.request.content)
@@ -103,17 +184,19 @@ class RequestResponseLogger:
                 print(f"❌ Error modifying prompt: {e}")
                 logging.error(f"Error modifying prompt: {e}")
 
+    def responseheaders(self, flow):
+        if flow.metadata.get("route") is None:
+            flow.response.stream = True
+
     def response(self, flow):
-        logging.info(f"Processing response: {flow.response.status_code} {flow.request.url}")
-        if flow.request.pretty_host in ctx.options.allowed_hosts.split(','):
-            logging.info(f"Allowed host detected for response: {flow.request.pretty_host}")
-            if flow.request.url == "https://chatgpt.com/backend-anon/conversation":
-                if flow.response.content:
-                    try:
-                        final_text = extract_final_text(flow.response.content)
-                        logging.info(f"Final Response Text: {final_text}")
-                    except Exception as e:
-                        logging.error(f"Error extracting final text: {e}")
+        if flow.metadata.get("route") is not None:
+            logging.info(f"Processing response: {flow.response.status_code} {flow.request.url}")
+            if flow.response.content:
+                try:
+                    final_text = extract_final_text(flow.response.content)
+                    logging.info(f"Final Response Text: {final_text}")
+                except Exception as e:
+                    logging.error(f"Error extracting final text: {e}")
 
 def extract_final_text(response_bytes):
     logging.info("Extracting final text from response...")
@@ -0,0 +1,108 @@
+# routes.py
+
+DEFAULT_ALLOWED_HOSTS = "chatgpt.com,chat.openai.com"
+
+
+class Route:
+    """One interception target. `hosts=None` binds the route to every allowed host."""
+
+    def __init__(self, name, paths, methods=None, hosts=None, inject=True):
+        self.name = name
+        self.paths = list(paths)
+        self.methods = frozenset(m.upper() for m in methods) if methods else None
+        self.hosts = hosts
+        self.inject = inject
+
+    def __repr__(self):
+        return f"Route({self.name!r})"
+
+
+# Covers the logged-in (backend-api), anonymous (backend-anon) and /f/ endpoints
+DEFAULT_ROUTES = [
+    Route(
+        "chatgpt-conversation",
+        paths=["/*/conversation", "/*/f/conversation"],
+        methods=["POST"],
+    ),
+]
+
+
+class _PathNode:
+    __slots__ = ("children", "wildcard", "routes")
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None
+        self.routes = []
+
+
+class RouteTable:
+    """Host dict + per-host segment trie, built once and then only read.
+
+    Host lookup is a dict hit; path lookup walks the path's segments once.
+    A `*` segment in a pattern matches any single segment.
+    """
+
+    def __init__(self, routes, allowed_hosts):
+        self.routes = list(routes)
+        self.allowed_hosts = frozenset(_split_hosts(allowed_hosts))
+        self._tries = {}
+        for route in self.routes:
+            hosts = route.hosts if route.hosts is not None else self.allowed_hosts
+            for host in hosts:
+                root = self._tries.setdefault(host.lower(), _PathNode())
+                for pattern in route.paths:
+                    _insert(root, pattern, route)
+
+    def intercepts_host(self, host):
+        return host is not None and host.lower() in self._tries
+
+    def match(self, host, path, method=None):
+        root = self._tries.get(host.lower()) if host else None
+        if root is None:
+            return None
+        query = path.find("?")
+        if query != -1:
+            path = path[:query]
+        for route in _walk(root, path.strip("/").split("/"), 0):
+            if route.methods is None or method is None or method.upper() in route.methods:
+                return route
+        return None
+
+    def match_flow(self, flow):
+        request = flow.request
+        return self.match(request.pretty_host, request.path, request.method)
+
+
+def compile_routes(allowed_hosts=DEFAULT_ALLOWED_HOSTS, routes=None):
+    return RouteTable(DEFAULT_ROUTES if routes is None else routes, allowed_hosts)
+
+
+def _split_hosts(allowed_hosts):
+    if isinstance(allowed_hosts, str):
+        allowed_hosts = allowed_hosts.split(",")
+    return [h.strip().lower() for h in allowed_hosts if h.strip()]
+
+
+def _insert(root, pattern, route):
+    node = root
+    for segment in pattern.strip("/").split("/"):
+        if segment == "*":
+            if node.wildcard is None:
+                node.wildcard = _PathNode()
+            node = node.wildcard
+        else:
+            node = node.children.setdefault(segment, _PathNode())
+    node.routes.append(route)
+
+
+def _walk(node, segments, i):
+    # Exact segments take priority over wildcards
+    if i == len(segments):
+        yield from node.routes
+        return
+    child = node.children.get(segments[i])
+    if child is not None:
+        yield from _walk(child, segments, i + 1)
+    if node.wildcard is not None:
+        yield from _walk(node.wildcard, segments, i + 1)
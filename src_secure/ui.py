@@ -8,6 +8,7 @@ from PySide6.QtCore import QUrl
 from PySide6.QtNetwork import QSslCertificate, QSslConfiguration, QSslSocket
 import os
 import logging
+from tab_lifecycle import FREEZE_AFTER, MEMORY_BUDGET_MB, TabLifecycleManager, format_stats
 
 logging.basicConfig(level=logging.INFO)
 logging.info("Importing ui.py")
@@ -30,7 +31,7 @@ class CustomWebEnginePage(QWebEnginePage):
         return False
 
 class MainWindow(QMainWindow):
-    def __init__(self, ca_cert_path):
+    def __init__(self, ca_cert_path, freeze_after=FREEZE_AFTER, memory_budget_mb=MEMORY_BUDGET_MB):
         logging.info("Initializing MainWindow...")
         super(MainWindow, self).__init__()
         self.setWindowTitle('PyBrowser')
@@ -65,6 +66,12 @@ class MainWindow(QMainWindow):
         self.tabs.tabCloseRequested.connect(self.close_tab)
         self.setCentralWidget(self.tabs)
 
+        # Background tabs are frozen when idle and discarded under memory pressure
+        logging.info("Creating tab lifecycle manager...")
+        self.lifecycle = TabLifecycleManager(
+            self.tabs, freeze_after, memory_budget_mb,
+            on_stats=lambda stats: self.statusBar().showMessage(format_stats(stats)), parent=self)
+
         # Create toolbar
         logging.info("Creating toolbar...")
         toolbar = QToolBar()
@@ -109,11 +116,11 @@ class MainWindow(QMainWindow):
         browser.setPage(page)
         browser.setUrl(QUrl('https://chat.openai.com'))
 
+        # Registered first so it sees the tab become current; it also keeps the tab title
+        self.lifecycle.add(browser)
         self.tabs.addTab(browser, 'New Tab')
         self.tabs.setCurrentWidget(browser)
 
-        browser.titleChanged.connect(
-            lambda title, browser=browser: self.tabs.setTabText(self.tabs.indexOf(browser), title))
         browser.urlChanged.connect(
             lambda url, browser=browser: self.update_url(url) if self.tabs.currentWidget() == browser else None)
         
@@ -126,6 +133,7 @@ class MainWindow(QMainWindow):
             self.close()
         else:
             browser_widget = self.tabs.widget(index)
+            self.lifecycle.remove(browser_widget)
             browser_widget.deleteLater()
             self.tabs.removeTab(index)
             logging.info(f"Tab {index} closed.")